@@ -11,10 +11,15 @@ import io
 import json
 import hashlib
 import sys
+import bisect
+import heapq
+from array import array
 from datetime import datetime, timedelta, date, timezone
 from typing import Dict, List, Optional, Tuple, Any, Union
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 from functools import lru_cache, wraps
+from itertools import islice
+from contextvars import ContextVar
 
 import asyncpg
 from aiogram import Bot, Dispatcher, types, BaseMiddleware, F
@@ -25,13 +30,15 @@ from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import (
     ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup,
     InlineKeyboardButton, CallbackQuery, Message, BufferedInputFile,
-    ChatPermissions, ContentType
+    ChatPermissions, ContentType, ChatMemberUpdated
 )
 from aiogram.exceptions import (
     TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter,
     TelegramAPIError
 )
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.event.handler import HandlerObject
 from aiogram.enums import ParseMode
 from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
 
@@ -73,6 +80,10 @@ if REDIS_URL:
     except Exception as e:
         logging.error(f"❌ Ошибка подключения к Redis: {e}")
 
+# Без Redis кулдауны живут в памяти процесса; при COOLDOWNS_DURABLE=1 они дублируются
+# в таблицу global_cooldowns и переживают перезапуск
+COOLDOWNS_DURABLE = os.getenv("COOLDOWNS_DURABLE", "0") == "1"
+
 # ==================== СОЗДАНИЕ БОТА ====================
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 storage = MemoryStorage()
@@ -173,6 +184,7 @@ DEFAULT_SETTINGS = {
     "theft_defense_penalty": "10",
     "min_theft_amount": "5",
     "max_theft_amount": "15",
+    "random_target_require_balance": "0",  # 1 — случайная цель только с балансом больше min_theft_amount
 
     # ----- КАЗИНО -----
     "casino_win_chance": "40.0",
@@ -319,6 +331,16 @@ DEFAULT_SETTINGS = {
     "global_cooldown_seconds": "3",
     "global_chat_cooldown_hours": "1",
 
+    # ----- ТРОТТЛИНГ (ТОКЕН-БАКЕТЫ: ЁМКОСТЬ И ПОПОЛНЕНИЕ В СЕКУНДУ, 0 — ВЫКЛ) -----
+    "throttle_private_burst": "3",
+    "throttle_private_rate": "2",
+    "throttle_group_burst": "5",
+    "throttle_group_rate": "1",
+    "throttle_chat_burst": "30",
+    "throttle_chat_rate": "10",
+    "throttle_callback_burst": "4",
+    "throttle_callback_rate": "2",
+
     # ----- ЛИМИТ НА ВВОД ЧИСЕЛ -----
     "max_input_number": "1000000",
 
@@ -338,6 +360,27 @@ DEFAULT_SETTINGS = {
     "promocode_max_uses_default": "1",
 }
 
+# Дробные настройки; остальные числовые читаются как int, нечисловые — как str
+FLOAT_SETTINGS = frozenset({
+    "business_upgrade_cost_per_level", "casino_max_bet", "casino_min_bet", "casino_win_chance",
+    "exchange_commission_percent", "exchange_min_amount_btc", "gift_amount", "golden_ticket_gift",
+    "level_multiplier", "level_reward_coins", "level_reward_coins_increment", "max_input_number",
+    "min_theft_amount", "new_user_bonus", "random_attack_cost", "referral_bonus",
+    "reputation_defense_bonus", "reputation_max_bonus_percent", "reputation_theft_bonus",
+    "roulette_color_multiplier", "roulette_green_multiplier", "roulette_number_multiplier",
+    "roulette_win_chance", "slots_multiplier_diamond", "slots_multiplier_seven",
+    "slots_multiplier_three", "slots_win_probability", "smuggle_base_amount",
+    "targeted_attack_cost", "theft_defense_chance", "theft_success_chance",
+})
+
+def _setting_type(key: str):
+    if key in FLOAT_SETTINGS:
+        return float
+    default = DEFAULT_SETTINGS.get(key)
+    if default is not None and default.lstrip('-').isdigit():
+        return int
+    return str
+
 # ==================== ТИПЫ БИЗНЕСОВ ====================
 BUSINESS_TYPES = [
     {
@@ -423,6 +466,41 @@ MEDIA_KEYS = [
 
 # ==================== КОНСТАНТЫ ====================
 ITEMS_PER_PAGE = 10
+ORDER_BOOK_DEPTH_LEVELS = 10  # сколько уровней стакана показывается и зеркалируется в Redis
+ORDER_BOOK_REDIS_KEY = "exchange:depth"
+LEADERBOARD_FIELDS = ('balance', 'total_spent', 'theft_success', 'reputation', 'bitcoin_balance', 'level')
+LEADERBOARD_FLUSH_INTERVAL = 5       # секунд между применениями изменений к индексам топов
+LEADERBOARD_RESYNC_INTERVAL = 1800   # полная пересборка индексов из users
+LEADERBOARD_COMMIT_GRACE = 30       # столько секунд после отметки пользователь перечитывается (запись могла быть ещё не закоммичена)
+LEADERBOARD_NOTIFY_MAX_IDS = 500     # user_id в одном NOTIFY об изменениях топов (без Redis)
+CHAT_MEMBER_TOUCH_INTERVAL = 3600    # не чаще раза в час обновляем last_seen одной пары (чат, пользователь)
+CHAT_MEMBERS_FLUSH_INTERVAL = 10     # секунд между пакетными записями chat_members
+CHAT_MEMBERS_SEEN_MAX = 200000
+COOLDOWN_WHEEL_SLOTS = 3600          # слотов в колесе таймеров кулдаунов (по секунде)
+THROTTLE_LOCAL_MAX = 100000          # бакетов в локальном лимитере (без Redis)
+THROTTLE_WARNING_INTERVAL = 60       # не чаще раза в минуту предупреждаем о флуде
+LEADER_LOCK_ID = 7_318_204_551       # ключ advisory lock лидера фоновых задач
+LEADER_CHECK_INTERVAL = 5            # секунд между проверками соединения лидера / попытками захвата
+WORKER_HEARTBEAT_INTERVAL = 10       # секунд между отметками воркера в bot_workers
+WORKER_STALE_AFTER = 30              # воркер без отметки дольше этого считается мёртвым
+SHARD_GRACE_SECONDS = 60             # просроченный срок чужого шарда выполняет любой воркер
+BROADCAST_RATE = 25                  # сообщений в секунду на всю рассылку (лимит Telegram ~30)
+BROADCAST_SENDERS = 8                # параллельных отправителей
+BROADCAST_BATCH = 500                # пользователей за одно чтение курсора
+BROADCAST_CHECKPOINT = 25            # адресатов между сохранениями курсора (столько максимум повторится после сбоя)
+BROADCAST_PROGRESS_INTERVAL = 3      # секунд между обновлениями сообщения о прогрессе
+BROADCAST_STALE_AFTER = 60           # рассылку без прогресса дольше этого подхватывает лидер
+OUTBOUND_GLOBAL_RATE = 30            # сообщений в секунду на бота (лимит Telegram)
+OUTBOUND_PRIVATE_RATE = 1.0          # сообщений в секунду в один личный чат
+OUTBOUND_PRIVATE_BURST = 3
+OUTBOUND_GROUP_RATE = 20 / 60        # 20 сообщений в минуту в одну группу
+OUTBOUND_GROUP_BURST = 5
+OUTBOUND_MAX_IN_FLIGHT = 16          # одновременных запросов к Bot API из очереди
+OUTBOUND_MAX_ATTEMPTS = 3            # попыток доставки при RetryAfter
+OUTBOUND_SCAN_LIMIT = 50             # сколько сообщений одного приоритета просматриваем в поиске свободного чата
+MAX_LEVEL = 100
+LEVEL_REWARD_SETTINGS = ("level_reward_coins", "level_reward_reputation",
+                         "level_reward_coins_increment", "level_reward_reputation_increment")
 BIG_WIN_THRESHOLD = 100
 BIG_PURCHASE_THRESHOLD = 100
 
@@ -729,13 +807,25 @@ logging.basicConfig(
 
 # ==================== ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ====================
 db_pool = None
-settings_cache = {}
-settings_cache_lock = asyncio.Lock()
-last_settings_update = 0
+SETTINGS_REFRESH_INTERVAL = 60  # секунд между фоновыми перечитываниями таблицы settings
+CACHE_INVALIDATION_CHANNEL = "bot_cache_invalidation"  # канал Postgres NOTIFY для сброса кэшей между воркерами
+CACHE_TTL_WITH_NOTIFY = 6 * 3600   # TTL кэшей, пока слушатель NOTIFY подключён
+CACHE_TTL_WITHOUT_NOTIFY = 300     # TTL кэшей, если слушатель недоступен
+cache_listener_conn = None
 channels_cache = []
 last_channels_update = 0
 confirmed_chats_cache = {}
 last_confirmed_chats_update = 0
+media_cache = {}  # key -> (file_id, время загрузки)
+SUBSCRIPTION_POSITIVE_TTL = 600   # сколько секунд доверяем подтверждённой подписке
+SUBSCRIPTION_NEGATIVE_TTL = 30    # сколько секунд помним отсутствие подписки
+SUBSCRIPTION_CACHE_MAX = 50000
+subscription_cache = {}  # (str(channel_id), user_id) -> (подписан, истекает_в)
+KNOWN_USERS_MAX = 100000
+known_users = OrderedDict()   # LRU: user_id -> (username, first_name), пользователи, точно существующие в БД
+banned_user_ids = set()       # заблокированные пользователи (загружаются при старте)
+admin_permissions_cache = {}  # user_id младшего админа -> список прав
+access_cache_loaded = False
 # ==================== КОНЕЦ ЧАСТИ 1.1 ====================
 # ==================== ЧАСТЬ 1.2: ДЕКОРАТОРЫ, МИДЛВАРИ, ФУНКЦИИ ПРОВЕРКИ ПРАВ, БЕЗОПАСНАЯ ОТПРАВКА, АВТОУДАЛЕНИЕ, ПОДКЛЮЧЕНИЕ К БД, ИНИЦИАЛИЗАЦИЯ ТАБЛИЦ, РАБОТА С НАСТРОЙКАМИ, ФУНКЦИИ ДЛЯ ЧАТОВ И ПОЛЬЗОВАТЕЛЕЙ (ПРОДОЛЖЕНИЕ) ====================
 
@@ -762,33 +852,118 @@ def db_retry(max_retries=3, delay=1):
     return decorator
 
 # ==================== МИДЛВАРЬ ДЛЯ ЛИЧНЫХ СООБЩЕНИЙ (анти-флуд) ====================
+# Токен-бакет в Redis: один на ключ для всех воркеров. Время передаётся из бота в миллисекундах.
+THROTTLE_LUA = """
+local burst = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(data[1])
+local ts = tonumber(data[2])
+if tokens == nil then
+    tokens = burst
+    ts = now
+end
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+return allowed
+"""
+
+class TokenBucketLimiter:
+    """Локальный токен-бакет (запасной вариант без Redis). Хранит не больше THROTTLE_LOCAL_MAX ключей."""
+
+    def __init__(self, max_keys: int = THROTTLE_LOCAL_MAX):
+        self.buckets = OrderedDict()  # key -> [tokens, ts]
+        self.max_keys = max_keys
+
+    def allow(self, key: str, burst: float, rate: float, now: float) -> bool:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = [burst, now]
+            self.buckets[key] = bucket
+            if len(self.buckets) > self.max_keys:
+                # Вытесненный бакет просто начнётся заново полным
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True
+        return False
+
+local_throttle = TokenBucketLimiter()
+throttle_script = None
+
+async def throttle_allow(scope: str, key_id: int) -> bool:
+    """Списывает токен из бакета scope:key_id. Параметры берутся из настроек throttle_{scope}_*."""
+    cfg = settings_snapshot
+    burst = cfg.get_float(f"throttle_{scope}_burst")
+    rate = cfg.get_float(f"throttle_{scope}_rate")
+    if burst <= 0 or rate <= 0:
+        return True
+    key = f"tb:{scope}:{key_id}"
+    global throttle_script
+    if redis_client is not None:
+        try:
+            if throttle_script is None:
+                throttle_script = redis_client.register_script(THROTTLE_LUA)
+            allowed = await throttle_script(keys=[key], args=[burst, rate, int(time.time() * 1000)])
+            return bool(int(allowed))
+        except Exception as e:
+            logging.error(f"Redis throttle error: {e}")
+    return local_throttle.allow(key, burst, rate, time.time())
+
 class ThrottlingMiddleware(BaseMiddleware):
-    def __init__(self, rate_limit=1.0):
-        self.rate_limit = rate_limit
-        self.user_last_time = defaultdict(float)
-        self.last_warning = defaultdict(float)  # для ограничения спама предупреждениями
+    """
+    Внешний мидлварь для сообщений и колбэков: токен-бакеты по областям
+    private (пользователь в личке), group (пользователь в группах), chat (весь чат), callback (кнопки).
+    Стоит раньше загрузки контекста пользователя, так что отсечённый флуд не доходит до БД.
+    """
 
-    async def __call__(self, handler, event: Message, data: dict):
-        if event.chat.type != 'private':
-            return await handler(event, data)
-        user_id = event.from_user.id
-        if await is_super_admin(user_id):
+    def __init__(self):
+        self.last_warning = OrderedDict()
+
+    def _should_warn(self, user_id: int, now: float) -> bool:
+        if now - self.last_warning.get(user_id, 0) < THROTTLE_WARNING_INTERVAL:
+            return False
+        self.last_warning[user_id] = now
+        self.last_warning.move_to_end(user_id)
+        if len(self.last_warning) > THROTTLE_LOCAL_MAX:
+            self.last_warning.popitem(last=False)
+        return True
+
+    async def __call__(self, handler, event, data: dict):
+        user = data.get('event_from_user')
+        if user is None or user.id in SUPER_ADMINS:
             return await handler(event, data)
-        now = time.time()
-        if now - self.user_last_time[user_id] < self.rate_limit:
-            # Отправляем предупреждение не чаще чем раз в 60 секунд
-            if now - self.last_warning[user_id] > 60:
+        if isinstance(event, CallbackQuery):
+            if not await throttle_allow("callback", user.id):
                 try:
-                    await event.answer("⏳ Слишком много запросов. Подожди секунду.")
-                    self.last_warning[user_id] = now
+                    await event.answer("⏳ Не так быстро!")
                 except Exception:
                     pass
+                return
+            return await handler(event, data)
+        if event.chat.type == 'private':
+            if not await throttle_allow("private", user.id):
+                if self._should_warn(user.id, time.time()):
+                    try:
+                        await event.answer("⏳ Слишком много запросов. Подожди секунду.")
+                    except Exception:
+                        pass
+                return
+            return await handler(event, data)
+        # В группах молча отбрасываем: предупреждения сами были бы флудом
+        if not await throttle_allow("group", user.id) or not await throttle_allow("chat", event.chat.id):
             return
-        self.user_last_time[user_id] = now
-        if len(self.user_last_time) > 1000:
-            cutoff = now - 3600
-            self.user_last_time = defaultdict(float, {k:v for k,v in self.user_last_time.items() if v > cutoff})
-            self.last_warning = defaultdict(float, {k:v for k,v in self.last_warning.items() if v > cutoff})
         return await handler(event, data)
 
 # ==================== МИДЛВАРЬ ДЛЯ ГЛОБАЛЬНОГО КУЛДАУНА В ЧАТАХ ====================
@@ -798,8 +973,7 @@ class GlobalCooldownMiddleware(BaseMiddleware):
             return await handler(event, data)
         user_id = event.from_user.id
         try:
-            cooldown_hours = await get_setting_int("global_chat_cooldown_hours")
-            ok, remaining = await check_global_cooldown(user_id, "chat_activity", cooldown_hours * 3600)
+            ok, remaining = await check_global_cooldown(user_id, "chat_activity")
             if not ok:
                 await auto_delete_command(event, f"⏳ Глобальный кулдаун! Ты сможешь снова участвовать через {format_time_remaining(remaining)}")
                 return
@@ -807,14 +981,186 @@ class GlobalCooldownMiddleware(BaseMiddleware):
             logging.error(f"GlobalCooldownMiddleware error: {e}")
         return await handler(event, data)
 
+# ==================== МИДЛВАРЬ КОНТЕКСТА ПОЛЬЗОВАТЕЛЯ ====================
+class UserContextLoaderMiddleware(BaseMiddleware):
+    """
+    Внешний мидлварь: одним запросом загружает строку users для автора апдейта
+    и кладёт UserContext в data['user_ctx'] и в current_user_ctx, откуда его берут геттеры.
+    В группах строка грузится только для команд, чтобы не читать БД на каждое сообщение.
+    Регистрируется на сообщения и колбэки после ThrottlingMiddleware.
+    """
+    async def __call__(self, handler, event, data: dict):
+        user = data.get('event_from_user')
+        chat = data.get('event_chat')
+        if user is None or db_pool is None:
+            return await handler(event, data)
+        if isinstance(event, Message) and chat is not None and chat.type != 'private':
+            if not (event.text or '').startswith('/'):
+                return await handler(event, data)
+        try:
+            async with db_pool.acquire() as conn:
+                row = await conn.fetchrow("SELECT * FROM users WHERE user_id=$1", user.id)
+        except Exception as e:
+            logging.error(f"UserContextLoaderMiddleware error: {e}")
+            return await handler(event, data)
+        ctx = UserContext(user.id, dict(row) if row else None)
+        data['user_ctx'] = ctx
+        token = current_user_ctx.set(ctx)
+        try:
+            return await handler(event, data)
+        finally:
+            # Задачи, запущенные из хендлера, наследуют контекст — после апдейта он им не должен доверяться
+            ctx.active = False
+            current_user_ctx.reset(token)
+
+# ==================== МИДЛВАРЬ УЧЁТА УЧАСТНИКОВ ЧАТОВ ====================
+class ChatMembershipMiddleware(BaseMiddleware):
+    """Отмечает авторов сообщений в группах для топов чата (только в памяти, запись в БД пакетами)."""
+    async def __call__(self, handler, event: Message, data: dict):
+        if event.chat.type in ('group', 'supergroup') and event.from_user and not event.from_user.is_bot:
+            record_chat_member(event.chat.id, event.from_user.id)
+        return await handler(event, data)
+
+# ==================== ИНДЕКС МАРШРУТИЗАЦИИ (КНОПКИ И CALLBACK_DATA) ====================
+class PrefixTrie:
+    """Посимвольное дерево префиксов: match() отдаёт все значения, чьи префиксы являются началом строки."""
+
+    def __init__(self):
+        self.root = {}
+
+    def insert(self, prefix: str, value):
+        node = self.root
+        for ch in prefix:
+            node = node.setdefault(ch, {})
+        node.setdefault(None, value)
+
+    def match(self, text: str) -> list:
+        found = []
+        node = self.root
+        if None in node:
+            found.append(node[None])
+        for ch in text:
+            node = node.get(ch)
+            if node is None:
+                break
+            if None in node:
+                found.append(node[None])
+        return found
+
+button_routes: Dict[str, HandlerObject] = {}         # точный текст кнопки -> хендлер
+callback_exact_routes: Dict[str, Tuple[int, HandlerObject]] = {}
+callback_prefix_routes = PrefixTrie()                # префикс callback_data -> (порядок, хендлер)
+route_counter = 0
+
+def button(*texts: str):
+    """
+    Регистрирует хендлер кнопки: обычным фильтром F.text (для пользователей в состоянии FSM)
+    и в индексе button_routes, откуда он вызывается без перебора фильтров.
+    """
+    def decorator(fn):
+        dp.message(F.text == texts[0] if len(texts) == 1 else F.text.in_(texts))(fn)
+        handler = HandlerObject(callback=fn)
+        for text in texts:
+            button_routes.setdefault(text, handler)
+        return fn
+    return decorator
+
+def _next_route_order() -> int:
+    # Порядок регистрации решает, какой хендлер победит при совпадении нескольких префиксов — как в цепочке фильтров
+    global route_counter
+    route_counter += 1
+    return route_counter
+
+def callback_exact(data: str, *filters):
+    def decorator(fn):
+        dp.callback_query(F.data == data, *filters)(fn)
+        callback_exact_routes.setdefault(data, (_next_route_order(), HandlerObject(callback=fn)))
+        return fn
+    return decorator
+
+def callback_prefix(prefix: str, *filters):
+    def decorator(fn):
+        dp.callback_query(F.data.startswith(prefix), *filters)(fn)
+        callback_prefix_routes.insert(prefix, (_next_route_order(), HandlerObject(callback=fn)))
+        return fn
+    return decorator
+
+def match_callback_route(data: str) -> Optional[HandlerObject]:
+    candidates = callback_prefix_routes.match(data)
+    exact = callback_exact_routes.get(data)
+    if exact is not None:
+        candidates.append(exact)
+    if not candidates:
+        return None
+    return min(candidates, key=lambda c: c[0])[1]
+
+class DispatchIndexMiddleware(BaseMiddleware):
+    """
+    Внешний мидлварь: пока у пользователя нет состояния FSM, находит хендлер кнопки по словарю,
+    а колбэка — по дереву префиксов, и вызывает его напрямую. Всё остальное (состояния FSM, группы,
+    команды) идёт обычной цепочкой фильтров.
+    """
+    async def __call__(self, handler, event, data: dict):
+        if data.get('raw_state') is None:
+            route = None
+            if isinstance(event, CallbackQuery):
+                if event.data:
+                    route = match_callback_route(event.data)
+            elif event.chat.type == 'private' and event.text:
+                route = button_routes.get(event.text)
+            if route is not None:
+                return await route.call(event, **data)
+        return await handler(event, data)
+
 # Мидлвари будут зарегистрированы в конце этого файла после определения всех функций
 
 # ==================== ФУНКЦИИ ПРОВЕРКИ ПРАВ ====================
+def _parse_permissions(perms_json) -> List[str]:
+    if not perms_json:
+        return []
+    try:
+        return json.loads(perms_json)
+    except (ValueError, TypeError):
+        return []
+
+@db_retry()
+async def load_access_cache():
+    """Загружает в память множество забаненных и права младших админов."""
+    global banned_user_ids, admin_permissions_cache, access_cache_loaded
+    async with db_pool.acquire() as conn:
+        banned_rows = await conn.fetch("SELECT user_id FROM banned_users")
+        admin_rows = await conn.fetch("SELECT user_id, permissions FROM admins")
+    banned_user_ids = {r['user_id'] for r in banned_rows}
+    admin_permissions_cache = {r['user_id']: _parse_permissions(r['permissions']) for r in admin_rows}
+    access_cache_loaded = True
+
+@db_retry()
+async def refresh_ban_cache_entry(user_id: int):
+    async with db_pool.acquire() as conn:
+        banned = await conn.fetchval("SELECT 1 FROM banned_users WHERE user_id=$1", user_id)
+    if banned:
+        banned_user_ids.add(user_id)
+        remove_theft_target(user_id)
+    else:
+        banned_user_ids.discard(user_id)
+        touch_leaderboards(user_id)
+
+@db_retry()
+async def refresh_admin_cache_entry(user_id: int):
+    async with db_pool.acquire() as conn:
+        row = await conn.fetchrow("SELECT permissions FROM admins WHERE user_id=$1", user_id)
+    if row:
+        admin_permissions_cache[user_id] = _parse_permissions(row['permissions'])
+    else:
+        admin_permissions_cache.pop(user_id, None)
+
 async def is_super_admin(user_id: int) -> bool:
     return user_id in SUPER_ADMINS
 
 @db_retry()
 async def is_junior_admin(user_id: int) -> bool:
+    if access_cache_loaded:
+        return user_id in admin_permissions_cache
     async with db_pool.acquire() as conn:
         row = await conn.fetchval("SELECT user_id FROM admins WHERE user_id=$1", user_id)
     return row is not None
@@ -828,32 +1174,18 @@ async def is_admin(user_id: int) -> bool:
         logging.error(f"Error checking junior admin for {user_id}: {e}")
         return False
 
-@db_retry()
 async def has_permission(user_id: int, permission: str) -> bool:
-    if await is_super_admin(user_id):
-        return True
-    async with db_pool.acquire() as conn:
-        perms_json = await conn.fetchval("SELECT permissions FROM admins WHERE user_id=$1", user_id)
-    if not perms_json:
-        return False
-    try:
-        perms = json.loads(perms_json)
-        return permission in perms
-    except:
-        return False
+    return permission in await get_admin_permissions(user_id)
 
 @db_retry()
 async def get_admin_permissions(user_id: int) -> List[str]:
     if await is_super_admin(user_id):
         return PERMISSIONS_LIST.copy()
+    if access_cache_loaded:
+        return list(admin_permissions_cache.get(user_id, []))
     async with db_pool.acquire() as conn:
         perms_json = await conn.fetchval("SELECT permissions FROM admins WHERE user_id=$1", user_id)
-    if not perms_json:
-        return []
-    try:
-        return json.loads(perms_json)
-    except:
-        return []
+    return _parse_permissions(perms_json)
 
 @db_retry()
 async def update_admin_permissions(user_id: int, permissions: List[str]):
@@ -862,35 +1194,234 @@ async def update_admin_permissions(user_id: int, permissions: List[str]):
             "UPDATE admins SET permissions=$1 WHERE user_id=$2",
             json.dumps(permissions), user_id
         )
+        admin_permissions_cache[user_id] = list(permissions)
+        await notify_cache_invalidation("admins", str(user_id), conn=conn)
+
+# ==================== ОЧЕРЕДЬ ИСХОДЯЩИХ СООБЩЕНИЙ ====================
+# Все фоновые отправки идут через одну очередь: общий лимит бота, лимит на чат,
+# приоритеты и общая пауза после 429. Ответы хендлеров (message.answer и т.п.) уходят
+# напрямую, но учитываются в тех же бакетах через middleware сессии.
+PRIORITY_INTERACTIVE = 0   # ответы на действия пользователя
+PRIORITY_GAME = 1          # результаты игр, налётов, рейсов
+PRIORITY_NOTIFY = 2        # уведомления
+PRIORITY_BROADCAST = 3     # рассылки
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "ответы",
+    PRIORITY_GAME: "игры",
+    PRIORITY_NOTIFY: "уведомления",
+    PRIORITY_BROADCAST: "рассылки",
+}
 
-# ==================== БЕЗОПАСНАЯ ОТПРАВКА ====================
-async def safe_send_message(user_id: int, text: str, **kwargs):
-    try:
-        await bot.send_message(user_id, text, **kwargs)
-    except TelegramBadRequest as e:
-        logging.warning(f"Bad request for user {user_id}: {e}")
-    except TelegramForbiddenError:
-        logging.warning(f"Bot blocked by user {user_id}")
-    except TelegramRetryAfter as e:
-        logging.warning(f"Flood limit exceeded. Retry after {e.retry_after} seconds")
-        await asyncio.sleep(e.retry_after)
+# Отправка изнутри очереди (middleware сессии её не учитывает повторно)
+outbound_origin: ContextVar[bool] = ContextVar('outbound_origin', default=False)
+
+class AsyncTokenBucket:
+    """Общий для нескольких корутин токен-бакет с паузой (на время RetryAfter от Telegram)."""
+
+    def __init__(self, rate: float, burst: float = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def debit(self):
+        """Списывает токен без ожидания (запрос уже ушёл в обход бакета). Долг не больше burst."""
+        self._refill(time.monotonic())
+        self.tokens = max(-self.burst, self.tokens - 1)
+
+    def refund(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class OutboundItem:
+    __slots__ = ('chat_id', 'factory', 'future', 'priority', 'enqueued', 'attempts')
+
+    def __init__(self, chat_id: int, factory, future, priority: int):
+        self.chat_id = chat_id
+        self.factory = factory      # корутин-фабрика, выполняющая запрос к Bot API
+        self.future = future        # None — никто не ждёт, ошибки только логируются
+        self.priority = priority
+        self.enqueued = time.monotonic()
+        self.attempts = 0
+
+def chat_send_allowed(chat_id: int) -> bool:
+    """Списывает токен из бакета чата, если он есть."""
+    if chat_id > 0:
+        return outbound_chat_limiter.allow(chat_id, OUTBOUND_PRIVATE_BURST, OUTBOUND_PRIVATE_RATE, time.monotonic())
+    return outbound_chat_limiter.allow(chat_id, OUTBOUND_GROUP_BURST, OUTBOUND_GROUP_RATE, time.monotonic())
+
+def log_send_error(chat_id: int, e: Exception):
+    if isinstance(e, TelegramForbiddenError):
+        logging.warning(f"Bot blocked by user {chat_id}")
+    elif isinstance(e, TelegramBadRequest):
+        logging.warning(f"Bad request for chat {chat_id}: {e}")
+    elif isinstance(e, TelegramAPIError):
+        logging.warning(f"Telegram API error for chat {chat_id}: {e}")
+    else:
+        logging.warning(f"Failed to send message to {chat_id}: {e}")
+
+class OutboundQueue:
+    """
+    Очередь по приоритетам. Диспетчер берёт токен общего бакета, затем первое сообщение
+    самого высокого приоритета, у чата которого есть токен; порядок внутри чата и приоритета сохраняется.
+    На RetryAfter весь бакет встаёт на паузу, а сообщение возвращается в начало своей очереди.
+    """
+
+    def __init__(self):
+        self.queues = [deque() for _ in PRIORITY_NAMES]
+        self.size = 0
+        self.wakeup = asyncio.Event()
+        self.bucket = AsyncTokenBucket(OUTBOUND_GLOBAL_RATE, burst=OUTBOUND_GLOBAL_RATE)
+        self.slots = asyncio.Semaphore(OUTBOUND_MAX_IN_FLIGHT)
+        self.metrics = {p: {'sent': 0, 'failed': 0, 'retried': 0, 'latency': 0.0} for p in PRIORITY_NAMES}
+        self.direct = 0       # прямых отправок хендлеров, учтённых в бакетах
+        self.flood_waits = 0  # полученных 429
+
+    def put(self, item: OutboundItem, front: bool = False):
+        if front:
+            self.queues[item.priority].appendleft(item)
+        else:
+            self.queues[item.priority].append(item)
+        self.size += 1
+        self.wakeup.set()
+
+    def _pick(self) -> Optional[OutboundItem]:
+        for q in self.queues:
+            blocked = set()
+            for i in range(min(len(q), OUTBOUND_SCAN_LIMIT)):
+                item = q[i]
+                if item.chat_id in blocked:
+                    continue
+                if chat_send_allowed(item.chat_id):
+                    del q[i]
+                    self.size -= 1
+                    return item
+                blocked.add(item.chat_id)  # более поздние сообщения этого чата не обгоняют раннее
+        return None
+
+    def flood_wait(self, seconds: float):
+        self.flood_waits += 1
+        self.bucket.pause(seconds)
+
+    async def run(self):
+        while True:
+            if not self.size:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            await self.bucket.acquire()
+            item = self._pick()
+            if item is None:
+                # Все чаты с сообщениями упёрлись в свой лимит
+                self.bucket.refund()
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=0.05)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.slots.acquire()
+            asyncio.create_task(self._deliver(item))
+
+    async def _deliver(self, item: OutboundItem):
+        outbound_origin.set(True)
+        stats = self.metrics[item.priority]
         try:
-            await bot.send_message(user_id, text, **kwargs)
-        except Exception as ex:
-            logging.warning(f"Still failed after retry: {ex}")
-    except TelegramAPIError as e:
-        logging.warning(f"Telegram API error for user {user_id}: {e}")
-    except Exception as e:
-        logging.warning(f"Failed to send message to {user_id}: {e}")
+            result = await item.factory()
+        except TelegramRetryAfter as e:
+            self.flood_wait(e.retry_after)
+            item.attempts += 1
+            if item.attempts < OUTBOUND_MAX_ATTEMPTS:
+                stats['retried'] += 1
+                logging.warning(f"Flood limit exceeded. Retry after {e.retry_after} seconds")
+                self.put(item, front=True)
+                return
+            self._fail(item, e)
+        except Exception as e:
+            self._fail(item, e)
+        else:
+            stats['sent'] += 1
+            stats['latency'] += time.monotonic() - item.enqueued
+            if item.future is not None and not item.future.done():
+                item.future.set_result(result)
+        finally:
+            self.slots.release()
+
+    def _fail(self, item: OutboundItem, e: Exception):
+        self.metrics[item.priority]['failed'] += 1
+        if item.future is not None:
+            if not item.future.done():
+                item.future.set_exception(e)
+        else:
+            log_send_error(item.chat_id, e)
+
+    def format_metrics(self) -> str:
+        lines = [f"📤 Очередь отправки: {self.size} в ожидании, 429 получено: {self.flood_waits}, прямых: {self.direct}"]
+        for p, name in PRIORITY_NAMES.items():
+            m = self.metrics[p]
+            avg = m['latency'] / m['sent'] if m['sent'] else 0.0
+            lines.append(f"  • {name}: {m['sent']} отпр., {m['failed']} ошибок, {m['retried']} повторов, ~{avg:.2f} с")
+        return "\n".join(lines)
+
+outbound_chat_limiter = TokenBucketLimiter()
+outbound_queue = OutboundQueue()
+
+async def queue_send(chat_id: int, factory, priority: int = PRIORITY_NOTIFY, wait: bool = False):
+    """
+    Ставит запрос к Bot API в очередь. С wait=True дожидается доставки и возвращает
+    результат запроса (ошибки пробрасываются), иначе ошибки только логируются.
+    """
+    future = asyncio.get_running_loop().create_future() if wait else None
+    outbound_queue.put(OutboundItem(chat_id, factory, future, priority))
+    if future is not None:
+        return await future
+
+class OutboundAccountingMiddleware(BaseRequestMiddleware):
+    """Учитывает прямые отправки в бакетах очереди и ставит общую паузу на 429 от любого запроса."""
+
+    async def __call__(self, make_request, bot, method):
+        if not outbound_origin.get():
+            chat_id = getattr(method, 'chat_id', None)
+            if isinstance(chat_id, int) and type(method).__name__.startswith('Send'):
+                outbound_queue.direct += 1
+                outbound_queue.bucket.debit()
+                chat_send_allowed(chat_id)
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            outbound_queue.flood_wait(e.retry_after)
+            raise
+
+bot.session.middleware(OutboundAccountingMiddleware())
+
+# ==================== БЕЗОПАСНАЯ ОТПРАВКА ====================
+async def safe_send_message(user_id: int, text: str, priority: int = PRIORITY_NOTIFY, **kwargs):
+    await queue_send(user_id, lambda: bot.send_message(user_id, text, **kwargs), priority)
 
 def safe_send_message_task(user_id: int, text: str, **kwargs):
     asyncio.create_task(safe_send_message(user_id, text, **kwargs))
 
-async def safe_send_chat(chat_id: int, text: str, **kwargs):
-    try:
-        await bot.send_message(chat_id, text, **kwargs)
-    except Exception as e:
-        logging.error(f"Failed to send to chat {chat_id}: {e}")
+async def safe_send_chat(chat_id: int, text: str, priority: int = PRIORITY_GAME, **kwargs):
+    await queue_send(chat_id, lambda: bot.send_message(chat_id, text, **kwargs), priority)
 
 # ==================== АВТОУДАЛЕНИЕ ====================
 async def can_delete_message(chat_id: int, message: Message) -> bool:
@@ -915,7 +1446,7 @@ async def delete_after(message: Message, seconds: int):
 
 async def auto_delete_reply(message: Message, text: str, delete_seconds: int = None, **kwargs):
     if delete_seconds is None:
-        delete_seconds = int(await get_setting("auto_delete_commands_seconds"))
+        delete_seconds = settings_snapshot.auto_delete_commands_seconds
     sent = await message.reply(text, **kwargs)
     if message.chat.type != 'private':
         confirmed = await get_confirmed_chats()
@@ -928,7 +1459,7 @@ async def auto_delete_message(message: Message, delete_seconds: int = None):
     if message.chat.type == 'private':
         return
     if delete_seconds is None:
-        delete_seconds = int(await get_setting("auto_delete_commands_seconds"))
+        delete_seconds = settings_snapshot.auto_delete_commands_seconds
     confirmed = await get_confirmed_chats()
     chat_data = confirmed.get(message.chat.id)
     if chat_data and not chat_data.get('auto_delete_enabled', True):
@@ -941,13 +1472,12 @@ async def auto_delete_command(message: Message, text: str = None, **kwargs):
     except:
         pass
     if text:
-        delete_seconds = int(await get_setting("auto_delete_commands_seconds"))
+        delete_seconds = settings_snapshot.auto_delete_commands_seconds
         sent = await message.answer(text, **kwargs)
         asyncio.create_task(delete_after(sent, delete_seconds))
 
 # ==================== ПОДКЛЮЧЕНИЕ К БД ====================
-async def create_db_pool(retries: int = 10, delay: int = 5) -> bool:
-    global db_pool
+def get_database_dsn() -> str:
     database_url = DATABASE_URL
     # Добавляем sslmode=require если его нет
     if "sslmode" not in database_url:
@@ -955,6 +1485,11 @@ async def create_db_pool(retries: int = 10, delay: int = 5) -> bool:
             database_url += "&sslmode=require"
         else:
             database_url += "?sslmode=require"
+    return database_url
+
+async def create_db_pool(retries: int = 10, delay: int = 5) -> bool:
+    global db_pool
+    database_url = get_database_dsn()
     for attempt in range(1, retries + 1):
         try:
             logging.info(f"Попытка подключения к БД {attempt}/{retries}...")
@@ -1159,6 +1694,7 @@ async def init_db():
         await add_column_if_not_exists(conn, 'users', 'defense', 'INTEGER DEFAULT 1')
         await add_column_if_not_exists(conn, 'users', 'authority_balance', 'INTEGER DEFAULT 0')
         await add_column_if_not_exists(conn, 'users', 'global_authority', 'INTEGER DEFAULT 0')  # возможно дубль, но оставим
+        await add_column_if_not_exists(conn, 'users', 'bot_blocked', 'BOOLEAN DEFAULT FALSE')
 
         # Проверяем, существует ли ограничение на username
         constraint_exists = await conn.fetchval("""
@@ -1529,6 +2065,59 @@ async def init_db():
                 updated_at TIMESTAMP DEFAULT NOW()
             )
         ''')
+        # Журнал изменений баланса (только добавление записей)
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS balance_ledger (
+                id BIGSERIAL PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                source TEXT NOT NULL,
+                stake NUMERIC(12,2) DEFAULT 0,
+                payout NUMERIC(12,2) DEFAULT 0,
+                delta NUMERIC(12,2) NOT NULL,
+                balance_after NUMERIC(12,2) NOT NULL,
+                created_at TIMESTAMP DEFAULT NOW()
+            )
+        ''')
+        # Участники чатов (кто писал в группе) — для топов чата
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS chat_members (
+                chat_id BIGINT NOT NULL,
+                user_id BIGINT NOT NULL,
+                last_seen TIMESTAMP DEFAULT NOW(),
+                PRIMARY KEY (chat_id, user_id)
+            )
+        ''')
+        # Рассылки: задание и его прогресс (курсор по user_id), чтобы рассылка переживала перезапуск
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id SERIAL PRIMARY KEY,
+                created_by BIGINT NOT NULL,
+                content TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'running',
+                total INTEGER NOT NULL DEFAULT 0,
+                status_chat_id BIGINT,
+                status_message_id BIGINT,
+                created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                finished_at TIMESTAMP
+            )
+        ''')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_progress (
+                job_id INTEGER PRIMARY KEY REFERENCES broadcast_jobs(id) ON DELETE CASCADE,
+                cursor_user_id BIGINT NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                blocked INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+        ''')
+        # Живые воркеры бота (для распределения фоновых задач)
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS bot_workers (
+                worker_id TEXT PRIMARY KEY,
+                heartbeat_at TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+        ''')
         # Ключи для сброса статистики
         await conn.execute('''
             CREATE TABLE IF NOT EXISTS reset_keys (
@@ -1554,6 +2143,14 @@ async def init_db():
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_requests_status ON chat_confirmation_requests(status)")
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_global_cooldowns_user ON global_cooldowns(user_id)")
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_global_cooldowns_last_used ON global_cooldowns(last_used)")
+        await add_column_if_not_exists(conn, 'global_cooldowns', 'expires_at', 'TIMESTAMP')
+        await add_column_if_not_exists(conn, 'giveaways', 'participants_count', 'INTEGER DEFAULT 0')
+        # Сверяем счётчик участников активных розыгрышей (строки, созданные до появления колонки)
+        await conn.execute("""
+            UPDATE giveaways g SET participants_count = (SELECT COUNT(*) FROM participants p WHERE p.giveaway_id = g.id)
+            WHERE g.status = 'active'
+        """)
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_participants_giveaway ON participants(giveaway_id, user_id)")
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_bitcoin_orders_user ON bitcoin_orders(user_id)")
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_bitcoin_orders_status ON bitcoin_orders(status)")
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_bitcoin_orders_type ON bitcoin_orders(type)")
@@ -1576,12 +2173,18 @@ async def init_db():
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_reputation ON users(reputation DESC)")
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_bitcoin_balance ON users(bitcoin_balance DESC)")
         await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_level_desc ON users(level DESC)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_balance_ledger_user ON balance_ledger(user_id, created_at)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_members_user ON chat_members(user_id)")
+        # Покрывающий индекс для топов чата: join по user_id без чтения строк users
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_chat_top ON users(user_id) INCLUDE (balance, reputation, first_name)")
         await migrate_date_columns(conn)
 
     await init_settings()
+    await refresh_settings_snapshot()
     await init_level_rewards()
     await init_business_types()
     await init_media_keys()
+    await init_db_functions()
     logging.info("✅ Таблицы в PostgreSQL проверены/обновлены")
 
 @db_retry()
@@ -1596,7 +2199,7 @@ async def init_settings():
 @db_retry()
 async def init_level_rewards():
     async with db_pool.acquire() as conn:
-        for lvl in range(1, 101):
+        for lvl in range(1, MAX_LEVEL + 1):
             exists = await conn.fetchval("SELECT level FROM level_rewards WHERE level=$1", lvl)
             if not exists:
                 coins = int(DEFAULT_SETTINGS["level_reward_coins"]) + (lvl-1) * int(DEFAULT_SETTINGS["level_reward_coins_increment"])
@@ -1638,76 +2241,292 @@ async def init_media_keys():
                 key, "", f"Медиа для {key}"
             )
 
-# ==================== РАБОТА С НАСТРОЙКАМИ ====================
+# Серверная функция расчёта ставки казино: одна транзакция и один запрос на спин,
+# включая повышение уровня. Исход ставки и прирост статов передаёт вызывающий (из снимка настроек),
+# а уровень считается по той же кривой, что и add_exp: вызывающий передаёт массивы LevelCurve
+# (кумулятивные пороги опыта и префиксные суммы наград), цикла и запросов к level_rewards нет.
+# Возвращает старый и новый уровень; текст поздравления строится по кривой в Python.
+SETTLE_BET_SQL = """
+CREATE OR REPLACE FUNCTION settle_bet(
+    p_user_id BIGINT, p_game TEXT, p_stake NUMERIC, p_payout NUMERIC, p_win BOOLEAN, p_exp INTEGER,
+    p_reputation INTEGER, p_thresholds FLOAT8[], p_coins_prefix FLOAT8[], p_rep_prefix INTEGER[],
+    p_str INTEGER, p_agi INTEGER, p_def INTEGER
+) RETURNS TABLE (ok BOOLEAN, new_balance NUMERIC, old_level INTEGER, new_level INTEGER)
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_balance NUMERIC;
+    v_exp NUMERIC;
+    v_level INTEGER;
+    v_old INTEGER;
+    v_total NUMERIC;
+    v_max INTEGER := COALESCE(cardinality(p_thresholds), 0);
+    v_gained INTEGER;
+    v_coins NUMERIC := 0;
+    v_rep INTEGER := 0;
+BEGIN
+    IF p_game NOT IN ('dice', 'guess', 'slots', 'roulette') THEN
+        RAISE EXCEPTION 'settle_bet: invalid game %', p_game;
+    END IF;
+
+    SELECT u.balance, u.exp, u.level INTO v_balance, v_exp, v_level
+    FROM users u WHERE u.user_id = p_user_id FOR UPDATE;
+    IF NOT FOUND OR v_balance < p_stake THEN
+        RETURN QUERY SELECT FALSE, COALESCE(v_balance, 0::NUMERIC), NULL::INTEGER, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    -- Как LevelCurve.advance: уровень = число порогов, не превышающих накопленный опыт
+    v_old := v_level;
+    IF v_level >= 1 AND v_level < v_max THEN
+        v_total := p_thresholds[v_level]::NUMERIC + v_exp + p_exp;
+        SELECT GREATEST(v_level, COUNT(*)::INTEGER) INTO v_level
+        FROM unnest(p_thresholds) AS t(threshold) WHERE t.threshold::NUMERIC <= v_total;
+        v_exp := FLOOR(v_total - p_thresholds[v_level]::NUMERIC);
+    ELSE
+        v_exp := v_exp + p_exp;
+    END IF;
+    v_gained := v_level - v_old;
+    IF v_gained > 0 THEN
+        v_coins := ROUND((p_coins_prefix[v_level + 1] - p_coins_prefix[v_old + 1])::NUMERIC, 2);
+        v_rep := p_rep_prefix[v_level + 1] - p_rep_prefix[v_old + 1];
+    END IF;
+
+    UPDATE users u SET
+        balance = u.balance - p_stake + p_payout + v_coins,
+        exp = v_exp,
+        level = v_level,
+        reputation = u.reputation + p_reputation + v_rep,
+        strength = u.strength + v_gained * p_str,
+        agility = u.agility + v_gained * p_agi,
+        defense = u.defense + v_gained * p_def,
+        dice_wins = u.dice_wins + (p_game = 'dice' AND p_win)::INTEGER,
+        dice_losses = u.dice_losses + (p_game = 'dice' AND NOT p_win)::INTEGER,
+        guess_wins = u.guess_wins + (p_game = 'guess' AND p_win)::INTEGER,
+        guess_losses = u.guess_losses + (p_game = 'guess' AND NOT p_win)::INTEGER,
+        slots_wins = u.slots_wins + (p_game = 'slots' AND p_win)::INTEGER,
+        slots_losses = u.slots_losses + (p_game = 'slots' AND NOT p_win)::INTEGER,
+        roulette_wins = u.roulette_wins + (p_game = 'roulette' AND p_win)::INTEGER,
+        roulette_losses = u.roulette_losses + (p_game = 'roulette' AND NOT p_win)::INTEGER
+    WHERE u.user_id = p_user_id
+    RETURNING u.balance INTO v_balance;
+
+    INSERT INTO balance_ledger (user_id, source, stake, payout, delta, balance_after)
+    VALUES (p_user_id, p_game, p_stake, p_payout, p_payout - p_stake, v_balance);
+
+    RETURN QUERY SELECT TRUE, v_balance, v_old, v_level;
+END;
+$$
+"""
+
 @db_retry()
-async def get_setting(key: str) -> str:
-    global settings_cache, last_settings_update
-    now = time.time()
-    async with settings_cache_lock:
-        # Принудительное обновление каждые 60 секунд или если кеш пуст
-        if now - last_settings_update > 60 or not settings_cache:
-            try:
-                async with db_pool.acquire() as conn:
-                    rows = await conn.fetch("SELECT key, value FROM settings")
-                    settings_cache = {row['key']: row['value'] for row in rows}
-                last_settings_update = now
-            except Exception as e:
-                logging.error(f"Ошибка при обновлении кеша настроек: {e}")
-                # Если не удалось обновить, используем старый кеш (если есть)
-                if not settings_cache:
-                    # Если кеш пуст, пробуем взять из DEFAULT
-                    pass
-        value = settings_cache.get(key)
-        if value is None:
-            value = DEFAULT_SETTINGS.get(key, "")
-            if value:
-                # Асинхронно вставляем в БД, но не ждём
-                asyncio.create_task(_insert_default_setting(key, value))
-                settings_cache[key] = value
-    return value
+async def init_db_functions():
+    async with db_pool.acquire() as conn:
+        # Прежние сигнатуры — иначе останутся перегрузки
+        await conn.execute("DROP FUNCTION IF EXISTS settle_bet(BIGINT, TEXT, NUMERIC, NUMERIC, INTEGER, INTEGER)")
+        await conn.execute(
+            "DROP FUNCTION IF EXISTS settle_bet(BIGINT, TEXT, NUMERIC, NUMERIC, BOOLEAN, INTEGER, INTEGER, NUMERIC, INTEGER, INTEGER, INTEGER)"
+        )
+        await conn.execute(SETTLE_BET_SQL)
+
+# ==================== МЕЖПРОЦЕССНАЯ ИНВАЛИДАЦИЯ КЭШЕЙ (LISTEN/NOTIFY) ====================
+def cache_ttl(fallback: int = CACHE_TTL_WITHOUT_NOTIFY) -> int:
+    """TTL in-process кэшей: долгий, пока слушатель NOTIFY подключён, иначе короткий."""
+    if cache_listener_conn is not None and not cache_listener_conn.is_closed():
+        return CACHE_TTL_WITH_NOTIFY
+    return fallback
+
+def apply_cache_invalidation(scope: str, key: str = ""):
+    """Сбрасывает локальный кэш по области (settings, confirmed_chats, channels, media, admins, bans, heists, level_rewards, orders, leaderboard)."""
+    global last_channels_update, last_confirmed_chats_update
+    if scope == "settings":
+        asyncio.create_task(refresh_settings_snapshot())
+    elif scope == "confirmed_chats":
+        last_confirmed_chats_update = 0
+    elif scope == "channels":
+        last_channels_update = 0
+    elif scope == "media":
+        if key:
+            media_cache.pop(key, None)
+        else:
+            media_cache.clear()
+    elif scope == "admins":
+        asyncio.create_task(refresh_admin_cache_entry(int(key)) if key else load_access_cache())
+    elif scope == "bans":
+        asyncio.create_task(refresh_ban_cache_entry(int(key)) if key else load_access_cache())
+    elif scope == "heists":
+        asyncio.create_task(reload_active_heist(int(key)) if key else load_active_heists())
+    elif scope == "level_rewards":
+        asyncio.create_task(load_level_rewards())
+    elif scope == "orders":
+        apply_order_changes(key)
+    elif scope == "leaderboard":
+        apply_leaderboard_marks(key)
+    else:
+        logging.warning(f"Неизвестная область инвалидации кэша: {scope}")
 
-async def _insert_default_setting(key: str, value: str):
-    """Вставляет настройку по умолчанию в БД (фоново)."""
+async def notify_cache_invalidation(scope: str, key: str = "", conn=None):
+    """
+    Сбрасывает кэш локально и рассылает NOTIFY остальным воркерам.
+    Если передан conn внутри транзакции, уведомление уйдёт только после коммита.
+    """
+    apply_cache_invalidation(scope, key)
+    payload = f"{scope}:{key}"
     try:
-        async with db_pool.acquire() as conn:
-            await conn.execute(
-                "INSERT INTO settings (key, value) VALUES ($1, $2) ON CONFLICT (key) DO NOTHING",
-                key, value
-            )
+        if conn:
+            await conn.execute("SELECT pg_notify($1, $2)", CACHE_INVALIDATION_CHANNEL, payload)
+        else:
+            async with db_pool.acquire() as new_conn:
+                await new_conn.execute("SELECT pg_notify($1, $2)", CACHE_INVALIDATION_CHANNEL, payload)
     except Exception as e:
-        logging.error(f"Не удалось вставить настройку по умолчанию {key}: {e}")
+        logging.error(f"Не удалось отправить NOTIFY {payload}: {e}")
+
+def _on_cache_notification(connection, pid, channel, payload):
+    scope, _, key = payload.partition(":")
+    apply_cache_invalidation(scope, key)
+
+async def cache_invalidation_listener():
+    """
+    Держит отдельное соединение с LISTEN на канале инвалидации.
+    После (пере)подключения сбрасывает все кэши, т.к. уведомления за время разрыва потеряны.
+    """
+    global cache_listener_conn
+    while True:
+        try:
+            cache_listener_conn = await asyncpg.connect(
+                get_database_dsn(), timeout=30, statement_cache_size=0,
+                server_settings={'application_name': 'malboro_bot_listener'}
+            )
+            await cache_listener_conn.add_listener(CACHE_INVALIDATION_CHANNEL, _on_cache_notification)
+            for scope in ("settings", "confirmed_chats", "channels", "media", "admins", "bans", "heists", "level_rewards", "orders", "leaderboard"):
+                apply_cache_invalidation(scope)
+            logging.info("✅ Слушатель инвалидации кэшей подключён")
+            while not cache_listener_conn.is_closed():
+                await asyncio.sleep(30)
+                await cache_listener_conn.execute("SELECT 1")
+        except Exception as e:
+            logging.error(f"Слушатель инвалидации кэшей отключился: {e}")
+        finally:
+            if cache_listener_conn is not None and not cache_listener_conn.is_closed():
+                await cache_listener_conn.close()
+            cache_listener_conn = None
+        await asyncio.sleep(10)
+
+# ==================== РАБОТА С НАСТРОЙКАМИ ====================
+class SettingsSnapshot:
+    """
+    Неизменяемый снимок настроек. Значения разбираются в int/float один раз при создании,
+    поэтому чтение не требует ни блокировок, ни await. При обновлении создаётся новый снимок
+    и глобальная ссылка settings_snapshot подменяется целиком (атомарно для asyncio).
+    Каждый ключ доступен как типизированный атрибут: settings_snapshot.casino_min_bet -> float,
+    settings_snapshot.heist_join_minutes -> int (тип задаёт FLOAT_SETTINGS и значение по умолчанию).
+    """
+    __slots__ = ('_raw', '_int', '_float', '_typed', 'loaded_at')
+
+    def __init__(self, raw: Dict[str, str], loaded_at: float = 0.0):
+        merged = dict(DEFAULT_SETTINGS)
+        merged.update({k: v for k, v in raw.items() if v is not None})
+        ints, floats = {}, {}
+        for key, value in merged.items():
+            try:
+                floats[key] = float(value)
+            except (ValueError, TypeError):
+                continue
+            try:
+                ints[key] = int(value)
+            except ValueError:
+                pass
+        object.__setattr__(self, '_raw', merged)
+        object.__setattr__(self, '_int', ints)
+        object.__setattr__(self, '_float', floats)
+        object.__setattr__(self, '_typed', {})
+        for key in merged:
+            kind = _setting_type(key)
+            self._typed[key] = merged[key] if kind is str else (self.get_float(key) if kind is float else self.get_int(key))
+        object.__setattr__(self, 'loaded_at', loaded_at)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("SettingsSnapshot is immutable")
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._typed[name]
+        except KeyError:
+            raise AttributeError(f"Нет настройки {name}") from None
+
+    def get(self, key: str) -> str:
+        return self._raw.get(key, "")
+
+    def get_int(self, key: str) -> int:
+        value = self._int.get(key)
+        if value is None:
+            logging.warning(f"Не удалось преобразовать настройку {key}='{self.get(key)}' в int")
+            return int(DEFAULT_SETTINGS.get(key, 0))
+        return value
+
+    def get_float(self, key: str) -> float:
+        value = self._float.get(key)
+        if value is None:
+            logging.warning(f"Не удалось преобразовать настройку {key}='{self.get(key)}' в float")
+            return float(DEFAULT_SETTINGS.get(key, 0))
+        return value
+
+    def replace(self, key: str, value: str) -> 'SettingsSnapshot':
+        """Новый снимок с изменённым значением одного ключа."""
+        raw = dict(self._raw)
+        raw[key] = value
+        return SettingsSnapshot(raw, self.loaded_at)
+
+# До первой загрузки из БД действуют значения по умолчанию
+settings_snapshot = SettingsSnapshot({})
+
+@db_retry()
+async def refresh_settings_snapshot():
+    """Перечитывает таблицу settings и подменяет снимок."""
+    global settings_snapshot
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch("SELECT key, value FROM settings")
+    settings_snapshot = SettingsSnapshot({row['key']: row['value'] for row in rows}, time.time())
+
+async def settings_refresher():
+    """
+    Фоновое обновление снимка настроек (подстраховка к set_setting и NOTIFY).
+    Пока слушатель NOTIFY подключён, таблица перечитывается лишь раз в CACHE_TTL_WITH_NOTIFY.
+    """
+    while True:
+        await asyncio.sleep(SETTINGS_REFRESH_INTERVAL)
+        if time.time() - settings_snapshot.loaded_at < cache_ttl(SETTINGS_REFRESH_INTERVAL):
+            continue
+        try:
+            await refresh_settings_snapshot()
+        except Exception as e:
+            logging.error(f"Ошибка при обновлении снимка настроек: {e}")
+
+# Устаревшие асинхронные обёртки: новый код читает settings_snapshot.<ключ> без await
+async def get_setting(key: str) -> str:
+    return settings_snapshot.get(key)
 
 async def get_setting_float(key: str) -> float:
-    val = await get_setting(key)
-    try:
-        return float(val)
-    except (ValueError, TypeError) as e:
-        logging.warning(f"Не удалось преобразовать настройку {key}='{val}' в float: {e}")
-        return float(DEFAULT_SETTINGS.get(key, 0))
+    return settings_snapshot.get_float(key)
 
 async def get_setting_int(key: str) -> int:
-    val = await get_setting(key)
-    try:
-        return int(val)
-    except (ValueError, TypeError) as e:
-        logging.warning(f"Не удалось преобразовать настройку {key}='{val}' в int: {e}")
-        return int(DEFAULT_SETTINGS.get(key, 0))
+    return settings_snapshot.get_int(key)
 
 @db_retry()
 async def set_setting(key: str, value: str):
+    global settings_snapshot
     async with db_pool.acquire() as conn:
         await conn.execute("UPDATE settings SET value=$1 WHERE key=$2", value, key)
-    async with settings_cache_lock:
-        settings_cache[key] = value
-        global last_settings_update
-        last_settings_update = 0  # сброс, чтобы при следующем get обновилось
+        settings_snapshot = settings_snapshot.replace(key, value)
+        await conn.execute("SELECT pg_notify($1, $2)", CACHE_INVALIDATION_CHANNEL, f"settings:{key}")
 
 # ==================== ФУНКЦИИ ДЛЯ ЧАТОВ И КАНАЛОВ ====================
 @db_retry()
 async def get_channels():
     global channels_cache, last_channels_update
     now = time.time()
-    if now - last_channels_update > 300 or not channels_cache:
+    if now - last_channels_update > cache_ttl() or not channels_cache:
         async with db_pool.acquire() as conn:
             rows = await conn.fetch("SELECT chat_id, title, invite_link FROM channels")
             channels_cache = [(r['chat_id'], r['title'], r['invite_link']) for r in rows]
@@ -1718,7 +2537,7 @@ async def get_channels():
 async def get_confirmed_chats(force_update=False) -> Dict[int, dict]:
     global confirmed_chats_cache, last_confirmed_chats_update
     now = time.time()
-    if force_update or now - last_confirmed_chats_update > 300 or not confirmed_chats_cache:
+    if force_update or now - last_confirmed_chats_update > cache_ttl() or not confirmed_chats_cache:
         async with db_pool.acquire() as conn:
             rows = await conn.fetch("SELECT * FROM confirmed_chats")
             confirmed_chats_cache = {row['chat_id']: dict(row) for row in rows}
@@ -1738,9 +2557,11 @@ async def add_confirmed_chat(chat_id: int, title: str, chat_type: str, confirmed
         )
     if conn:
         await _add(conn)
+        await notify_cache_invalidation("confirmed_chats", conn=conn)
     else:
         async with db_pool.acquire() as new_conn:
             await _add(new_conn)
+            await notify_cache_invalidation("confirmed_chats", conn=new_conn)
     await get_confirmed_chats(force_update=True)
 
 @db_retry()
@@ -1749,9 +2570,11 @@ async def remove_confirmed_chat(chat_id: int, conn=None):
         await conn.execute("DELETE FROM confirmed_chats WHERE chat_id=$1", chat_id)
     if conn:
         await _remove(conn)
+        await notify_cache_invalidation("confirmed_chats", conn=conn)
     else:
         async with db_pool.acquire() as new_conn:
             await _remove(new_conn)
+            await notify_cache_invalidation("confirmed_chats", conn=new_conn)
     await get_confirmed_chats(force_update=True)
 
 @db_retry()
@@ -1779,18 +2602,36 @@ async def update_chat_request_status(chat_id: int, status: str, conn=None):
             await _update(new_conn)
 
 # ==================== ПРОВЕРКА ПОДПИСКИ ====================
-async def check_subscription(user_id: int):
+def cache_subscription(chat_id, user_id: int, subscribed: bool):
+    ttl = SUBSCRIPTION_POSITIVE_TTL if subscribed else SUBSCRIPTION_NEGATIVE_TTL
+    now = time.time()
+    if len(subscription_cache) >= SUBSCRIPTION_CACHE_MAX:
+        for cache_key in [k for k, (_, expires) in subscription_cache.items() if expires <= now]:
+            del subscription_cache[cache_key]
+        if len(subscription_cache) >= SUBSCRIPTION_CACHE_MAX:
+            subscription_cache.clear()
+    subscription_cache[(str(chat_id), user_id)] = (subscribed, now + ttl)
+
+async def is_channel_member(chat_id, user_id: int, force: bool = False) -> bool:
+    """Подписан ли пользователь на канал; результат кэшируется с разными TTL для да/нет."""
+    if not force:
+        cached = subscription_cache.get((str(chat_id), user_id))
+        if cached and cached[1] > time.time():
+            return cached[0]
+    try:
+        member = await bot.get_chat_member(chat_id=chat_id, user_id=user_id)
+        subscribed = member.status not in ['left', 'kicked']
+    except Exception:
+        subscribed = False
+    cache_subscription(chat_id, user_id, subscribed)
+    return subscribed
+
+async def check_subscription(user_id: int, force: bool = False):
     channels = await get_channels()
     if not channels:
         return True, []
-    not_subscribed = []
-    for chat_id, title, link in channels:
-        try:
-            member = await bot.get_chat_member(chat_id=chat_id, user_id=user_id)
-            if member.status in ['left', 'kicked']:
-                not_subscribed.append((title, link))
-        except Exception:
-            not_subscribed.append((title, link))
+    results = await asyncio.gather(*(is_channel_member(chat_id, user_id, force) for chat_id, _, _ in channels))
+    not_subscribed = [(title, link) for (_, title, link), ok in zip(channels, results) if not ok]
     return len(not_subscribed) == 0, not_subscribed
 
 # ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
@@ -1823,10 +2664,12 @@ async def notify_chats(message_text: str):
     for chat_id, data in confirmed.items():
         if not data.get('notify_enabled', True):
             continue
-        await safe_send_chat(chat_id, message_text)
+        await safe_send_chat(chat_id, message_text, priority=PRIORITY_NOTIFY)
 
 @db_retry()
 async def is_banned(user_id: int) -> bool:
+    if access_cache_loaded:
+        return user_id in banned_user_ids
     async with db_pool.acquire() as conn:
         row = await conn.fetchval("SELECT user_id FROM banned_users WHERE user_id=$1", user_id)
     return row is not None
@@ -1854,6 +2697,9 @@ async def find_user_by_input(input_str: str) -> Optional[Dict]:
             return dict(row) if row else None
 
 async def get_media_file_id(key: str) -> Optional[str]:
+    cached_local = media_cache.get(key)
+    if cached_local and time.time() - cached_local[1] < cache_ttl():
+        return cached_local[0]
     if redis_client:
         cached = await redis_get(f"media:{key}")
         if cached:
@@ -1862,6 +2708,8 @@ async def get_media_file_id(key: str) -> Optional[str]:
         file_id = await conn.fetchval("SELECT file_id FROM media WHERE key=$1", key)
         if file_id and redis_client:
             await redis_set(f"media:{key}", file_id, 3600)
+        if file_id:
+            media_cache[key] = (file_id, time.time())
         return file_id
 
 @db_retry()
@@ -1871,19 +2719,31 @@ async def set_media_file_id(key: str, file_id: str, description: str = ""):
             "INSERT INTO media (key, file_id, description) VALUES ($1, $2, $3) ON CONFLICT (key) DO UPDATE SET file_id=$2, description=$3, updated_at=NOW()",
             key, file_id, description
         )
+        await notify_cache_invalidation("media", key, conn=conn)
     if redis_client:
         await redis_set(f"media:{key}", file_id, 3600)
 
-async def send_with_media(chat_id: int, text: str, media_key: str = None, **kwargs):
-    if media_key:
-        file_id = await get_media_file_id(media_key)
+async def send_with_media(chat_id: int, text: str, media_key: str = None, priority: int = PRIORITY_INTERACTIVE, **kwargs):
+    """Фото с подписью (или текст, если фото нет). Интерактивные ответы ждут доставки, остальные только ставятся в очередь."""
+    file_id = await get_media_file_id(media_key) if media_key else None
+
+    async def send():
         if file_id:
             try:
-                await bot.send_photo(chat_id, file_id, caption=text, **kwargs)
-                return
+                return await bot.send_photo(chat_id, file_id, caption=text, **kwargs)
+            except TelegramRetryAfter:
+                raise
             except Exception as e:
                 logging.error(f"Ошибка отправки фото с ключом {media_key}: {e}")
-    await safe_send_message(chat_id, text, **kwargs)
+        return await bot.send_message(chat_id, text, **kwargs)
+
+    if priority != PRIORITY_INTERACTIVE:
+        await queue_send(chat_id, send, priority)
+        return
+    try:
+        await queue_send(chat_id, send, priority, wait=True)
+    except Exception as e:
+        log_send_error(chat_id, e)
 
 @db_retry()
 async def save_last_bet(user_id: int, game: str, amount: float, bet_data: dict = None):
@@ -1897,24 +2757,111 @@ async def save_last_bet(user_id: int, game: str, amount: float, bet_data: dict =
                 updated_at = NOW()
         """, user_id, game, amount, json.dumps(bet_data) if bet_data else None)
 
+# ==================== КОНТЕКСТ ПОЛЬЗОВАТЕЛЯ ТЕКУЩЕГО АПДЕЙТА ====================
+class UserContext:
+    """
+    Строка users автора апдейта, загруженная один раз UserContextLoaderMiddleware.
+    Действует только пока апдейт обрабатывается и пока по этому пользователю не было записи
+    (функции, меняющие users, вызывают invalidate_user_context).
+    """
+    __slots__ = ('user_id', 'row', 'active', 'dirty')
+
+    def __init__(self, user_id: int, row: Optional[dict]):
+        self.user_id = user_id
+        self.row = row
+        self.active = True
+        self.dirty = False
+
+    @property
+    def is_banned(self) -> bool:
+        return self.user_id in banned_user_ids
+
+    @property
+    def is_admin(self) -> bool:
+        return self.user_id in SUPER_ADMINS or self.user_id in admin_permissions_cache
+
+current_user_ctx: ContextVar[Optional[UserContext]] = ContextVar('current_user_ctx', default=None)
+
+def get_context_user_row(user_id: int) -> Optional[dict]:
+    """Актуальная строка users из контекста апдейта или None, если нужно идти в БД."""
+    ctx = current_user_ctx.get()
+    if ctx is None or ctx.user_id != user_id or not ctx.active or ctx.dirty or ctx.row is None:
+        return None
+    return ctx.row
+
+def invalidate_user_context(user_id: Optional[int] = None):
+    """Помечает контекст устаревшим (для конкретного пользователя или безусловно)."""
+    ctx = current_user_ctx.get()
+    if ctx is not None and (user_id is None or ctx.user_id == user_id):
+        ctx.dirty = True
+
 # ==================== ФУНКЦИИ ДЛЯ ПОЛЬЗОВАТЕЛЕЙ ====================
+def remember_known_user(user_id: int, username: Optional[str], first_name: Optional[str]):
+    known_users[user_id] = (username, first_name)
+    known_users.move_to_end(user_id)
+    if len(known_users) > KNOWN_USERS_MAX:
+        known_users.popitem(last=False)
+
+def _names_match(known: Tuple[Optional[str], Optional[str]], username: Optional[str], first_name: Optional[str]) -> bool:
+    # None означает «нет сведений», а не «имя удалено» — такие поля не сравниваем
+    return (username is None or username == known[0]) and (first_name is None or first_name == known[1])
+
 @db_retry()
 async def ensure_user_exists(user_id: int, username: str = None, first_name: str = None):
+    """
+    Создаёт пользователя, если его нет, и обновляет username/first_name, если они изменились.
+    Известные пользователи с неизменными именами не требуют обращения к БД.
+    Возвращает (создан ли, начисленный бонус).
+    """
+    known = known_users.get(user_id)
+    if known is not None and _names_match(known, username, first_name):
+        known_users.move_to_end(user_id)
+        return False, 0
+    row = get_context_user_row(user_id)
+    if row is not None and _names_match((row['username'], row['first_name']), username, first_name):
+        remember_known_user(user_id, row['username'], row['first_name'])
+        return False, 0
+
+    invalidate_user_context(user_id)
+
+    touch_leaderboards(user_id)
+    bonus = settings_snapshot.new_user_bonus
     async with db_pool.acquire() as conn:
-        exists = await conn.fetchval("SELECT 1 FROM users WHERE user_id=$1", user_id)
-        if not exists:
-            bonus = await get_setting_float("new_user_bonus")
-            await conn.execute(
+        async def _upsert():
+            # Без изменений имён UPDATE не выполняется (WHERE), и RETURNING не возвращает строк
+            return await conn.fetchrow(
                 "INSERT INTO users (user_id, username, first_name, joined_date, balance, reputation, total_spent, negative_balance, exp, level, bitcoin_balance, authority_balance, skill_share, skill_luck, skill_betray) "
-                "VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15)",
-                user_id, username, first_name, datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
-                bonus, 0, 0, 0, 0, 1, 0.0, 0, 0, 0, 0
+                "VALUES ($1, $2, $3, $4, $5, 0, 0, 0, 0, 1, 0.0, 0, 0, 0, 0) "
+                "ON CONFLICT (user_id) DO UPDATE SET "
+                "username = COALESCE(EXCLUDED.username, users.username), "
+                "first_name = COALESCE(EXCLUDED.first_name, users.first_name) "
+                "WHERE users.username IS DISTINCT FROM COALESCE(EXCLUDED.username, users.username) "
+                "OR users.first_name IS DISTINCT FROM COALESCE(EXCLUDED.first_name, users.first_name) "
+                "RETURNING (xmax = 0) AS created, username, first_name",
+                user_id, username, first_name, datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"), bonus
             )
-            return True, bonus
+        try:
+            row = await _upsert()
+        except asyncpg.UniqueViolationError:
+            # username уникален: освобождаем его у устаревшей записи (пользователь сменил ник)
+            await conn.execute("UPDATE users SET username=NULL WHERE username=$1 AND user_id<>$2", username, user_id)
+            row = await _upsert()
+    if row is None:
+        if known is not None:
+            remember_known_user(user_id, username or known[0], first_name or known[1])
+        else:
+            remember_known_user(user_id, username, first_name)
+        return False, 0
+    remember_known_user(user_id, row['username'], row['first_name'])
+    if row['created']:
+        return True, bonus
     return False, 0
 
 @db_retry()
 async def get_user_balance(user_id: int) -> float:
+    row = get_context_user_row(user_id)
+    if row is not None:
+        return float(row['balance'])
     async with db_pool.acquire() as conn:
         balance = await conn.fetchval("SELECT balance FROM users WHERE user_id=$1", user_id)
         return float(balance) if balance is not None else 0.0
@@ -1922,6 +2869,8 @@ async def get_user_balance(user_id: int) -> float:
 @db_retry()
 async def update_user_balance(user_id: int, delta: float, conn=None, allow_negative: bool = False) -> Tuple[bool, float, float]:
     delta = round(float(delta), 2)
+    invalidate_user_context(user_id)
+    touch_leaderboards(user_id)
     async def _update(conn):
         row = await conn.fetchrow("SELECT balance, negative_balance FROM users WHERE user_id=$1 FOR UPDATE", user_id)
         if not row:
@@ -1969,13 +2918,17 @@ async def get_user_bitcoin(user_id: int, conn=None) -> float:
 
     if conn:
         return await _get(conn)
-    else:
-        async with db_pool.acquire() as new_conn:
-            return await _get(new_conn)
+    row = get_context_user_row(user_id)
+    if row is not None:
+        return float(row['bitcoin_balance'])
+    async with db_pool.acquire() as new_conn:
+        return await _get(new_conn)
 
 @db_retry()
 async def update_user_bitcoin(user_id: int, delta: float, conn=None) -> Tuple[bool, float]:
     delta = round(float(delta), 4)
+    invalidate_user_context(user_id)
+    touch_leaderboards(user_id)
     async def _update(conn):
         row = await conn.fetchrow("""
             UPDATE users SET bitcoin_balance = bitcoin_balance + $1
@@ -1995,12 +2948,17 @@ async def update_user_bitcoin(user_id: int, delta: float, conn=None) -> Tuple[bo
 
 @db_retry()
 async def get_user_authority(user_id: int) -> int:
+    row = get_context_user_row(user_id)
+    if row is not None:
+        return row['authority_balance'] or 0
     async with db_pool.acquire() as conn:
         auth = await conn.fetchval("SELECT authority_balance FROM users WHERE user_id=$1", user_id)
         return auth if auth is not None else 0
 
 @db_retry()
 async def update_user_authority(user_id: int, delta: int, conn=None) -> int:
+    invalidate_user_context(user_id)
+    touch_leaderboards(user_id)
     async def _update(conn):
         row = await conn.fetchrow("""
             UPDATE users SET authority_balance = authority_balance + $1
@@ -2017,12 +2975,17 @@ async def update_user_authority(user_id: int, delta: int, conn=None) -> int:
 
 @db_retry()
 async def get_user_reputation(user_id: int) -> int:
+    row = get_context_user_row(user_id)
+    if row is not None:
+        return row['reputation'] or 0
     async with db_pool.acquire() as conn:
         rep = await conn.fetchval("SELECT reputation FROM users WHERE user_id=$1", user_id)
         return rep if rep is not None else 0
 
 @db_retry()
 async def update_user_reputation(user_id: int, delta: int, conn=None):
+    invalidate_user_context(user_id)
+    touch_leaderboards(user_id)
     async def _update(conn):
         await conn.execute("UPDATE users SET reputation = reputation + $1 WHERE user_id=$2", delta, user_id)
     if conn:
@@ -2033,6 +2996,9 @@ async def update_user_reputation(user_id: int, delta: int, conn=None):
 
 @db_retry()
 async def get_user_skills(user_id: int) -> dict:
+    row = get_context_user_row(user_id)
+    if row is not None:
+        return {k: row[k] for k in ('skill_share', 'skill_luck', 'skill_betray')}
     async with db_pool.acquire() as conn:
         row = await conn.fetchrow(
             "SELECT skill_share, skill_luck, skill_betray FROM users WHERE user_id=$1",
@@ -2047,6 +3013,8 @@ async def update_user_skill(user_id: int, skill: str, delta: int = 1, conn=None)
     allowed = ['skill_share', 'skill_luck', 'skill_betray']
     if skill not in allowed:
         raise ValueError("Invalid skill")
+    invalidate_user_context(user_id)
+    touch_leaderboards(user_id)
     async def _update(conn):
         await conn.execute(f"UPDATE users SET {skill} = {skill} + $1 WHERE user_id=$2", delta, user_id)
     if conn:
@@ -2057,6 +3025,9 @@ async def update_user_skill(user_id: int, skill: str, delta: int = 1, conn=None)
 
 @db_retry()
 async def get_user_stats(user_id: int) -> dict:
+    row = get_context_user_row(user_id)
+    if row is not None:
+        return {k: row[k] for k in ('level', 'exp', 'strength', 'agility', 'defense')}
     async with db_pool.acquire() as conn:
         row = await conn.fetchrow("SELECT level, exp, strength, agility, defense FROM users WHERE user_id=$1", user_id)
         if row:
@@ -2065,6 +3036,8 @@ async def get_user_stats(user_id: int) -> dict:
 
 @db_retry()
 async def update_user_game_stats(user_id: int, game: str, win: bool, conn=None):
+    invalidate_user_context(user_id)
+    touch_leaderboards(user_id)
     async def _update(conn):
         if win:
             if game == 'dice':
@@ -2090,6 +3063,74 @@ async def update_user_game_stats(user_id: int, game: str, win: bool, conn=None):
         async with db_pool.acquire() as new_conn:
             await _update(new_conn)
 
+# ==================== КРИВАЯ УРОВНЕЙ И НАГРАДЫ ====================
+class LevelCurve:
+    """
+    Кумулятивная кривая опыта и префиксные суммы наград за уровни.
+    Переход с уровня L на L+1 стоит L * level_multiplier, поэтому до уровня L нужно
+    mult * (L-1) * L / 2 опыта с первого уровня; уровень находится bisect'ом по этой кривой.
+    """
+    __slots__ = ('mult', 'thresholds', 'coins', 'reputation', 'present', 'coins_prefix', 'rep_prefix')
+
+    def __init__(self, mult: float, rewards: Dict[int, Tuple[float, int]]):
+        self.mult = mult
+        # thresholds[i] — опыт от начала первого уровня до уровня i+1
+        self.thresholds = [mult * lvl * (lvl + 1) / 2 for lvl in range(MAX_LEVEL)]
+        self.coins = [0.0] * (MAX_LEVEL + 1)
+        self.reputation = [0] * (MAX_LEVEL + 1)
+        self.present = [False] * (MAX_LEVEL + 1)
+        for lvl, (coins, rep) in rewards.items():
+            if 1 <= lvl <= MAX_LEVEL:
+                self.coins[lvl] = coins
+                self.reputation[lvl] = rep
+                self.present[lvl] = True
+        self.coins_prefix = [0.0] * (MAX_LEVEL + 1)
+        self.rep_prefix = [0] * (MAX_LEVEL + 1)
+        for lvl in range(1, MAX_LEVEL + 1):
+            self.coins_prefix[lvl] = self.coins_prefix[lvl - 1] + self.coins[lvl]
+            self.rep_prefix[lvl] = self.rep_prefix[lvl - 1] + self.reputation[lvl]
+
+    def advance(self, level: int, exp: float, gained: float) -> Tuple[int, float]:
+        """Новые (уровень, опыт внутри уровня) после получения gained опыта."""
+        if level >= MAX_LEVEL or level < 1 or self.mult <= 0:
+            return level, exp + gained
+        total = self.thresholds[level - 1] + exp + gained
+        new_level = max(level, bisect.bisect_right(self.thresholds, total))
+        return new_level, total - self.thresholds[new_level - 1]
+
+    def rewards_between(self, old_level: int, new_level: int) -> Tuple[float, int]:
+        """Сумма наград за уровни old_level+1 .. new_level."""
+        return (self.coins_prefix[new_level] - self.coins_prefix[old_level],
+                self.rep_prefix[new_level] - self.rep_prefix[old_level])
+
+    def reward_rows(self, old_level: int, new_level: int) -> List[Tuple[int, float, int]]:
+        return [(lvl, self.coins[lvl], self.reputation[lvl])
+                for lvl in range(old_level + 1, new_level + 1) if self.present[lvl]]
+
+    def reward(self, level: int) -> Tuple[float, int]:
+        if 1 <= level <= MAX_LEVEL:
+            return self.coins[level], self.reputation[level]
+        return 0.0, 0
+
+level_rewards_rows: Dict[int, Tuple[float, int]] = {}  # уровень -> (баксы, репутация) из level_rewards
+level_curve: Optional[LevelCurve] = None
+
+def get_level_curve() -> LevelCurve:
+    """Кривая для текущего level_multiplier; пересобирается при смене множителя или наград."""
+    global level_curve
+    mult = settings_snapshot.level_multiplier
+    if level_curve is None or level_curve.mult != mult:
+        level_curve = LevelCurve(mult, level_rewards_rows)
+    return level_curve
+
+@db_retry()
+async def load_level_rewards():
+    global level_rewards_rows, level_curve
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch("SELECT level, coins, reputation FROM level_rewards")
+    level_rewards_rows = {r['level']: (float(r['coins'] or 0), r['reputation'] or 0) for r in rows}
+    level_curve = None
+
 @db_retry()
 async def add_exp(user_id: int, exp: int, conn=None) -> Optional[str]:
     """
@@ -2099,72 +3140,7 @@ async def add_exp(user_id: int, exp: int, conn=None) -> Optional[str]:
     """
     async def _add(conn):
         await conn.execute("SET LOCAL statement_timeout = '5s'")
-        user = await conn.fetchrow("SELECT exp, level, balance, reputation FROM users WHERE user_id=$1 FOR UPDATE", user_id)
-        if not user:
-            # Если пользователя нет, создаём его (на всякий случай)
-            await ensure_user_exists(user_id, conn=conn)
-            user = await conn.fetchrow("SELECT exp, level, balance, reputation FROM users WHERE user_id=$1 FOR UPDATE", user_id)
-            if not user:
-                logging.error(f"Не удалось создать пользователя {user_id} в add_exp")
-                return None
-        new_exp = user['exp'] + exp
-        level = user['level']
-        level_mult = await get_setting_float("level_multiplier")  # используем float
-        levels_gained = 0
-        rewards = []  # список достигнутых уровней
-        while new_exp >= level * level_mult and level < 100:
-            new_exp -= level * level_mult
-            level += 1
-            levels_gained += 1
-            rewards.append(level)
-
-        # Обновляем опыт и уровень
-        await conn.execute(
-            "UPDATE users SET exp=$1, level=$2 WHERE user_id=$3",
-            new_exp, level, user_id
-        )
-
-        if levels_gained > 0:
-            # Начисляем статы
-            str_inc = await get_setting_int("stat_strength_per_level") * levels_gained
-            agi_inc = await get_setting_int("stat_agility_per_level") * levels_gained
-            def_inc = await get_setting_int("stat_defense_per_level") * levels_gained
-            await conn.execute(
-                "UPDATE users SET strength = strength + $1, agility = agility + $2, defense = defense + $3 WHERE user_id=$4",
-                str_inc, agi_inc, def_inc, user_id
-            )
-
-            # Начисляем награды за каждый достигнутый уровень
-            total_coins = 0.0
-            total_rep = 0
-            for lvl in rewards:
-                reward = await conn.fetchrow(
-                    "SELECT coins, reputation FROM level_rewards WHERE level=$1",
-                    lvl
-                )
-                if reward:
-                    total_coins += float(reward['coins'])
-                    total_rep += reward['reputation']
-
-            if total_coins > 0:
-                await update_user_balance(user_id, total_coins, conn=conn, allow_negative=False)
-            if total_rep > 0:
-                await update_user_reputation(user_id, total_rep, conn=conn)
-
-            # Формируем сообщение
-            reward_summary = []
-            for lvl in rewards:
-                reward = await conn.fetchrow(
-                    "SELECT coins, reputation FROM level_rewards WHERE level=$1",
-                    lvl
-                )
-                if reward:
-                    reward_summary.append(f"Уровень {lvl}: +{float(reward['coins']):.2f} баксов, +{reward['reputation']} репутации")
-            if reward_summary:
-                text = "🎉 Поздравляем! Ты достиг новых уровней!\n" + "\n".join(reward_summary) + \
-                       f"\nТвои статы увеличены: сила +{str_inc}, ловкость +{agi_inc}, защита +{def_inc}."
-                return text
-        return None
+        return (await add_exp_bulk([(user_id, exp)], conn)).get(user_id)
 
     if conn:
         return await _add(conn)
@@ -2176,20 +3152,227 @@ async def add_exp(user_id: int, exp: int, conn=None) -> Optional[str]:
                 await safe_send_message(user_id, msg)
         return None
 
+async def add_exp_bulk(entries: List[Tuple[int, int]], conn) -> Dict[int, str]:
+    """
+    Начисляет опыт сразу нескольким пользователям внутри транзакции conn.
+    Строки блокируются одним SELECT ... FOR UPDATE в порядке user_id (без взаимоблокировок),
+    повышения считаются по кривой уровней, а опыт, уровень, статы, баланс и репутация
+    пишутся одним UPDATE ... FROM unnest. Возвращает {user_id: сообщение о повышении уровня}.
+    """
+    gains = defaultdict(int)
+    for uid, exp in entries:
+        gains[uid] += exp
+    if not gains:
+        return {}
+    user_ids = sorted(gains)
+    for uid in user_ids:
+        invalidate_user_context(uid)
+    touch_leaderboards(*user_ids)
+
+    select_sql = "SELECT user_id, exp, level FROM users WHERE user_id = ANY($1::bigint[]) ORDER BY user_id FOR UPDATE"
+    rows = await conn.fetch(select_sql, user_ids)
+    if len(rows) < len(user_ids):
+        # Недостающих пользователей создаём на том же соединении (на всякий случай)
+        found = {r['user_id'] for r in rows}
+        missing = [uid for uid in user_ids if uid not in found]
+        logging.warning(f"add_exp_bulk: нет пользователей {missing}, создаю")
+        await conn.execute(
+            "INSERT INTO users (user_id, joined_date, balance, reputation, total_spent, negative_balance, exp, level, "
+            "bitcoin_balance, authority_balance, skill_share, skill_luck, skill_betray) "
+            "SELECT u, $2, 0, 0, 0, 0, 0, 1, 0.0, 0, 0, 0, 0 FROM unnest($1::bigint[]) AS u "
+            "ON CONFLICT (user_id) DO NOTHING",
+            missing, datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        )
+        rows = await conn.fetch(select_sql, user_ids)
+
+    curve = get_level_curve()
+    cfg = settings_snapshot
+    str_per = cfg.get_int("stat_strength_per_level")
+    agi_per = cfg.get_int("stat_agility_per_level")
+    def_per = cfg.get_int("stat_defense_per_level")
+    ids, new_exps, levels, gained_levels, coins_list, rep_list = [], [], [], [], [], []
+    messages = {}
+    for r in rows:
+        uid = r['user_id']
+        old_level = r['level'] or 1
+        level, new_exp = curve.advance(old_level, r['exp'] or 0, gains[uid])
+        gained = max(0, level - old_level)
+        coins, rep = curve.rewards_between(old_level, level) if gained else (0.0, 0)
+        ids.append(uid)
+        new_exps.append(int(new_exp))
+        levels.append(level)
+        gained_levels.append(gained)
+        coins_list.append(round(coins, 2))
+        rep_list.append(rep)
+        if gained:
+            msg = format_level_up_message(
+                curve.reward_rows(old_level, level), str_per * gained, agi_per * gained, def_per * gained
+            )
+            if msg:
+                messages[uid] = msg
+
+    await conn.execute("""
+        UPDATE users u SET
+            exp = a.exp,
+            level = a.level,
+            strength = u.strength + a.gained * $7,
+            agility = u.agility + a.gained * $8,
+            defense = u.defense + a.gained * $9,
+            balance = ROUND(u.balance + a.coins::numeric, 2),
+            reputation = u.reputation + a.rep
+        FROM unnest($1::bigint[], $2::int[], $3::int[], $4::int[], $5::float8[], $6::int[])
+             AS a(user_id, exp, level, gained, coins, rep)
+        WHERE u.user_id = a.user_id
+    """, ids, new_exps, levels, gained_levels, coins_list, rep_list, str_per, agi_per, def_per)
+    return messages
+
+def format_level_up_message(reward_rows: List[Tuple[int, float, int]], str_inc: int, agi_inc: int, def_inc: int) -> Optional[str]:
+    """Текст поздравления по списку (уровень, монеты, репутация) достигнутых уровней."""
+    if not reward_rows:
+        return None
+    reward_summary = [f"Уровень {lvl}: +{coins:.2f} баксов, +{rep} репутации" for lvl, coins, rep in reward_rows]
+    return "🎉 Поздравляем! Ты достиг новых уровней!\n" + "\n".join(reward_summary) + \
+           f"\nТвои статы увеличены: сила +{str_inc}, ловкость +{agi_inc}, защита +{def_inc}."
+
 async def get_user_level(user_id: int) -> int:
     return (await get_user_stats(user_id))['level']
 
 async def get_user_exp(user_id: int) -> int:
     return (await get_user_stats(user_id))['exp']
 
+# ==================== РАСЧЁТ СТАВОК КАЗИНО ====================
+CASINO_GAMES = ('dice', 'guess', 'slots', 'roulette')
+
+@db_retry()
+async def settle_casino_bet(user_id: int, game: str, stake: float, payout: float, win: bool,
+                            exp: int, reputation: int = 0) -> Tuple[bool, float, Optional[str]]:
+    """
+    Проводит ставку казино через серверную функцию settle_bet (см. SETTLE_BET_SQL):
+    списание ставки, выигрыш, счётчик побед/поражений, опыт, повышение уровня с наградами
+    и запись в balance_ledger выполняются одним запросом.
+    Возвращает (успех, новый баланс, сообщение о повышении уровня или None).
+    """
+    if game not in CASINO_GAMES:
+        raise ValueError("Invalid game")
+    invalidate_user_context(user_id)
+    touch_leaderboards(user_id)
+    cfg = settings_snapshot
+    str_per = cfg.get_int("stat_strength_per_level")
+    agi_per = cfg.get_int("stat_agility_per_level")
+    def_per = cfg.get_int("stat_defense_per_level")
+    curve = get_level_curve()
+    # Пустая кривая (множитель <= 0) — уровень не меняется, как в LevelCurve.advance
+    thresholds = curve.thresholds if curve.mult > 0 else []
+    async with db_pool.acquire() as conn:
+        row = await conn.fetchrow(
+            "SELECT * FROM settle_bet($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13)",
+            user_id, game, round(float(stake), 2), round(float(payout), 2), bool(win), exp, reputation,
+            thresholds, curve.coins_prefix, curve.rep_prefix, str_per, agi_per, def_per
+        )
+    if not row or not row['ok']:
+        return False, 0.0, None
+    new_balance = float(row['new_balance'])
+    levels_gained = row['new_level'] - row['old_level']
+    if levels_gained <= 0:
+        return True, new_balance, None
+    level_up_msg = format_level_up_message(
+        curve.reward_rows(row['old_level'], row['new_level']),
+        str_per * levels_gained, agi_per * levels_gained, def_per * levels_gained
+    )
+    return True, new_balance, level_up_msg
+
 @db_retry()
 async def update_user_total_spent(user_id: int, amount: float):
+    invalidate_user_context(user_id)
+    touch_leaderboards(user_id)
     async with db_pool.acquire() as conn:
         await conn.execute("UPDATE users SET total_spent = total_spent + $1 WHERE user_id=$2", amount, user_id)
 
+# ==================== ПУЛ СЛУЧАЙНЫХ ЦЕЛЕЙ ДЛЯ ОГРАБЛЕНИЯ ====================
+class UserIdPool:
+    """
+    Компактный набор user_id (array('q')) с индексом позиций.
+    Добавление, удаление (перестановкой с последним) и случайный выбор — O(1).
+    """
+
+    def __init__(self):
+        self.ids = array('q')
+        self.pos: Dict[int, int] = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.pos
+
+    def add(self, user_id: int):
+        if user_id not in self.pos:
+            self.pos[user_id] = len(self.ids)
+            self.ids.append(user_id)
+
+    def remove(self, user_id: int):
+        idx = self.pos.pop(user_id, None)
+        if idx is None:
+            return
+        last = self.ids.pop()
+        if last != user_id:
+            self.ids[idx] = last
+            self.pos[last] = idx
+
+    def sample(self, exclude_id: int) -> Optional[int]:
+        """Случайный id, отличный от exclude_id (равновероятно среди остальных), или None."""
+        size = len(self.ids)
+        if size == 0 or (size == 1 and self.ids[0] == exclude_id):
+            return None
+        idx = random.randrange(size)
+        if self.ids[idx] == exclude_id:
+            # Попали в исключённого — сдвигаемся на случайное число позиций среди остальных
+            idx = (idx + 1 + random.randrange(size - 1)) % size
+        return self.ids[idx]
+
+theft_targets = UserIdPool()       # все незабаненные пользователи
+rich_theft_targets = UserIdPool()  # из них — с балансом больше min_theft_amount
+theft_targets_ready = False
+
+def update_theft_targets(rows, full: bool = False):
+    """
+    Обновляет пулы по строкам users (user_id, balance). Вызывается из пересборки
+    и инкрементального обновления индексов топов, поэтому отдельных запросов не делает.
+    """
+    global theft_targets, rich_theft_targets, theft_targets_ready
+    min_balance = settings_snapshot.min_theft_amount
+    if full:
+        all_pool, rich_pool = UserIdPool(), UserIdPool()
+    else:
+        all_pool, rich_pool = theft_targets, rich_theft_targets
+    for r in rows:
+        user_id = r['user_id']
+        if user_id in banned_user_ids:
+            all_pool.remove(user_id)
+            rich_pool.remove(user_id)
+            continue
+        all_pool.add(user_id)
+        if float(r['balance'] or 0) > min_balance:
+            rich_pool.add(user_id)
+        else:
+            rich_pool.remove(user_id)
+    if full:
+        theft_targets, rich_theft_targets = all_pool, rich_pool
+        theft_targets_ready = True
+
+def remove_theft_target(user_id: int):
+    theft_targets.remove(user_id)
+    rich_theft_targets.remove(user_id)
+
 @db_retry()
 async def get_random_user(exclude_id: int):
-    # Используем более эффективный метод с OFFSET
+    if theft_targets_ready:
+        if settings_snapshot.random_target_require_balance:
+            target = rich_theft_targets.sample(exclude_id)
+            if target is not None:
+                return target
+        return theft_targets.sample(exclude_id)
+    # Пул ещё не построен — выбираем в БД
     async with db_pool.acquire() as conn:
         total = await conn.fetchval("SELECT COUNT(*) FROM users WHERE user_id != $1 AND user_id NOT IN (SELECT user_id FROM banned_users)", exclude_id)
         if total == 0:
@@ -2203,30 +3386,196 @@ async def get_random_user(exclude_id: int):
         """, exclude_id, offset)
         return row['user_id'] if row else None
 
-# ==================== ФУНКЦИИ ДЛЯ ГЛОБАЛЬНОГО КУЛДАУНА ====================
-@db_retry()
-async def check_global_cooldown(user_id: int, command: str, cooldown_seconds: int = None) -> Tuple[bool, int]:
-    if cooldown_seconds is None:
-        cooldown_seconds = await get_setting_int("global_cooldown_seconds")
+# ==================== СЕРВИС КУЛДАУНОВ ====================
+class CooldownWheel:
+    """
+    Локальное хранилище кулдаунов: ключ (user_id, command) -> момент истечения.
+    Истёкшие ключи вычищаются колесом таймеров по секундным слотам при каждом обращении,
+    поэтому память не растёт и отдельная чистка не нужна.
+    """
+
+    def __init__(self, slots: int = COOLDOWN_WHEEL_SLOTS):
+        self.expires: Dict[Tuple[int, str], float] = {}
+        self.by_user: Dict[int, set] = defaultdict(set)
+        self.slots = [set() for _ in range(slots)]
+        self.last_tick = int(time.time())
+
+    def _tick(self, now: float):
+        current = int(now)
+        steps = min(current - self.last_tick, len(self.slots))
+        for i in range(1, steps + 1):
+            slot = self.slots[(self.last_tick + i) % len(self.slots)]
+            for key in [k for k in slot if self.expires.get(k, 0) <= now]:
+                slot.discard(key)
+                self._drop(key)
+        self.last_tick = current
+
+    def _drop(self, key):
+        if self.expires.pop(key, None) is None:
+            return
+        commands = self.by_user.get(key[0])
+        if commands is not None:
+            commands.discard(key[1])
+            if not commands:
+                del self.by_user[key[0]]
+
+    def remaining(self, key, now: float) -> float:
+        self._tick(now)
+        return self.expires.get(key, 0) - now
+
+    def set(self, key, expires_at: float):
+        old = self.expires.get(key)
+        if old is not None:
+            self.slots[int(old) % len(self.slots)].discard(key)
+        self.expires[key] = expires_at
+        self.by_user[key[0]].add(key[1])
+        self.slots[int(expires_at) % len(self.slots)].add(key)
+
+    def try_acquire(self, key, ttl: float, now: float) -> float:
+        """Ставит кулдаун, если его нет. Возвращает 0 при успехе, иначе оставшиеся секунды."""
+        left = self.remaining(key, now)
+        if left > 0:
+            return left
+        self.set(key, now + ttl)
+        return 0
+
+    def clear(self, key):
+        old = self.expires.get(key)
+        if old is not None:
+            self.slots[int(old) % len(self.slots)].discard(key)
+        self._drop(key)
+
+    def clear_user(self, user_id: int):
+        for command in list(self.by_user.get(user_id, ())):
+            self.clear((user_id, command))
+
+cooldown_wheel = CooldownWheel()
+
+def _cooldown_key(user_id: int, command: str) -> str:
+    return f"cd:{user_id}:{command}"
+
+async def _persist_cooldown(user_id: int, command: str, expires_at: float):
+    """Дублирует кулдаун в PostgreSQL (только при COOLDOWNS_DURABLE и без Redis)."""
+    try:
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        async with db_pool.acquire() as conn:
+            await conn.execute('''
+                INSERT INTO global_cooldowns (user_id, command, last_used, expires_at)
+                VALUES ($1, $2, $3, $4)
+                ON CONFLICT (user_id, command) DO UPDATE SET last_used = $3, expires_at = $4
+            ''', user_id, command, now, datetime.fromtimestamp(expires_at, timezone.utc).replace(tzinfo=None))
+    except Exception as e:
+        logging.error(f"Не удалось сохранить кулдаун {command} пользователя {user_id}: {e}")
+
+async def load_durable_cooldowns():
+    """При старте без Redis восстанавливает ещё не истёкшие кулдауны из PostgreSQL."""
+    if redis_client is not None:
+        return
     async with db_pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT last_used FROM global_cooldowns WHERE user_id=$1 AND command=$2", user_id, command)
-        if row and row['last_used']:
-            diff = datetime.now(timezone.utc) - row['last_used']
-            remaining = cooldown_seconds - diff.total_seconds()
-            if remaining > 0:
-                return False, int(remaining)
+        rows = await conn.fetch(
+            "SELECT user_id, command, expires_at FROM global_cooldowns WHERE expires_at > (NOW() AT TIME ZONE 'UTC')"
+        )
+        smuggle_rows = await conn.fetch(
+            "SELECT user_id, cooldown_until FROM smuggle_cooldowns WHERE cooldown_until > (NOW() AT TIME ZONE 'UTC')"
+        )
+    for r in rows:
+        cooldown_wheel.set((r['user_id'], r['command']), r['expires_at'].replace(tzinfo=timezone.utc).timestamp())
+    for r in smuggle_rows:
+        cooldown_wheel.set((r['user_id'], "smuggle"), r['cooldown_until'].replace(tzinfo=timezone.utc).timestamp())
+    logging.info(f"✅ Восстановлено кулдаунов: {len(rows) + len(smuggle_rows)}")
+
+async def check_global_cooldown(user_id: int, command: str) -> Tuple[bool, int]:
+    """
+    Проверяет кулдаун без его установки. В БД не ходит.
+    Годится только для быстрой предпроверки: сам кулдаун захватывается try_acquire_cooldown.
+    """
+    if redis_client is not None:
+        try:
+            ttl_ms = await redis_client.pttl(_cooldown_key(user_id, command))
+            if ttl_ms and ttl_ms > 0:
+                return False, max(1, int(ttl_ms / 1000))
+            return True, 0
+        except Exception as e:
+            logging.error(f"Redis cooldown check error: {e}")
+    remaining = cooldown_wheel.remaining((user_id, command), time.time())
+    if remaining > 0:
+        return False, max(1, int(remaining))
     return True, 0
 
-@db_retry()
 async def set_global_cooldown(user_id: int, command: str, cooldown_seconds: int = None):
+    """Безусловно ставит кулдаун на cooldown_seconds."""
     if cooldown_seconds is None:
-        cooldown_seconds = await get_setting_int("global_cooldown_seconds")
-    async with db_pool.acquire() as conn:
-        await conn.execute('''
-            INSERT INTO global_cooldowns (user_id, command, last_used)
-            VALUES ($1, $2, $3)
-            ON CONFLICT (user_id, command) DO UPDATE SET last_used = $3
-        ''', user_id, command, datetime.now(timezone.utc))
+        cooldown_seconds = settings_snapshot.global_cooldown_seconds
+    if cooldown_seconds <= 0:
+        return
+    if redis_client is not None:
+        try:
+            await redis_client.set(_cooldown_key(user_id, command), "1", px=int(cooldown_seconds * 1000))
+            return
+        except Exception as e:
+            logging.error(f"Redis cooldown set error: {e}")
+    expires_at = time.time() + cooldown_seconds
+    cooldown_wheel.set((user_id, command), expires_at)
+    if COOLDOWNS_DURABLE:
+        asyncio.create_task(_persist_cooldown(user_id, command, expires_at))
+
+async def try_acquire_cooldown(user_id: int, command: str, cooldown_seconds: int = None) -> Tuple[bool, int]:
+    """
+    Атомарная проверка с установкой: если кулдауна нет — ставит его и возвращает (True, 0),
+    иначе (False, оставшиеся секунды). Два параллельных запроса не пройдут оба.
+    """
+    if cooldown_seconds is None:
+        cooldown_seconds = settings_snapshot.global_cooldown_seconds
+    if cooldown_seconds <= 0:
+        return True, 0
+    if redis_client is not None:
+        key = _cooldown_key(user_id, command)
+        try:
+            if await redis_client.set(key, "1", px=int(cooldown_seconds * 1000), nx=True):
+                return True, 0
+            ttl_ms = await redis_client.pttl(key)
+            return False, max(1, int((ttl_ms or 0) / 1000))
+        except Exception as e:
+            logging.error(f"Redis cooldown acquire error: {e}")
+    now = time.time()
+    remaining = cooldown_wheel.try_acquire((user_id, command), cooldown_seconds, now)
+    if remaining > 0:
+        return False, max(1, int(remaining))
+    if COOLDOWNS_DURABLE:
+        asyncio.create_task(_persist_cooldown(user_id, command, now + cooldown_seconds))
+    return True, 0
+
+async def release_cooldown(user_id: int, command: str):
+    """Снимает кулдаун, захваченный try_acquire_cooldown, если действие так и не состоялось."""
+    cooldown_wheel.clear((user_id, command))
+    if redis_client is not None:
+        try:
+            await redis_client.delete(_cooldown_key(user_id, command))
+        except Exception as e:
+            logging.error(f"Redis cooldown release error: {e}")
+    if COOLDOWNS_DURABLE:
+        try:
+            async with db_pool.acquire() as conn:
+                await conn.execute("DELETE FROM global_cooldowns WHERE user_id=$1 AND command=$2", user_id, command)
+        except Exception as e:
+            logging.error(f"Не удалось снять кулдаун {command} пользователя {user_id}: {e}")
+
+async def clear_user_cooldowns(user_id: int, conn=None):
+    """Снимает все кулдауны пользователя (сброс статистики)."""
+    cooldown_wheel.clear_user(user_id)
+    if redis_client is not None:
+        try:
+            keys = [k async for k in redis_client.scan_iter(match=f"cd:{user_id}:*")]
+            if keys:
+                await redis_client.delete(*keys)
+        except Exception as e:
+            logging.error(f"Redis cooldown clear error: {e}")
+    if COOLDOWNS_DURABLE:
+        if conn:
+            await conn.execute("DELETE FROM global_cooldowns WHERE user_id=$1", user_id)
+        else:
+            async with db_pool.acquire() as new_conn:
+                await new_conn.execute("DELETE FROM global_cooldowns WHERE user_id=$1", user_id)
 
 # ==================== ФУНКЦИИ ДЛЯ БИЗНЕСОВ ====================
 @db_retry()
@@ -2294,7 +3643,7 @@ async def get_business_price(business_type: dict, level: int) -> float:
     if level == 1:
         return base_price
     else:
-        upgrade_base = await get_setting_float("business_upgrade_cost_per_level")
+        upgrade_base = settings_snapshot.business_upgrade_cost_per_level
         cost = base_price + upgrade_base * (level ** 1.5)
         return round(cost, 2)
 
@@ -2306,10 +3655,12 @@ async def create_user_business(user_id: int, business_type_id: int, lifetime_hou
     async with db_pool.acquire() as conn:
         now = datetime.now(timezone.utc)
         expires_at = now + timedelta(hours=lifetime_hours) if lifetime_hours > 0 else None
-        await conn.execute(
-            "INSERT INTO user_businesses (user_id, business_type_id, level, last_collection, purchased_at, expires_at) VALUES ($1, $2, $3, $4, $5, $6) ON CONFLICT (user_id, business_type_id) DO NOTHING",
+        business_id = await conn.fetchval(
+            "INSERT INTO user_businesses (user_id, business_type_id, level, last_collection, purchased_at, expires_at) VALUES ($1, $2, $3, $4, $5, $6) ON CONFLICT (user_id, business_type_id) DO NOTHING RETURNING id",
             user_id, business_type_id, 1, now, now, expires_at
         )
+    if business_id and expires_at:
+        schedule_deadline('business', business_id, expires_at)
 
 @db_retry()
 async def collect_business_income(user_id: int, business_id: int, conn=None) -> Tuple[bool, str, float]:
@@ -2329,13 +3680,13 @@ async def collect_business_income(user_id: int, business_id: int, conn=None) ->
         now = datetime.now(timezone.utc)
         minutes_passed = int((now - last_date).total_seconds() / 60)
 
-        collect_interval = await get_setting_int("business_collect_interval_minutes")
+        collect_interval = settings_snapshot.business_collect_interval_minutes
         if minutes_passed < collect_interval:
             next_collect = last_date + timedelta(minutes=collect_interval)
             wait_minutes = int((next_collect - now).total_seconds() / 60)
             return False, f"⏳ Следующий сбор через {wait_minutes} мин.", 0
 
-        max_storage_hours = await get_setting_int("business_max_storage_hours")
+        max_storage_hours = settings_snapshot.business_max_storage_hours
         max_storage_minutes = max_storage_hours * 60
         collectable_minutes = min(minutes_passed, max_storage_minutes)
 
@@ -2395,14 +3746,98 @@ async def upgrade_business(user_id: int, business_id: int) -> Tuple[bool, str]:
             )
             return True, f"✅ Бизнес {biz['emoji']} {biz['name']} улучшен до уровня {biz['level'] + 1}! Потрачено {cost:.2f} BTC."
 
+# ==================== РЕЕСТР АКТИВНЫХ НАЛЁТОВ ====================
+# chat_id -> {'id', 'keyword', 'join_until' (unix time), 'participants' (set)} для налётов в фазе сбора.
+# Сообщения в группах сверяются с реестром, и БД трогается только при совпадении кодового слова.
+# Другие воркеры узнают об изменениях через NOTIFY (область "heists"), копия лежит в Redis.
+active_heists: Dict[int, dict] = {}
+
+def _heist_redis_key(chat_id: int) -> str:
+    return f"heist:active:{chat_id}"
+
+def register_active_heist(chat_id: int, heist_id: int, keyword: str, join_until: datetime, participants=()):
+    if join_until.tzinfo is None:
+        join_until = join_until.replace(tzinfo=timezone.utc)
+    entry = {
+        'id': heist_id,
+        'keyword': keyword.upper(),
+        'join_until': join_until.timestamp(),
+        'participants': set(participants),
+    }
+    active_heists[chat_id] = entry
+    ttl = int(entry['join_until'] - time.time()) + 1
+    if ttl > 0:
+        asyncio.create_task(redis_set(_heist_redis_key(chat_id), json.dumps({
+            'id': heist_id, 'keyword': entry['keyword'], 'join_until': entry['join_until']
+        }), ttl))
+
+def unregister_active_heist(chat_id: int):
+    if active_heists.pop(chat_id, None) is not None:
+        asyncio.create_task(redis_delete(_heist_redis_key(chat_id)))
+
+async def reload_active_heist(chat_id: int):
+    """Перечитывает налёт чата из БД (по NOTIFY от другого воркера)."""
+    try:
+        async with db_pool.acquire() as conn:
+            heist = await conn.fetchrow(
+                "SELECT id, keyword, join_until FROM heists WHERE chat_id=$1 AND status='joining' AND join_until > NOW()",
+                chat_id
+            )
+            participants = []
+            if heist:
+                participants = await conn.fetch("SELECT user_id FROM heist_participants WHERE heist_id=$1", heist['id'])
+    except Exception as e:
+        logging.error(f"Не удалось перечитать налёт чата {chat_id}: {e}")
+        return
+    if heist:
+        register_active_heist(chat_id, heist['id'], heist['keyword'], heist['join_until'], [p['user_id'] for p in participants])
+    else:
+        unregister_active_heist(chat_id)
+
+@db_retry()
+async def load_active_heists():
+    """Заполняет реестр налётами в фазе сбора (при старте)."""
+    async with db_pool.acquire() as conn:
+        heists = await conn.fetch("SELECT id, chat_id, keyword, join_until FROM heists WHERE status='joining' AND join_until > NOW()")
+        participants = await conn.fetch(
+            "SELECT heist_id, user_id FROM heist_participants WHERE heist_id = ANY($1::int[])",
+            [h['id'] for h in heists]
+        )
+    by_heist = defaultdict(list)
+    for p in participants:
+        by_heist[p['heist_id']].append(p['user_id'])
+    active_heists.clear()
+    for h in heists:
+        register_active_heist(h['chat_id'], h['id'], h['keyword'], h['join_until'], by_heist[h['id']])
+    logging.info(f"✅ В реестре активных налётов: {len(heists)}")
+
+async def get_active_heist(chat_id: int) -> Optional[dict]:
+    """Налёт в фазе сбора для чата или None. Без обращения к БД."""
+    entry = active_heists.get(chat_id)
+    if entry is None and cache_listener_conn is None and redis_client is not None:
+        # Слушатель NOTIFY недоступен — о налётах других воркеров узнаём из Redis
+        raw = await redis_get(_heist_redis_key(chat_id))
+        if raw:
+            data = json.loads(raw)
+            register_active_heist(chat_id, data['id'], data['keyword'],
+                                  datetime.fromtimestamp(data['join_until'], timezone.utc))
+            entry = active_heists.get(chat_id)
+    if entry is not None and entry['join_until'] <= time.time():
+        active_heists.pop(chat_id, None)
+        return None
+    return entry
+
 # ==================== ФУНКЦИИ ДЛЯ НАЛЁТОВ ====================
 @db_retry()
-async def spawn_heist(chat_id: int):
+async def spawn_heist(chat_id: int, conn) -> dict:
+    """
+    Вставляет налёт и отмечает last_heist_time в транзакции вызывающего (под блокировкой чата).
+    Объявлять налёт нужно после коммита — announce_heist.
+    """
     heist_type = random.choice(list(HEIST_TYPES.keys()))
-    config = HEIST_TYPES[heist_type]
-    keyword = config['keyword']
-    join_minutes = await get_setting_int("heist_join_minutes")
-    split_minutes = await get_setting_int("heist_split_minutes")
+    keyword = HEIST_TYPES[heist_type]['keyword']
+    join_minutes = settings_snapshot.heist_join_minutes
+    split_minutes = settings_snapshot.heist_split_minutes
     now = datetime.now(timezone.utc)
     join_until = now + timedelta(minutes=join_minutes)
     split_until = join_until + timedelta(minutes=split_minutes)
@@ -2410,27 +3845,31 @@ async def spawn_heist(chat_id: int):
     total_pot = 0
     btc_pot = 0
 
-    async with db_pool.acquire() as conn:
-        heist_id = await conn.fetchval(
-            "INSERT INTO heists (chat_id, event_type, keyword, total_pot, remaining_pot, btc_pot, started_at, join_until, split_until, status) "
-            "VALUES ($1, $2, $3, $4, $4, $5, $6, $7, $8, $9) RETURNING id",
-            chat_id, heist_type, keyword, total_pot, btc_pot,
-            now, join_until, split_until, 'joining'
-        )
-    text = get_random_phrase(config['phrases_start'], minutes=join_minutes)
-    text += f"\n\n📝 Чтобы участвовать, напиши **{keyword}** в течение {join_minutes} минут!"
-
-    media_key = f"heist_{heist_type}"
-    file_id = await get_media_file_id(media_key)
-    if file_id:
-        await bot.send_photo(chat_id, file_id, caption=text)
-    else:
-        await safe_send_chat(chat_id, text)
-    asyncio.create_task(finish_heist_joining(heist_id, join_until))
-
-async def finish_heist_joining(heist_id: int, join_until: datetime):
-    delay = max(0, (join_until - datetime.now(timezone.utc)).total_seconds())
-    await asyncio.sleep(delay)
+    heist_id = await conn.fetchval(
+        "INSERT INTO heists (chat_id, event_type, keyword, total_pot, remaining_pot, btc_pot, started_at, join_until, split_until, status) "
+        "VALUES ($1, $2, $3, $4, $4, $5, $6, $7, $8, $9) RETURNING id",
+        chat_id, heist_type, keyword, total_pot, btc_pot,
+        now, join_until, split_until, 'joining'
+    )
+    await conn.execute("UPDATE confirmed_chats SET last_heist_time=$1 WHERE chat_id=$2", now, chat_id)
+    # Новый владелец шарда должен видеть свежий last_heist_time, а не свой старый кэш чатов
+    await notify_cache_invalidation("confirmed_chats", str(chat_id), conn=conn)
+    return {'id': heist_id, 'event_type': heist_type, 'keyword': keyword,
+            'join_until': join_until, 'join_minutes': join_minutes, 'started_at': now}
+
+async def announce_heist(chat_id: int, heist: dict):
+    """Регистрирует закоммиченный налёт, рассылает NOTIFY и объявляет его в чате."""
+    config = HEIST_TYPES[heist['event_type']]
+    register_active_heist(chat_id, heist['id'], heist['keyword'], heist['join_until'])
+    await notify_cache_invalidation("heists", str(chat_id))
+    text = get_random_phrase(config['phrases_start'], minutes=heist['join_minutes'])
+    text += f"\n\n📝 Чтобы участвовать, напиши **{heist['keyword']}** в течение {heist['join_minutes']} минут!"
+
+    await send_with_media(chat_id, text, media_key=f"heist_{heist['event_type']}", priority=PRIORITY_GAME)
+    schedule_deadline('heist_join', heist['id'], heist['join_until'])
+
+async def finish_heist_joining(heist_id: int):
+    """Закрывает сбор налёта (вызывается планировщиком в join_until)."""
     async with db_pool.acquire() as conn:
         async with conn.transaction():
             heist = await conn.fetchrow("SELECT * FROM heists WHERE id=$1 AND status='joining' FOR UPDATE", heist_id)
@@ -2440,6 +3879,8 @@ async def finish_heist_joining(heist_id: int, join_until: datetime):
                 "UPDATE heists SET status='splitting' WHERE id=$1",
                 heist_id
             )
+            unregister_active_heist(heist['chat_id'])
+            await notify_cache_invalidation("heists", str(heist['chat_id']), conn=conn)
             participants = await conn.fetch("SELECT user_id FROM heist_participants WHERE heist_id=$1", heist_id)
             if not participants:
                 await conn.execute("UPDATE heists SET status='finished' WHERE id=$1", heist_id)
@@ -2447,7 +3888,7 @@ async def finish_heist_joining(heist_id: int, join_until: datetime):
                 return
 
             config = HEIST_TYPES[heist['event_type']]
-            split_minutes = await get_setting_int("heist_split_minutes")
+            split_minutes = settings_snapshot.heist_split_minutes
             text = get_random_phrase(config.get('phrases_split', ["🔪 Начинается распил! У тебя {minutes} минут."]), minutes=split_minutes)
             await safe_send_chat(heist['chat_id'], text)
 
@@ -2469,182 +3910,167 @@ async def ask_betray_choice(heist_id: int, split_until: datetime):
                 "🔪 Начинается распил! Ты можешь попытаться украсть часть добычи у других участников.\n"
                 "Если откажешься, останешься со своей долей, но можешь стать жертвой.\n"
                 "У тебя есть 5 минут на выбор.",
+                priority=PRIORITY_GAME,
                 reply_markup=kb
             )
-    asyncio.create_task(process_betray_results(heist_id, split_until))
-
-async def process_betray_results(heist_id: int, split_until: datetime):
-    delay = max(0, (split_until - datetime.now(timezone.utc)).total_seconds())
-    await asyncio.sleep(delay)
+    schedule_deadline('heist_split', heist_id, split_until)
 
+async def process_betray_results(heist_id: int):
+    """
+    Подводит итоги распила (вызывается планировщиком в split_until).
+    Участники читаются одним запросом, исходы кидалова считаются в памяти,
+    а изменения пишутся несколькими пакетными запросами — блокировка налёта держится недолго.
+    """
+    chat_messages = []
+    level_up_messages = {}
     async with db_pool.acquire() as conn:
         async with conn.transaction():
             heist = await conn.fetchrow("SELECT * FROM heists WHERE id=$1 AND status='splitting' FOR UPDATE", heist_id)
             if not heist:
                 return
 
-            participants = await conn.fetch(
-                "SELECT * FROM heist_participants WHERE heist_id=$1",
-                heist_id
-            )
-            if not participants:
+            rows = await conn.fetch("""
+                SELECT hp.user_id, hp.current_share, hp.betray_choice,
+                       COALESCE(u.skill_betray, 0) AS skill_betray, u.username, u.first_name
+                FROM heist_participants hp
+                LEFT JOIN users u ON u.user_id = hp.user_id
+                WHERE hp.heist_id = $1
+            """, heist_id)
+            if not rows:
                 await conn.execute("UPDATE heists SET status='finished' WHERE id=$1", heist_id)
                 return
 
-            # Начисляем опыт за участие всем участникам
-            exp_participation = await get_setting_int("exp_per_heist_participation")
-            for p in participants:
-                level_up_msg = await add_exp(p['user_id'], exp_participation, conn=conn)
-                if level_up_msg:
-                    asyncio.create_task(safe_send_message(p['user_id'], level_up_msg))
+            cfg = settings_snapshot
+            exp_participation = cfg.get_int("exp_per_heist_participation")
+            betray_bonus_per_level = cfg.get_int("skill_betray_bonus_per_level")
+            base_chance = cfg.get_int("betray_base_chance")
+            max_chance = cfg.get_int("betray_max_chance")
+            steal_percent = cfg.get_int("betray_steal_percent")
+            fail_penalty_percent = cfg.get_int("betray_fail_penalty_percent")
+            exp_success = cfg.get_int("exp_per_betray_success")
+            exp_fail = cfg.get_int("exp_per_betray_fail")
+            config = HEIST_TYPES[heist['event_type']]
 
-            attackers = [p for p in participants if p['betray_choice'] == 'yes']
-            victims_pool = [p for p in participants]
+            info = {r['user_id']: r for r in rows}
+            user_ids = sorted(info)
+            shares = {uid: float(info[uid]['current_share']) for uid in user_ids}
+            exp_gain = dict.fromkeys(user_ids, exp_participation)
 
+            # Назначаем цели: каждый участник может стать целью только один раз
+            attackers = [uid for uid in user_ids if info[uid]['betray_choice'] == 'yes']
             random.shuffle(attackers)
+            available = list(user_ids)
+            position = {uid: i for i, uid in enumerate(available)}
             assigned = {}
-            participants_indices = {p['user_id']: i for i, p in enumerate(participants)}
-            available_targets = set(range(len(participants)))
-            for attacker in attackers:
-                attacker_index = participants_indices[attacker['user_id']]
-                possible = [i for i in available_targets if i != attacker_index]
-                if not possible:
+            for attacker_id in attackers:
+                if len(available) - (1 if attacker_id in position else 0) <= 0:
                     continue
-                target_index = random.choice(possible)
-                target_id = participants[target_index]['user_id']
-                assigned[attacker['user_id']] = target_id
-                available_targets.remove(target_index)
-
-            for attacker_id, target_id in assigned.items():
-                await conn.execute(
-                    "UPDATE heist_participants SET betray_target_id=$1 WHERE heist_id=$2 AND user_id=$3",
-                    target_id, heist_id, attacker_id
-                )
-
-            betrayals_log = []
+                target_id = attacker_id
+                while target_id == attacker_id:
+                    target_id = available[random.randrange(len(available))]
+                # Удаляем цель из доступных перестановкой с последним элементом
+                idx = position.pop(target_id)
+                last = available.pop()
+                if last != target_id:
+                    available[idx] = last
+                    position[last] = idx
+                assigned[attacker_id] = target_id
+
+            # Исходы кидалова считаем в памяти, доли меняются последовательно
+            now = datetime.now(timezone.utc)
+            betrayal_rows = []
+            attempt_ids, attempt_success = [], []
             for attacker_id, target_id in assigned.items():
-                attacker = next(p for p in participants if p['user_id'] == attacker_id)
-                target = next(p for p in participants if p['user_id'] == target_id)
-
-                skills = await get_user_skills(attacker_id)
-                betray_bonus = skills['skill_betray'] * await get_setting_int("skill_betray_bonus_per_level")
-                base_chance = await get_setting_int("betray_base_chance")
-                max_chance = await get_setting_int("betray_max_chance")
-                chance = min(base_chance + betray_bonus, max_chance)
-
+                chance = min(base_chance + info[attacker_id]['skill_betray'] * betray_bonus_per_level, max_chance)
                 success = random.randint(1, 100) <= chance
-
-                steal_percent = await get_setting_int("betray_steal_percent")
-                fail_penalty_percent = await get_setting_int("betray_fail_penalty_percent")
-
-                attacker_share = float(attacker['current_share'])
-                target_share = float(target['current_share'])
-
                 if success:
-                    steal_amount = target_share * steal_percent / 100
-                    new_attacker_share = attacker_share + steal_amount
-                    new_target_share = target_share - steal_amount
-                    exp = await get_setting_int("exp_per_betray_success")
-                    betrayals_log.append((attacker_id, target_id, steal_amount, True))
+                    amount = shares[target_id] * steal_percent / 100
+                    shares[attacker_id] += amount
+                    shares[target_id] -= amount
+                    exp_gain[attacker_id] += exp_success
+                    phrases = config.get('phrases_betray_success', [])
                 else:
-                    penalty = attacker_share * fail_penalty_percent / 100
-                    new_attacker_share = attacker_share - penalty
-                    new_target_share = target_share + penalty
-                    exp = await get_setting_int("exp_per_betray_fail")
-                    betrayals_log.append((attacker_id, target_id, penalty, False))
-
-                await conn.execute(
-                    "UPDATE heist_participants SET current_share=$1 WHERE heist_id=$2 AND user_id=$3",
-                    new_attacker_share, heist_id, attacker_id
-                )
-                await conn.execute(
-                    "UPDATE heist_participants SET current_share=$1 WHERE heist_id=$2 AND user_id=$3",
-                    new_target_share, heist_id, target_id
-                )
-                await conn.execute(
+                    amount = shares[attacker_id] * fail_penalty_percent / 100
+                    shares[attacker_id] -= amount
+                    shares[target_id] += amount
+                    exp_gain[attacker_id] += exp_fail
+                    phrases = config.get('phrases_betray_fail', [])
+                betrayal_rows.append((heist_id, attacker_id, target_id, success, round(amount, 2), now))
+                attempt_ids.append(attacker_id)
+                attempt_success.append(1 if success else 0)
+                chat_messages.append(get_random_phrase(
+                    phrases,
+                    name=attacker_id,
+                    username=info[attacker_id]['username'] or "нет юзернейма",
+                    target=target_id,
+                    amount=amount
+                ))
+
+            # Блокируем строки пользователей в едином порядке, чтобы не ловить взаимоблокировки
+            await conn.execute(
+                "SELECT 1 FROM users WHERE user_id = ANY($1::bigint[]) ORDER BY user_id FOR UPDATE",
+                user_ids
+            )
+            final_shares = [round(shares[uid], 2) for uid in user_ids]
+            await conn.execute("""
+                UPDATE heist_participants hp
+                SET current_share = a.share,
+                    betray_target_id = COALESCE(a.target_id, hp.betray_target_id)
+                FROM unnest($2::bigint[], $3::float8[], $4::bigint[]) AS a(user_id, share, target_id)
+                WHERE hp.heist_id = $1 AND hp.user_id = a.user_id
+            """, heist_id, user_ids, final_shares, [assigned.get(uid) for uid in user_ids])
+            if betrayal_rows:
+                await conn.executemany(
                     "INSERT INTO heist_betrayals (heist_id, attacker_id, target_id, success, amount, created_at) VALUES ($1, $2, $3, $4, $5, $6)",
-                    heist_id, attacker_id, target_id, success, abs(attacker_share - new_attacker_share), datetime.now(timezone.utc)
-                )
-                level_up_msg = await add_exp(attacker_id, exp, conn=conn)
-                if level_up_msg:
-                    asyncio.create_task(safe_send_message(attacker_id, level_up_msg))
-
-                await set_global_cooldown(attacker_id, "betray")
-                await conn.execute(
-                    "UPDATE users SET heists_betray_attempts = heists_betray_attempts + 1, heists_betray_success = heists_betray_success + $1 WHERE user_id=$2",
-                    1 if success else 0, attacker_id
+                    betrayal_rows
                 )
+                await conn.execute("""
+                    UPDATE users u
+                    SET heists_betray_attempts = u.heists_betray_attempts + 1,
+                        heists_betray_success = u.heists_betray_success + a.success
+                    FROM unnest($1::bigint[], $2::int[]) AS a(user_id, success)
+                    WHERE u.user_id = a.user_id
+                """, attempt_ids, attempt_success)
                 await conn.execute(
-                    "UPDATE users SET heists_betrayed_count = heists_betrayed_count + 1 WHERE user_id=$1",
-                    target_id
+                    "UPDATE users SET heists_betrayed_count = heists_betrayed_count + 1 WHERE user_id = ANY($1::bigint[])",
+                    list(assigned.values())
                 )
+            # Начисляем доли на баланс одним запросом
+            await conn.execute("""
+                UPDATE users u
+                SET balance = ROUND(u.balance + a.share::numeric, 2)
+                FROM unnest($1::bigint[], $2::float8[]) AS a(user_id, share)
+                WHERE u.user_id = a.user_id AND a.share > 0
+            """, user_ids, final_shares)
 
-                config = HEIST_TYPES[heist['event_type']]
-                # Получаем username внутри транзакции, используя conn
-                attacker_username = await get_user_username(attacker_id, conn=conn)
-                target_username = await get_user_username(target_id, conn=conn)
-                if success:
-                    phrase = get_random_phrase(config.get('phrases_betray_success', []),
-                                               name=attacker_id,
-                                               username=attacker_username,
-                                               target=target_id,
-                                               amount=abs(attacker_share - new_attacker_share))
-                else:
-                    phrase = get_random_phrase(config.get('phrases_betray_fail', []),
-                                               name=attacker_id,
-                                               username=attacker_username,
-                                               target=target_id,
-                                               amount=abs(attacker_share - new_attacker_share))
-                asyncio.create_task(safe_send_chat(heist['chat_id'], phrase))
-
-            final_participants = await conn.fetch(
-                "SELECT user_id, current_share FROM heist_participants WHERE heist_id=$1 ORDER BY current_share DESC",
-                heist_id
-            )
-            top_list = []
-            for idx, p in enumerate(final_participants[:3], 1):
-                user_info = await conn.fetchrow("SELECT first_name FROM users WHERE user_id=$1", p['user_id'])
-                name = user_info['first_name'] if user_info else f"ID{p['user_id']}"
-                top_list.append(f"{idx}. {name}")
-
-            top_str = "\n".join(top_list)
+            level_up_messages = await add_exp_bulk([(uid, exp_gain[uid]) for uid in user_ids], conn)
 
-            config = HEIST_TYPES[heist['event_type']]
-            text = get_random_phrase(config.get('phrases_result', ["🏁 Налёт завершён!\n🏆 Топ воров:\n{top}"]), top=top_str)
-            await safe_send_chat(heist['chat_id'], text)
+            await conn.execute("UPDATE heists SET status='finished' WHERE id=$1", heist_id)
 
-            # Начисляем доли на баланс
-            for p in final_participants:
-                success, _, _ = await update_user_balance(p['user_id'], float(p['current_share']), conn=conn, allow_negative=False)
-                if not success:
-                    logging.error(f"Не удалось начислить долю {p['current_share']} пользователю {p['user_id']} в налёте {heist_id}")
+    invalidate_user_context()
+    touch_leaderboards(*user_ids)
+    for attacker_id in assigned:
+        await set_global_cooldown(attacker_id, "betray")
 
-            await conn.execute("UPDATE heists SET status='finished' WHERE id=$1", heist_id)
+    top_ids = sorted(user_ids, key=lambda uid: shares[uid], reverse=True)[:3]
+    top_str = "\n".join(
+        f"{idx}. {info[uid]['first_name'] or f'ID{uid}'}" for idx, uid in enumerate(top_ids, 1)
+    )
+    for phrase in chat_messages:
+        asyncio.create_task(safe_send_chat(heist['chat_id'], phrase))
+    text = get_random_phrase(config.get('phrases_result', ["🏁 Налёт завершён!\n🏆 Топ воров:\n{top}"]), top=top_str)
+    await safe_send_chat(heist['chat_id'], text)
+    for uid, level_up_msg in level_up_messages.items():
+        asyncio.create_task(safe_send_message(uid, level_up_msg))
 
 # ==================== ФУНКЦИИ ДЛЯ КОНТРАБАНДЫ ====================
-@db_retry()
-async def check_smuggle_cooldown(user_id: int) -> Tuple[bool, int]:
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT cooldown_until FROM smuggle_cooldowns WHERE user_id=$1", user_id)
-        if row and row['cooldown_until']:
-            cooldown_until = row['cooldown_until']
-            if cooldown_until.tzinfo is None:
-                cooldown_until = cooldown_until.replace(tzinfo=timezone.utc)
-            remaining = (cooldown_until - datetime.now(timezone.utc)).total_seconds()
-            if remaining > 0:
-                return False, int(remaining)
-    return True, 0
+async def try_acquire_smuggle_cooldown(user_id: int) -> Tuple[bool, int]:
+    base = settings_snapshot.smuggle_cooldown_minutes
+    return await try_acquire_cooldown(user_id, "smuggle", base * 60)
 
-@db_retry()
 async def set_smuggle_cooldown(user_id: int, penalty: int = 0):
-    base = await get_setting_int("smuggle_cooldown_minutes")
-    cooldown_until = datetime.now(timezone.utc) + timedelta(minutes=base + penalty)
-    async with db_pool.acquire() as conn:
-        await conn.execute('''
-            INSERT INTO smuggle_cooldowns (user_id, cooldown_until)
-            VALUES ($1, $2)
-            ON CONFLICT (user_id) DO UPDATE SET cooldown_until = $2
-        ''', user_id, cooldown_until)
+    base = settings_snapshot.smuggle_cooldown_minutes
+    await set_global_cooldown(user_id, "smuggle", (base + penalty) * 60)
 
 # ==================== ФУНКЦИИ ДЛЯ ТЮРЬМЫ ====================
 @db_retry()
@@ -2652,38 +4078,39 @@ async def start_jail_sentence(user_id: int, chat_id: int, duration_minutes: int,
     now = datetime.now(timezone.utc)
     end_time = now + timedelta(minutes=duration_minutes)
     async with db_pool.acquire() as conn:
-        await conn.execute(
-            "INSERT INTO jail_sentences (user_id, chat_id, start_time, end_time, cell_number, article_number) VALUES ($1, $2, $3, $4, $5, $6)",
+        sentence_id = await conn.fetchval(
+            "INSERT INTO jail_sentences (user_id, chat_id, start_time, end_time, cell_number, article_number) VALUES ($1, $2, $3, $4, $5, $6) RETURNING id",
             user_id, chat_id, now, end_time, cell, article
         )
+    schedule_deadline('jail', sentence_id, end_time)
     return end_time
 
 # ==================== ФУНКЦИИ ДЛЯ РАСЧЁТА ШАНСОВ (ДЛЯ КРАЖ) ====================
 async def get_theft_success_chance(attacker_id: int) -> float:
-    base = await get_setting_float("theft_success_chance")
+    base = settings_snapshot.theft_success_chance
     rep = await get_user_reputation(attacker_id)
-    bonus = float(await get_setting_float("reputation_theft_bonus")) * rep
-    max_bonus = await get_setting_float("reputation_max_bonus_percent")
+    bonus = float(settings_snapshot.reputation_theft_bonus) * rep
+    max_bonus = settings_snapshot.reputation_max_bonus_percent
     bonus = min(bonus, max_bonus)
     return base + bonus
 
 async def get_defense_chance(victim_id: int) -> float:
-    base = await get_setting_float("theft_defense_chance")
+    base = settings_snapshot.theft_defense_chance
     rep = await get_user_reputation(victim_id)
-    bonus = float(await get_setting_float("reputation_defense_bonus")) * rep
-    max_bonus = await get_setting_float("reputation_max_bonus_percent")
+    bonus = float(settings_snapshot.reputation_defense_bonus) * rep
+    max_bonus = settings_snapshot.reputation_max_bonus_percent
     bonus = min(bonus, max_bonus)
     return base + bonus
 
 # ==================== ФУНКЦИИ ДЛЯ ОЧИСТКИ ====================
 @db_retry()
 async def perform_cleanup(manual=False):
-    days_heists = await get_setting_int("cleanup_days_heists")
-    days_purchases = await get_setting_int("cleanup_days_purchases")
-    days_giveaways = await get_setting_int("cleanup_days_giveaways")
-    days_tasks = await get_setting_int("cleanup_days_user_tasks")
-    days_smuggle = await get_setting_int("cleanup_days_smuggle")
-    days_orders = await get_setting_int("cleanup_days_bitcoin_orders")
+    days_heists = settings_snapshot.cleanup_days_heists
+    days_purchases = settings_snapshot.cleanup_days_purchases
+    days_giveaways = settings_snapshot.cleanup_days_giveaways
+    days_tasks = settings_snapshot.cleanup_days_user_tasks
+    days_smuggle = settings_snapshot.cleanup_days_smuggle
+    days_orders = settings_snapshot.cleanup_days_bitcoin_orders
     days_jail = 30
 
     now = datetime.now(timezone.utc)
@@ -2704,8 +4131,12 @@ async def perform_cleanup(manual=False):
         await conn.execute("DELETE FROM bitcoin_orders WHERE status IN ('completed', 'cancelled') AND created_at < $1", cutoff_orders)
         await conn.execute("DELETE FROM jail_sentences WHERE status='completed' AND end_time < $1", cutoff_jail)
 
-        cutoff_cooldown = now - timedelta(days=1)
-        await conn.execute("DELETE FROM global_cooldowns WHERE last_used < $1", cutoff_cooldown)
+        # Кулдауны живут в Redis/памяти; в таблице остаются только дубли при COOLDOWNS_DURABLE
+        await conn.execute("DELETE FROM global_cooldowns WHERE COALESCE(expires_at, last_used) < $1", now.replace(tzinfo=None))
+
+        # Участники, не писавшие в чат 90 дней, выпадают из топа чата
+        cutoff_members = (now - timedelta(days=90)).replace(tzinfo=None)
+        await conn.execute("DELETE FROM chat_members WHERE last_seen < $1", cutoff_members)
 
     if manual:
         logging.info("Ручная очистка выполнена.")
@@ -2748,38 +4179,434 @@ async def export_table_to_csv(table: str) -> Optional[bytes]:
         return output.getvalue().encode('utf-8')
 
 # ==================== ФУНКЦИИ ДЛЯ БИТКОИН-БИРЖИ ====================
+class OrderBookDesync(Exception):
+    """Стакан в памяти разошёлся с таблицей bitcoin_orders (заявку изменил другой процесс)."""
+
+
+class ExchangeBatch:
+    """Изменения одного цикла сведения: заявки, сделки и движения средств пользователей."""
+
+    def __init__(self):
+        self.orders: Dict[int, Tuple[dict, float]] = {}  # id -> (заявка, объём до цикла)
+        self.trades: List[tuple] = []
+        self.balances = defaultdict(float)
+        self.bitcoins = defaultdict(float)
+
+    def touch(self, order: dict):
+        if order['id'] not in self.orders:
+            self.orders[order['id']] = (order, order['amount'])
+
+    def is_empty(self) -> bool:
+        return not self.orders and not self.trades
+
+
+class OrderBookEngine:
+    """
+    Резидентный стакан заявок: уровни с целочисленной ценой и FIFO-очередью заявок на каждом.
+    Загружается из bitcoin_orders при старте, сведение идёт в памяти,
+    а итог цикла записывается в БД одним запросом (flush_exchange_batch).
+    Глубина (объём и число заявок на уровне) поддерживается инкрементально при каждом изменении.
+    Все изменения выполняются под self.lock (см. run_exchange_operation).
+    """
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.orders: Dict[int, dict] = {}
+        self.levels: Dict[str, Dict[int, deque]] = {'buy': {}, 'sell': {}}
+        self.prices: Dict[str, List[int]] = {'buy': [], 'sell': []}  # отсортированы по возрастанию
+        self.level_depth: Dict[str, Dict[int, List]] = {'buy': {}, 'sell': {}}  # цена -> [объём, число заявок]
+        self.loaded = False
+        self.dirty = False
+        self.changed = set()  # id заявок, изменённых текущей операцией (для уведомления других воркеров)
+
+    def clear(self):
+        self.orders.clear()
+        self.changed.clear()
+        for side in ('buy', 'sell'):
+            self.levels[side].clear()
+            self.prices[side].clear()
+            self.level_depth[side].clear()
+
+    def add(self, order: dict):
+        side, price = order['type'], order['price']
+        level = self.levels[side].get(price)
+        if level is None:
+            level = self.levels[side][price] = deque()
+            self.level_depth[side][price] = [0.0, 0]
+            bisect.insort(self.prices[side], price)
+        level.append(order['id'])
+        self.orders[order['id']] = order
+        self._adjust_depth(side, price, order['amount'], 1)
+        self.changed.add(order['id'])
+        self.dirty = True
+
+    def remove(self, order_id: int) -> Optional[dict]:
+        order = self.orders.pop(order_id, None)
+        if order is None:
+            return None
+        side, price = order['type'], order['price']
+        level = self.levels[side].get(price)
+        if level is not None:
+            try:
+                level.remove(order_id)
+            except ValueError:
+                pass
+            else:
+                self._adjust_depth(side, price, -order['amount'], -1)
+            if not level:
+                self._drop_level(side, price)
+        self.changed.add(order_id)
+        self.dirty = True
+        return order
+
+    def sync(self, order_id: int, amount: float, total_locked: float):
+        """Приводит объём заявки к значению из БД, сохраняя её место в очереди уровня."""
+        order = self.orders.get(order_id)
+        if order is None:
+            return
+        if amount <= 0.0001:
+            self.remove(order_id)
+            return
+        self._adjust_depth(order['type'], order['price'], amount - order['amount'], 0)
+        order['amount'] = amount
+        order['total_locked'] = total_locked
+        self.dirty = True
+
+    def crosses(self) -> bool:
+        return bool(self.prices['buy']) and bool(self.prices['sell']) and self.prices['buy'][-1] >= self.prices['sell'][0]
+
+    def _adjust_depth(self, side: str, price: int, amount_delta: float, count_delta: int):
+        entry = self.level_depth[side][price]
+        entry[0] = round(entry[0] + amount_delta, 4)
+        entry[1] += count_delta
+
+    def _drop_level(self, side: str, price: int):
+        self.levels[side].pop(price, None)
+        self.level_depth[side].pop(price, None)
+        prices = self.prices[side]
+        idx = bisect.bisect_left(prices, price)
+        if idx < len(prices) and prices[idx] == price:
+            prices.pop(idx)
+
+    def best(self, side: str) -> Optional[dict]:
+        prices = self.prices[side]
+        if not prices:
+            return None
+        price = prices[-1] if side == 'buy' else prices[0]
+        return self.orders[self.levels[side][price][0]]
+
+    def level_orders(self, side: str, price: int) -> List[dict]:
+        return [self.orders[oid] for oid in self.levels[side].get(price, ())]
+
+    def user_orders(self, user_id: int) -> List[dict]:
+        return [o for o in self.orders.values() if o['user_id'] == user_id]
+
+    def crossing_buyers(self) -> List[int]:
+        """Покупатели, чьи заявки пересекаются с лучшей продажей (кандидаты на сведение)."""
+        if not self.prices['sell']:
+            return []
+        best_ask = self.prices['sell'][0]
+        idx = bisect.bisect_left(self.prices['buy'], best_ask)
+        return sorted({self.orders[oid]['user_id']
+                       for price in self.prices['buy'][idx:]
+                       for oid in self.levels['buy'][price]})
+
+    def _fill(self, batch: ExchangeBatch, order: dict, amount: float, locked_delta: float):
+        """Уменьшает заявку на исполненный объём; исполненную целиком снимает со стакана и возвращает остаток блокировки."""
+        batch.touch(order)
+        self.changed.add(order['id'])
+        self._adjust_depth(order['type'], order['price'], -amount, 0)
+        order['amount'] = round(order['amount'] - amount, 4)
+        order['total_locked'] = round(order['total_locked'] - locked_delta, 4)
+        if order['amount'] > 0.0001:
+            return
+        leftover = order['total_locked']
+        if leftover > 0:
+            # Остаток от исполнения по лучшей цене (или округления) возвращается владельцу
+            if order['type'] == 'buy':
+                batch.balances[order['user_id']] += round(leftover, 2)
+            else:
+                batch.bitcoins[order['user_id']] += leftover
+        self._adjust_depth(order['type'], order['price'], -order['amount'], 0)
+        order['amount'] = 0.0
+        order['total_locked'] = 0.0
+        self.remove(order['id'])
+
+    def match(self, batch: ExchangeBatch, commission_percent: float = 0.0,
+              commission_side: str = 'seller', buyer_funds: Dict[int, float] = None):
+        """Сводит встречные заявки по приоритету цена-время, пока лучшие цены пересекаются."""
+        while True:
+            buy = self.best('buy')
+            sell = self.best('sell')
+            if buy is None or sell is None or buy['price'] < sell['price']:
+                break
+            trade_amount = round(min(buy['amount'], sell['amount']), 4)
+            trade_price = sell['price']
+            total_cost = round(trade_amount * trade_price, 2)
+            buyer_id = buy['user_id']
+            seller_id = sell['user_id']
+
+            # Комиссия сгорает: покупатель платит её со свободного баланса, продавец – из выручки
+            commission = round(total_cost * commission_percent / 100, 2) if commission_percent > 0 else 0.0
+            buyer_fee = commission if commission_side in ('buyer', 'both') else 0.0
+            seller_fee = commission if commission_side in ('seller', 'both') else 0.0
+            if buyer_fee > 0 and buyer_funds is not None:
+                if buyer_funds.get(buyer_id, 0.0) + batch.balances[buyer_id] < buyer_fee:
+                    logging.error(f"Не удалось списать комиссию с покупателя {buyer_id} в сделке buy {buy['id']} и sell {sell['id']}")
+                    break
+
+            batch.balances[buyer_id] -= buyer_fee
+            batch.balances[seller_id] += round(total_cost - seller_fee, 2)
+            batch.bitcoins[buyer_id] += trade_amount
+            batch.trades.append((buy['id'], sell['id'], trade_amount, trade_price, buyer_id, seller_id))
+            self._fill(batch, buy, trade_amount, total_cost)
+            self._fill(batch, sell, trade_amount, trade_amount)
+
+    def take(self, batch: ExchangeBatch, taker_id: int, side: str, price: int, amount: float) -> float:
+        """
+        Исполняет заявки стороны side на уровне price в порядке очереди.
+        side='sell' – пользователь покупает у продавцов, side='buy' – продаёт покупателям.
+        Возвращает исполненный объём BTC.
+        """
+        remaining = amount
+        filled = 0.0
+        level = self.levels[side].get(price)
+        while level and remaining > 0.0001:
+            order = self.orders[level[0]]
+            take = round(min(remaining, order['amount']), 4)
+            cost = round(take * price, 2)
+            if side == 'sell':
+                batch.balances[taker_id] -= cost
+                batch.bitcoins[taker_id] += take
+                batch.balances[order['user_id']] += cost
+                batch.trades.append((None, order['id'], take, price, taker_id, order['user_id']))
+                self._fill(batch, order, take, take)
+            else:
+                batch.bitcoins[taker_id] -= take
+                batch.balances[taker_id] += cost
+                batch.bitcoins[order['user_id']] += take
+                batch.trades.append((order['id'], None, take, price, order['user_id'], taker_id))
+                self._fill(batch, order, take, cost)
+            remaining = round(remaining - take, 4)
+            filled = round(filled + take, 4)
+        return filled
+
+    def depth(self, limit: int = None) -> Dict[str, List[Dict]]:
+        """Снимок стакана по уровням: O(числа выводимых уровней), без обхода заявок и копирования цен."""
+        def side_depth(side: str, prices) -> List[Dict]:
+            depth = self.level_depth[side]
+            return [{'price': p, 'total_amount': depth[p][0], 'count': depth[p][1]} for p in islice(prices, limit)]
+        return {'bids': side_depth('buy', reversed(self.prices['buy'])), 'asks': side_depth('sell', self.prices['sell'])}
+
+
+order_book = OrderBookEngine()
+
+
+def _order_from_row(row) -> dict:
+    return {
+        'id': row['id'],
+        'user_id': row['user_id'],
+        'type': row['type'],
+        'amount': float(row['amount']),
+        'price': row['price'],
+        'total_locked': float(row['total_locked']),
+        'created_at': row['created_at']
+    }
+
 @db_retry()
-async def get_order_book() -> Dict[str, List[Dict]]:
+async def load_order_book():
+    """Загружает активные заявки из bitcoin_orders в стакан в памяти."""
     async with db_pool.acquire() as conn:
-        buy_orders = await conn.fetch("""
-            SELECT price, SUM(amount) as total_amount, COUNT(*) as count
-            FROM bitcoin_orders
-            WHERE type='buy' AND status='active'
-            GROUP BY price
-            ORDER BY price DESC
-        """)
-        sell_orders = await conn.fetch("""
-            SELECT price, SUM(amount) as total_amount, COUNT(*) as count
+        rows = await conn.fetch("""
+            SELECT id, user_id, type, amount, price, total_locked, created_at
             FROM bitcoin_orders
-            WHERE type='sell' AND status='active'
-            GROUP BY price
-            ORDER BY price ASC
+            WHERE status='active'
+            ORDER BY created_at ASC, id ASC
         """)
-        bids = []
-        for r in buy_orders:
-            bids.append({
-                'price': r['price'],
-                'total_amount': float(r['total_amount']),
-                'count': r['count']
-            })
-        asks = []
-        for r in sell_orders:
-            asks.append({
-                'price': r['price'],
-                'total_amount': float(r['total_amount']),
-                'count': r['count']
-            })
-        return {'bids': bids, 'asks': asks}
+    order_book.clear()
+    for r in rows:
+        order_book.add(_order_from_row(r))
+    order_book.loaded = True
+    order_book.dirty = False
+    logging.info(f"Биржевой стакан загружен: {len(rows)} активных заявок")
+    mirror_order_book_depth()
+
+order_book_mirror_task: Optional[asyncio.Task] = None
+order_book_mirror_pending = False
+
+async def _mirror_order_book_loop():
+    global order_book_mirror_pending
+    while order_book_mirror_pending:
+        order_book_mirror_pending = False
+        try:
+            await redis_set(ORDER_BOOK_REDIS_KEY, json.dumps(order_book.depth(ORDER_BOOK_DEPTH_LEVELS)), 3600)
+        except Exception as e:
+            logging.error(f"Не удалось зеркалировать стакан в Redis: {e}")
+
+def mirror_order_book_depth():
+    """
+    Публикует снимок глубины стакана в Redis (если он подключён) для других воркеров.
+    Запись идёт одной задачей: вызовы во время записи сливаются в ещё один проход
+    с самым свежим снимком, так что старый снимок не может лечь поверх нового.
+    """
+    global order_book_mirror_task, order_book_mirror_pending
+    if redis_client is None:
+        return
+    order_book_mirror_pending = True
+    if order_book_mirror_task is None or order_book_mirror_task.done():
+        order_book_mirror_task = asyncio.create_task(_mirror_order_book_loop())
+
+async def ensure_order_book_loaded():
+    if order_book.loaded:
+        return
+    async with order_book.lock:
+        if not order_book.loaded:
+            await load_order_book()
+
+async def run_exchange_operation(operation):
+    """
+    Выполняет operation(conn) под блокировкой стакана в одной транзакции.
+    Если транзакция откатилась после изменения стакана в памяти, стакан перечитывается из БД.
+    При расхождении с БД (заявки изменил другой воркер) операция повторяется один раз.
+    """
+    invalidate_user_context()
+    async with order_book.lock:
+        for attempt in range(2):
+            if not order_book.loaded:
+                await load_order_book()
+            order_book.dirty = False
+            order_book.changed.clear()
+            try:
+                async with db_pool.acquire() as conn:
+                    async with conn.transaction():
+                        await conn.execute("SET LOCAL statement_timeout = '5s'")
+                        result = await operation(conn)
+                        if order_book.changed:
+                            # Уйдёт только после коммита; остальные воркеры перечитают эти заявки
+                            await publish_order_changes(conn, order_book.changed)
+                order_book.changed.clear()
+                if order_book.dirty:
+                    mirror_order_book_depth()
+                return result
+            except OrderBookDesync as e:
+                logging.warning(f"Стакан разошёлся с БД, перечитываю: {e}")
+                order_book.loaded = False
+                if attempt == 1:
+                    raise
+            except Exception:
+                if order_book.dirty:
+                    order_book.loaded = False
+                raise
+
+ORDER_NOTIFY_MAX_IDS = 500  # больше — просим другие воркеры перечитать стакан целиком
+
+async def publish_order_changes(conn, order_ids):
+    """NOTIFY об изменённых заявках: orders:<воркер>:<id,...> (пустой список — перечитать всё)."""
+    ids = ",".join(map(str, sorted(order_ids))) if len(order_ids) <= ORDER_NOTIFY_MAX_IDS else ""
+    await conn.execute("SELECT pg_notify($1, $2)", CACHE_INVALIDATION_CHANNEL, f"orders:{WORKER_ID}:{ids}")
+
+def apply_order_changes(key: str):
+    """Обработчик области orders: чужие изменения заявок подтягиваются в свой стакан."""
+    origin, _, ids = key.partition(":")
+    if origin == WORKER_ID:
+        return
+    if not ids:
+        order_book.loaded = False  # перечитается при следующем обращении
+        return
+    asyncio.create_task(sync_orders_from_db([int(i) for i in ids.split(",") if i]))
+
+async def sync_orders_from_db(order_ids: List[int]):
+    """
+    Перечитывает заявки из БД в стакан: новые добавляет, исполненные и отменённые снимает,
+    объёмы сверяет. Если после этого заявки пересекаются, лидер сводит их.
+    """
+    try:
+        async with order_book.lock:
+            if not order_book.loaded:
+                return
+            async with db_pool.acquire() as conn:
+                rows = await conn.fetch("""
+                    SELECT id, user_id, type, amount, price, total_locked, created_at
+                    FROM bitcoin_orders
+                    WHERE id = ANY($1::int[]) AND status='active'
+                    ORDER BY created_at ASC, id ASC
+                """, order_ids)
+            active = {r['id']: r for r in rows}
+            for oid in order_ids:
+                if oid not in active:
+                    order_book.remove(oid)
+            for oid, r in active.items():
+                if oid in order_book.orders:
+                    order_book.sync(oid, float(r['amount']), float(r['total_locked']))
+                else:
+                    order_book.add(_order_from_row(r))
+            order_book.changed.clear()
+            crossing = order_book.crosses()
+        mirror_order_book_depth()
+        if crossing and is_leader:
+            await run_exchange_operation(match_orders)
+    except Exception as e:
+        logging.error(f"Не удалось синхронизировать заявки {order_ids}: {e}")
+        order_book.loaded = False
+
+async def flush_exchange_batch(conn, batch: ExchangeBatch):
+    """
+    Записывает итог цикла сведения одним запросом: новые объёмы и статусы заявок,
+    сделки и изменения балансов. Заявка обновляется, только если в БД она всё ещё активна
+    и её объём совпадает с объёмом в памяти до цикла.
+    """
+    if batch.is_empty():
+        return
+    order_ids, amounts, locked, statuses, prev_amounts = [], [], [], [], []
+    for order, prev_amount in batch.orders.values():
+        order_ids.append(order['id'])
+        amounts.append(order['amount'])
+        locked.append(order['total_locked'])
+        statuses.append('active' if order['amount'] > 0.0001 else 'completed')
+        prev_amounts.append(prev_amount)
+    trade_cols = list(zip(*batch.trades)) if batch.trades else [[]] * 6
+    user_ids = sorted(set(batch.balances) | set(batch.bitcoins))
+    touch_leaderboards(*user_ids)
+    row = await conn.fetchrow("""
+        WITH upd AS (
+            UPDATE bitcoin_orders o
+            SET amount = v.amount, total_locked = v.total_locked, status = v.status
+            FROM unnest($1::int[], $2::numeric[], $3::numeric[], $4::text[], $5::numeric[])
+                 AS v(id, amount, total_locked, status, prev_amount)
+            WHERE o.id = v.id AND o.status = 'active' AND o.amount = ROUND(v.prev_amount, 4)
+            RETURNING o.id
+        ), trades AS (
+            INSERT INTO bitcoin_trades (buy_order_id, sell_order_id, amount, price, buyer_id, seller_id)
+            SELECT * FROM unnest($6::int[], $7::int[], $8::numeric[], $9::int[], $10::bigint[], $11::bigint[])
+        ), funds AS (
+            UPDATE users u
+            SET balance = u.balance + v.balance_delta,
+                bitcoin_balance = u.bitcoin_balance + v.bitcoin_delta
+            FROM unnest($12::bigint[], $13::numeric[], $14::numeric[]) AS v(user_id, balance_delta, bitcoin_delta)
+            WHERE u.user_id = v.user_id
+            RETURNING u.balance, u.bitcoin_balance
+        )
+        SELECT (SELECT COUNT(*) FROM upd) AS orders_updated,
+               (SELECT COALESCE(bool_and(balance >= 0 AND bitcoin_balance >= 0), TRUE) FROM funds) AS funds_ok
+    """, order_ids, amounts, locked, statuses, prev_amounts,
+        list(trade_cols[0]), list(trade_cols[1]), list(trade_cols[2]),
+        list(trade_cols[3]), list(trade_cols[4]), list(trade_cols[5]),
+        user_ids, [round(batch.balances[u], 2) for u in user_ids], [round(batch.bitcoins[u], 4) for u in user_ids])
+    if row['orders_updated'] != len(order_ids):
+        raise OrderBookDesync(f"обновлено {row['orders_updated']} из {len(order_ids)} заявок")
+    if not row['funds_ok']:
+        raise ValueError("Недостаточно средств для сделки")
+
+async def get_order_book(limit: int = ORDER_BOOK_DEPTH_LEVELS) -> Dict[str, List[Dict]]:
+    """Глубина стакана (лучшие limit уровней с каждой стороны) без агрегации в БД."""
+    if not order_book.loaded:
+        # Пока стакан не загружен в этом процессе, отдаём зеркало из Redis
+        cached = await redis_get(ORDER_BOOK_REDIS_KEY)
+        if cached:
+            book = json.loads(cached)
+            return {'bids': book['bids'][:limit], 'asks': book['asks'][:limit]}
+    await ensure_order_book_loaded()
+    return order_book.depth(limit)
 
 @db_retry()
 async def get_active_orders(order_type: str = None) -> List[dict]:
@@ -2800,157 +4627,102 @@ async def get_active_orders(order_type: str = None) -> List[dict]:
 
 @db_retry()
 async def create_bitcoin_order(user_id: int, order_type: str, amount: float, price: int) -> int:
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():
-            await conn.execute("SET LOCAL statement_timeout = '5s'")
-            if order_type == 'sell':
-                success, new_balance = await update_user_bitcoin(user_id, -amount, conn=conn)
-                if not success:
-                    raise ValueError("Недостаточно BTC")
-                total_locked = amount
-            else:
-                total_cost = amount * price
-                user_row = await conn.fetchrow("SELECT balance FROM users WHERE user_id=$1 FOR UPDATE", user_id)
-                if not user_row:
-                    await ensure_user_exists(user_id)
-                    user_row = await conn.fetchrow("SELECT balance FROM users WHERE user_id=$1 FOR UPDATE", user_id)
-                current_balance = float(user_row['balance'])
-                if current_balance < total_cost - 0.01:
-                    raise ValueError("Недостаточно баксов")
-                success, new_balance, _ = await update_user_balance(user_id, -total_cost, conn=conn, allow_negative=False)
-                if not success:
-                    raise ValueError("Недостаточно баксов (ошибка при списании)")
-                total_locked = total_cost
-
-            order_id = await conn.fetchval(
-                "INSERT INTO bitcoin_orders (user_id, type, amount, price, total_locked) VALUES ($1, $2, $3, $4, $5) RETURNING id",
-                user_id, order_type, amount, price, total_locked
+    if order_type == 'sell':
+        total_locked = round(amount, 4)
+        locked_column, error = "bitcoin_balance", "Недостаточно BTC"
+    else:
+        total_locked = round(amount * price, 2)
+        locked_column, error = "balance", "Недостаточно баксов"
+
+    async def _create(conn):
+        # Блокировка средств и вставка заявки – один запрос
+        row = await conn.fetchrow(f"""
+            WITH debit AS (
+                UPDATE users SET {locked_column} = {locked_column} - $3::numeric
+                WHERE user_id = $1 AND {locked_column} >= $3::numeric
+                RETURNING user_id
             )
-            await match_orders(conn)
-            return order_id
+            INSERT INTO bitcoin_orders (user_id, type, amount, price, total_locked)
+            SELECT user_id, $2::text, $4::numeric, $5::int, $3::numeric FROM debit
+            RETURNING id, user_id, type, amount, price, total_locked, created_at
+        """, user_id, order_type, total_locked, amount, price)
+        if not row:
+            raise ValueError(error)
+        touch_leaderboards(user_id)
+        order_book.add(_order_from_row(row))
+        await match_orders(conn)
+        return row['id']
+
+    return await run_exchange_operation(_create)
 
 @db_retry()
 async def cancel_bitcoin_order(order_id: int, user_id: int) -> bool:
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():
-            await conn.execute("SET LOCAL statement_timeout = '5s'")
-            order = await conn.fetchrow("SELECT * FROM bitcoin_orders WHERE id=$1 AND user_id=$2 AND status='active' FOR UPDATE", order_id, user_id)
-            if not order:
-                return False
-            total_locked = float(order['total_locked'])
-            if order['type'] == 'sell':
-                await update_user_bitcoin(user_id, total_locked, conn=conn)
-            else:
-                await update_user_balance(user_id, total_locked, conn=conn, allow_negative=False)
-            await conn.execute("UPDATE bitcoin_orders SET status='cancelled' WHERE id=$1", order_id)
-            return True
+    async def _cancel(conn):
+        order = await conn.fetchrow("SELECT * FROM bitcoin_orders WHERE id=$1 AND user_id=$2 AND status='active' FOR UPDATE", order_id, user_id)
+        if not order:
+            return False
+        total_locked = float(order['total_locked'])
+        if order['type'] == 'sell':
+            await update_user_bitcoin(user_id, total_locked, conn=conn)
+        else:
+            await update_user_balance(user_id, total_locked, conn=conn, allow_negative=False)
+        await conn.execute("UPDATE bitcoin_orders SET status='cancelled' WHERE id=$1", order_id)
+        order_book.remove(order_id)
+        return True
+
+    return await run_exchange_operation(_cancel)
 
 # Новая функция для административной отмены любой заявки
 @db_retry()
 async def admin_cancel_bitcoin_order(order_id: int) -> bool:
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():
-            await conn.execute("SET LOCAL statement_timeout = '5s'")
-            order = await conn.fetchrow("SELECT * FROM bitcoin_orders WHERE id=$1 AND status='active' FOR UPDATE", order_id)
-            if not order:
-                return False
-            user_id = order['user_id']
-            total_locked = float(order['total_locked'])
-            if order['type'] == 'sell':
-                await update_user_bitcoin(user_id, total_locked, conn=conn)
-            else:
-                await update_user_balance(user_id, total_locked, conn=conn, allow_negative=False)
-            await conn.execute("UPDATE bitcoin_orders SET status='cancelled' WHERE id=$1", order_id)
-            return True
-
-async def match_orders(conn):
-    while True:
-        buy = await conn.fetchrow("""
-            SELECT id, user_id, price, amount, total_locked
-            FROM bitcoin_orders
-            WHERE type='buy' AND status='active'
-            ORDER BY price DESC, created_at ASC
-            LIMIT 1
-            FOR UPDATE SKIP LOCKED
-        """)
-        sell = await conn.fetchrow("""
-            SELECT id, user_id, price, amount, total_locked
-            FROM bitcoin_orders
-            WHERE type='sell' AND status='active'
-            ORDER BY price ASC, created_at ASC
-            LIMIT 1
-            FOR UPDATE SKIP LOCKED
-        """)
-        if not buy or not sell or buy['price'] < sell['price']:
-            break
-
-        buy_amount = float(buy['amount'])
-        buy_total_locked = float(buy['total_locked'])
-        sell_amount = float(sell['amount'])
-        sell_total_locked = float(sell['total_locked'])
-        trade_price = sell['price']
-
-        trade_amount = min(buy_amount, sell_amount)
-        total_cost = trade_amount * trade_price
-
-        buyer_id = buy['user_id']
-        seller_id = sell['user_id']
-
-        # Расчёт комиссии
-        commission_percent = await get_setting_float("exchange_commission_percent")
-        commission_side = await get_setting("exchange_commission_side")
-        commission_destination = await get_setting("exchange_commission_destination")
-        commission_amount = total_cost * commission_percent / 100
-
-        # Списание комиссии (проверяем успешность)
-        if commission_percent > 0:
-            if commission_side == 'buyer' or commission_side == 'both':
-                success, _, _ = await update_user_balance(buyer_id, -commission_amount, conn=conn, allow_negative=False)
-                if not success:
-                    # Если не удалось списать комиссию, откатываем сделку
-                    logging.error(f"Не удалось списать комиссию с покупателя {buyer_id} в сделке buy {buy['id']} и sell {sell['id']}")
-                    # Откат не требуется, так как ордера ещё не изменены
-                    # Просто пропускаем эту пару и продолжаем
-                    # Выйдем из цикла, чтобы не зависнуть
-                    break
-            if commission_side == 'seller' or commission_side == 'both':
-                success, _, _ = await update_user_balance(seller_id, -commission_amount, conn=conn, allow_negative=False)
-                if not success:
-                    logging.error(f"Не удалось списать комиссию с продавца {seller_id} в сделке buy {buy['id']} и sell {sell['id']}")
-                    # Откатываем уже списанную комиссию с покупателя, если была
-                    if commission_side == 'buyer' or commission_side == 'both':
-                        await update_user_balance(buyer_id, commission_amount, conn=conn, allow_negative=False)
-                    break
-            if commission_destination == 'burn':
-                # комиссия сгорает
-                pass
-            else:
-                # можно зачислять на баланс бота или админа (опционально)
-                pass
-
-        # Основной расчёт
-        await update_user_balance(seller_id, total_cost, conn=conn, allow_negative=False)
-        await update_user_bitcoin(buyer_id, trade_amount, conn=conn)
+    async def _cancel(conn):
+        order = await conn.fetchrow("SELECT * FROM bitcoin_orders WHERE id=$1 AND status='active' FOR UPDATE", order_id)
+        if not order:
+            return False
+        user_id = order['user_id']
+        total_locked = float(order['total_locked'])
+        if order['type'] == 'sell':
+            await update_user_bitcoin(user_id, total_locked, conn=conn)
+        else:
+            await update_user_balance(user_id, total_locked, conn=conn, allow_negative=False)
+        await conn.execute("UPDATE bitcoin_orders SET status='cancelled' WHERE id=$1", order_id)
+        order_book.remove(order_id)
+        return True
 
-        new_buy_amount = buy_amount - trade_amount
-        new_sell_amount = sell_amount - trade_amount
-        new_buy_locked = buy_total_locked - total_cost
-        new_sell_locked = sell_total_locked - trade_amount
+    return await run_exchange_operation(_cancel)
 
-        if new_buy_amount <= 0.0001:
-            await conn.execute("UPDATE bitcoin_orders SET status='completed', amount=0, total_locked=0 WHERE id=$1", buy['id'])
-        else:
-            await conn.execute("UPDATE bitcoin_orders SET amount=$1, total_locked=$2 WHERE id=$3", new_buy_amount, new_buy_locked, buy['id'])
+@db_retry()
+async def take_bitcoin_orders(user_id: int, side: str, price: int, amount: float) -> float:
+    """
+    Мгновенная сделка по цене из стакана: исполняет заявки стороны side на уровне price.
+    Возвращает исполненный объём BTC.
+    """
+    async def _take(conn):
+        batch = ExchangeBatch()
+        filled = order_book.take(batch, user_id, side, price, amount)
+        if filled <= 0:
+            raise ValueError("К сожалению, заявки по этой цене уже исполнены. Попробуйте снова.")
+        await flush_exchange_batch(conn, batch)
+        return filled
 
-        if new_sell_amount <= 0.0001:
-            await conn.execute("UPDATE bitcoin_orders SET status='completed', amount=0, total_locked=0 WHERE id=$1", sell['id'])
-        else:
-            await conn.execute("UPDATE bitcoin_orders SET amount=$1, total_locked=$2 WHERE id=$3", new_sell_amount, new_sell_locked, sell['id'])
+    return await run_exchange_operation(_take)
 
-        await conn.execute(
-            "INSERT INTO bitcoin_trades (buy_order_id, sell_order_id, amount, price, buyer_id, seller_id) VALUES ($1, $2, $3, $4, $5, $6)",
-            buy['id'], sell['id'], trade_amount, trade_price, buyer_id, seller_id
-        )
+async def match_orders(conn):
+    """Сводит заявки в стакане в памяти и записывает результат цикла одним запросом. Вызывается под order_book.lock."""
+    commission_percent = settings_snapshot.exchange_commission_percent
+    commission_side = settings_snapshot.exchange_commission_side
+    buyer_funds = None
+    if commission_percent > 0 and commission_side in ('buyer', 'both'):
+        buyer_ids = order_book.crossing_buyers()
+        if buyer_ids:
+            rows = await conn.fetch(
+                "SELECT user_id, balance FROM users WHERE user_id = ANY($1::bigint[]) ORDER BY user_id FOR UPDATE",
+                buyer_ids
+            )
+            buyer_funds = {r['user_id']: float(r['balance']) for r in rows}
+    batch = ExchangeBatch()
+    order_book.match(batch, commission_percent, commission_side, buyer_funds)
+    await flush_exchange_batch(conn, batch)
 
 # ==================== НОВЫЕ ФУНКЦИИ ДЛЯ СБРОСА СТАТИСТИКИ ====================
 @db_retry()
@@ -2977,7 +4749,10 @@ async def verify_reset_key(key: str, user_id: int) -> bool:
     return False
 
 @db_retry()
-async def reset_user_stats(user_id: int, conn=None):
+async def reset_user_stats(user_id: int):
+    """Сбрасывает статистику и снимает заявки пользователя (под блокировкой стакана, в одной транзакции)."""
+    invalidate_user_context(user_id)
+    touch_leaderboards(user_id)
     async def _reset(conn):
         await conn.execute("""
             UPDATE users SET
@@ -3022,15 +4797,12 @@ async def reset_user_stats(user_id: int, conn=None):
             WHERE user_id = $1
         """, user_id)
         await conn.execute("DELETE FROM user_tasks WHERE user_id = $1", user_id)
-        await conn.execute("UPDATE bitcoin_orders SET status='cancelled' WHERE user_id=$1 AND status='active'", user_id)
-        await conn.execute("DELETE FROM global_cooldowns WHERE user_id=$1", user_id)
+        cancelled = await conn.fetch("UPDATE bitcoin_orders SET status='cancelled' WHERE user_id=$1 AND status='active' RETURNING id", user_id)
+        for r in cancelled:
+            order_book.remove(r['id'])
+        await clear_user_cooldowns(user_id, conn=conn)
 
-    if conn:
-        await _reset(conn)
-    else:
-        async with db_pool.acquire() as new_conn:
-            async with new_conn.transaction():
-                await _reset(new_conn)
+    await run_exchange_operation(_reset)
 
 # ==================== НОВЫЕ ФУНКЦИИ ДЛЯ ЗАДАНИЙ ====================
 @db_retry()
@@ -3139,39 +4911,6 @@ async def activate_promocode(user_id: int, code: str) -> Tuple[bool, str]:
             )
             return True, f"✅ Промокод активирован! Вы получили {reward_text}"
 
-# ==================== ФУНКЦИИ ДЛЯ ВОССТАНОВЛЕНИЯ НАЛЁТОВ ====================
-@db_retry()
-async def recover_heists():
-    async with db_pool.acquire() as conn:
-        joining_heists = await conn.fetch(
-            "SELECT id, join_until FROM heists WHERE status='joining' AND join_until <= NOW()"
-        )
-        for h in joining_heists:
-            asyncio.create_task(finish_heist_joining(h['id'], h['join_until']))
-
-        splitting_heists = await conn.fetch(
-            "SELECT id, split_until FROM heists WHERE status='splitting' AND split_until <= NOW()"
-        )
-        for h in splitting_heists:
-            asyncio.create_task(process_betray_results(h['id'], h['split_until']))
-
-        active_joining = await conn.fetch(
-            "SELECT id, join_until FROM heists WHERE status='joining' AND join_until > NOW()"
-        )
-        for h in active_joining:
-            join_until = h['join_until']
-            asyncio.create_task(finish_heist_joining(h['id'], join_until))
-
-        active_splitting = await conn.fetch(
-            "SELECT id, split_until FROM heists WHERE status='splitting' AND split_until > NOW()"
-        )
-        for h in active_splitting:
-            split_until = h['split_until']
-            asyncio.create_task(process_betray_results(h['id'], split_until))
-
-    logging.info(f"Восстановлено {len(joining_heists)} просроченных и {len(active_joining)} активных налётов в сборе, "
-                 f"{len(splitting_heists)} просроченных и {len(active_splitting)} активных в распиле.")
-
 # ==================== ФУНКЦИИ ДЛЯ ПОЛУЧЕНИЯ ИНФОРМАЦИИ О ПОЛЬЗОВАТЕЛЕ ====================
 @db_retry()
 async def get_user_name(user_id: int, conn=None) -> str:
@@ -3180,9 +4919,11 @@ async def get_user_name(user_id: int, conn=None) -> str:
         return name or f"ID{user_id}"
     if conn:
         return await _get(conn)
-    else:
-        async with db_pool.acquire() as new_conn:
-            return await _get(new_conn)
+    row = get_context_user_row(user_id)
+    if row is not None:
+        return row['first_name'] or f"ID{user_id}"
+    async with db_pool.acquire() as new_conn:
+        return await _get(new_conn)
 
 @db_retry()
 async def get_user_username(user_id: int, conn=None) -> str:
@@ -3191,12 +4932,337 @@ async def get_user_username(user_id: int, conn=None) -> str:
         return username or "нет юзернейма"
     if conn:
         return await _get(conn)
+    row = get_context_user_row(user_id)
+    if row is not None:
+        return row['username'] or "нет юзернейма"
+    async with db_pool.acquire() as new_conn:
+        return await _get(new_conn)
+
+# ==================== ЛИДЕРБОРДЫ (ИНДЕКСЫ ТОПОВ) ====================
+def _desc_member(user_id: int) -> Tuple[int, ...]:
+    """Порядок равных очков как в Redis ZREVRANGE: по строке user_id, по убыванию."""
+    return tuple(-ord(c) for c in str(user_id)) + (1,)
+
+class SortedLeaderboard:
+    """
+    In-process индекс топа: отсортированный массив (-значение, ключ порядка, user_id) и словарь значений.
+    Страница, место пользователя и обновление — бинарным поиском; при равных очках порядок совпадает с Redis.
+    """
+
+    def __init__(self):
+        self.scores: Dict[int, float] = {}
+        self.keys: List[Tuple[float, Tuple[int, ...], int]] = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    @staticmethod
+    def _key(user_id: int, score: float):
+        return (-score, _desc_member(user_id), user_id)
+
+    def update(self, user_id: int, score: float):
+        old = self.scores.get(user_id)
+        if old == score:
+            return
+        if old is not None:
+            del self.keys[bisect.bisect_left(self.keys, self._key(user_id, old))]
+        self.scores[user_id] = score
+        bisect.insort(self.keys, self._key(user_id, score))
+
+    def replace_all(self, items: List[Tuple[int, float]]):
+        self.scores = dict(items)
+        self.keys = sorted(self._key(user_id, score) for user_id, score in items)
+
+    def page(self, offset: int, limit: int) -> List[Tuple[int, float]]:
+        return [(user_id, -neg) for neg, _, user_id in self.keys[offset:offset + limit]]
+
+    def rank(self, user_id: int) -> Optional[int]:
+        score = self.scores.get(user_id)
+        if score is None:
+            return None
+        return bisect.bisect_left(self.keys, self._key(user_id, score)) + 1
+
+local_leaderboards = {field: SortedLeaderboard() for field in LEADERBOARD_FIELDS}
+leaderboard_dirty: Dict[int, float] = {}  # user_id -> время последней отметки (monotonic)
+leaderboard_remote_dirty: Dict[int, float] = {}  # отметки других воркеров, пришедшие по NOTIFY (без Redis)
+leaderboard_announced: Dict[int, float] = {}  # какие локальные отметки уже разосланы другим воркерам
+leaderboards_ready = False
+
+def touch_leaderboards(*user_ids: int):
+    """
+    Отмечает пользователей, чьи значения в топах могли измениться (применяется фоново).
+    Отметка часто ставится внутри ещё открытой транзакции вызывающего, поэтому снимается
+    только чтением, начатым позже LEADERBOARD_COMMIT_GRACE секунд после неё.
+    """
+    now = time.monotonic()
+    for uid in user_ids:
+        leaderboard_dirty[uid] = now
+
+def _leaderboard_key(field: str) -> str:
+    return f"lb:{field}"
+
+def _leaderboard_values(row) -> Dict[str, float]:
+    return {field: float(row[field] or 0) for field in LEADERBOARD_FIELDS}
+
+async def _apply_leaderboard_rows(rows, full: bool = False):
+    if redis_client is not None:
+        pipe = redis_client.pipeline(transaction=False)
+        for field in LEADERBOARD_FIELDS:
+            key = _leaderboard_key(field)
+            target = f"{key}:rebuild:{os.getpid()}" if full else key
+            if full:
+                pipe.delete(target)
+            for i in range(0, len(rows), 5000):
+                chunk = rows[i:i + 5000]
+                if chunk:
+                    pipe.zadd(target, {str(r['user_id']): float(r[field] or 0) for r in chunk})
+            if full:
+                if rows:
+                    pipe.rename(target, key)
+                else:
+                    pipe.delete(key)
+        await pipe.execute()
+        return
+    if full:
+        for field in LEADERBOARD_FIELDS:
+            local_leaderboards[field].replace_all([(r['user_id'], float(r[field] or 0)) for r in rows])
     else:
-        async with db_pool.acquire() as new_conn:
-            return await _get(new_conn)
+        for r in rows:
+            for field, value in _leaderboard_values(r).items():
+                local_leaderboards[field].update(r['user_id'], value)
+
+@db_retry()
+async def rebuild_leaderboards():
+    """Полная пересборка индексов топов из таблицы users."""
+    global leaderboards_ready
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch(f"SELECT user_id, {', '.join(LEADERBOARD_FIELDS)} FROM users")
+    await _apply_leaderboard_rows(rows, full=True)
+    leaderboards_ready = True
+    update_theft_targets(rows, full=True)
+
+async def publish_leaderboard_marks(conn, user_ids: List[int]):
+    """NOTIFY об отмеченных пользователях: leaderboard:<воркер>:<id,...> (нужно только без Redis)."""
+    for i in range(0, len(user_ids), LEADERBOARD_NOTIFY_MAX_IDS):
+        ids = ",".join(map(str, user_ids[i:i + LEADERBOARD_NOTIFY_MAX_IDS]))
+        await conn.execute("SELECT pg_notify($1, $2)", CACHE_INVALIDATION_CHANNEL, f"leaderboard:{WORKER_ID}:{ids}")
+
+def apply_leaderboard_marks(key: str):
+    """
+    Обработчик области leaderboard: без Redis у каждого воркера свой индекс, поэтому чужие
+    отметки перечитываются и здесь. Пустой список (переподключение слушателя) — полная пересборка.
+    """
+    if redis_client is not None:
+        return
+    origin, _, ids = key.partition(":")
+    if origin == WORKER_ID:
+        return
+    if not ids:
+        if leaderboards_ready:
+            asyncio.create_task(rebuild_leaderboards())
+        return
+    now = time.monotonic()
+    for uid in ids.split(","):
+        if uid:
+            leaderboard_remote_dirty[int(uid)] = now
+
+@db_retry()
+async def flush_leaderboards():
+    """Перечитывает изменившихся пользователей и обновляет их позиции в индексах."""
+    if not leaderboard_dirty and not leaderboard_remote_dirty:
+        return
+    read_started = time.monotonic()
+    user_ids = list({**leaderboard_remote_dirty, **leaderboard_dirty})
+    # Новые локальные отметки рассылаются один раз; чужие обратно не пересылаются
+    fresh = {} if redis_client is not None else {
+        uid: touched for uid, touched in leaderboard_dirty.items() if leaderboard_announced.get(uid) != touched
+    }
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch(
+            f"SELECT user_id, {', '.join(LEADERBOARD_FIELDS)} FROM users WHERE user_id = ANY($1::bigint[])",
+            user_ids
+        )
+        if fresh:
+            await publish_leaderboard_marks(conn, list(fresh))
+            leaderboard_announced.update(fresh)
+    update_theft_targets(rows)
+    await _apply_leaderboard_rows(rows)
+    # Снимаем только отметки, которые это чтение гарантированно увидело после коммита;
+    # при ошибке выше отметки остаются и будут перечитаны в следующий раз
+    settled_before = read_started - LEADERBOARD_COMMIT_GRACE
+    for uid in user_ids:
+        for marks in (leaderboard_dirty, leaderboard_remote_dirty):
+            touched = marks.get(uid)
+            if touched is not None and touched <= settled_before:
+                del marks[uid]
+        if uid not in leaderboard_dirty:
+            leaderboard_announced.pop(uid, None)
+
+async def leaderboard_updater():
+    last_rebuild = time.time()
+    while True:
+        await asyncio.sleep(LEADERBOARD_FLUSH_INTERVAL)
+        try:
+            if time.time() - last_rebuild > LEADERBOARD_RESYNC_INTERVAL:
+                await rebuild_leaderboards()
+                last_rebuild = time.time()
+            else:
+                await flush_leaderboards()
+        except Exception as e:
+            logging.error(f"Ошибка обновления индексов топов: {e}")
+
+async def get_leaderboard_page(field: str, offset: int, limit: int) -> Tuple[List[Tuple[int, float]], int]:
+    """Страница топа [(user_id, значение)] и общее число участников."""
+    if field not in LEADERBOARD_FIELDS:
+        raise ValueError("Invalid leaderboard field")
+    if redis_client is not None and leaderboards_ready:
+        try:
+            key = _leaderboard_key(field)
+            entries = await redis_client.zrevrange(key, offset, offset + limit - 1, withscores=True)
+            total = await redis_client.zcard(key)
+            return [(int(member), score) for member, score in entries], total
+        except Exception as e:
+            logging.error(f"Ошибка чтения топа {field} из Redis: {e}")
+    elif redis_client is None and leaderboards_ready:
+        board = local_leaderboards[field]
+        return board.page(offset, limit), len(board)
+    # Индексы ещё не построены или Redis недоступен — читаем из БД
+    async with db_pool.acquire() as conn:
+        total = await conn.fetchval("SELECT COUNT(*) FROM users")
+        rows = await conn.fetch(
+            f"SELECT user_id, {field} AS value FROM users ORDER BY value DESC LIMIT $1 OFFSET $2",
+            limit, offset
+        )
+    return [(r['user_id'], float(r['value'] or 0)) for r in rows], total
+
+async def get_leaderboard_rank(field: str, user_id: int) -> Optional[int]:
+    """Место пользователя в топе (с 1) или None."""
+    if field not in LEADERBOARD_FIELDS:
+        raise ValueError("Invalid leaderboard field")
+    if redis_client is not None and leaderboards_ready:
+        try:
+            rank = await redis_client.zrevrank(_leaderboard_key(field), str(user_id))
+            return rank + 1 if rank is not None else None
+        except Exception as e:
+            logging.error(f"Ошибка чтения места в топе {field} из Redis: {e}")
+    elif redis_client is None and leaderboards_ready:
+        return local_leaderboards[field].rank(user_id)
+    async with db_pool.acquire() as conn:
+        return await conn.fetchval(
+            f"SELECT (SELECT COUNT(*) FROM users o WHERE o.{field} > u.{field}) + 1 FROM users u WHERE u.user_id=$1",
+            user_id
+        )
+
+@db_retry()
+async def get_first_names(user_ids: List[int]) -> Dict[int, str]:
+    if not user_ids:
+        return {}
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch("SELECT user_id, first_name FROM users WHERE user_id = ANY($1::bigint[])", user_ids)
+    return {r['user_id']: r['first_name'] for r in rows}
+
+# ==================== ИНДЕКС УЧАСТНИКОВ ЧАТОВ ====================
+chat_members_pending = {}              # (chat_id, user_id) -> время последнего сообщения, ждёт записи
+chat_members_seen = OrderedDict()      # (chat_id, user_id) -> когда last_seen последний раз уходил в БД
+
+def record_chat_member(chat_id: int, user_id: int):
+    """Запоминает автора сообщения в группе; запись в БД — пакетами в chat_members_flusher."""
+    key = (chat_id, user_id)
+    now = time.time()
+    seen = chat_members_seen.get(key)
+    if seen is not None and now - seen < CHAT_MEMBER_TOUCH_INTERVAL:
+        return
+    chat_members_pending[key] = now
+
+@db_retry()
+async def flush_chat_members():
+    if not chat_members_pending:
+        return
+    batch = list(chat_members_pending.items())
+    chat_members_pending.clear()
+    chat_ids = [chat_id for (chat_id, _), _ in batch]
+    user_ids = [user_id for (_, user_id), _ in batch]
+    seen_at = [datetime.fromtimestamp(ts, timezone.utc).replace(tzinfo=None) for _, ts in batch]
+    try:
+        async with db_pool.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO chat_members (chat_id, user_id, last_seen)
+                SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::timestamp[])
+                ON CONFLICT (chat_id, user_id) DO UPDATE SET last_seen = EXCLUDED.last_seen
+            """, chat_ids, user_ids, seen_at)
+    except Exception:
+        # Возвращаем пачку, чтобы повтор (db_retry или следующий цикл) её записал;
+        # более свежие отметки, пришедшие за это время, не затираем
+        for key, ts in batch:
+            if chat_members_pending.get(key, 0) < ts:
+                chat_members_pending[key] = ts
+        raise
+    for key, ts in batch:
+        chat_members_seen[key] = ts
+        chat_members_seen.move_to_end(key)
+    while len(chat_members_seen) > CHAT_MEMBERS_SEEN_MAX:
+        chat_members_seen.popitem(last=False)
+
+async def chat_members_flusher():
+    while True:
+        await asyncio.sleep(CHAT_MEMBERS_FLUSH_INTERVAL)
+        try:
+            await flush_chat_members()
+        except Exception as e:
+            logging.error(f"Ошибка записи chat_members: {e}")
+
+@db_retry()
+async def remove_chat_member(chat_id: int, user_id: int):
+    chat_members_pending.pop((chat_id, user_id), None)
+    chat_members_seen.pop((chat_id, user_id), None)
+    async with db_pool.acquire() as conn:
+        await conn.execute("DELETE FROM chat_members WHERE chat_id=$1 AND user_id=$2", chat_id, user_id)
+
+CHAT_TOP_FIELDS = ('balance', 'reputation')
+
+@db_retry()
+async def get_chat_leaderboard_page(chat_id: int, field: str, offset: int, limit: int) -> Tuple[List[Tuple[int, str, float]], int]:
+    """Страница топа участников чата [(user_id, имя, значение)] и их общее число."""
+    if field not in CHAT_TOP_FIELDS:
+        raise ValueError("Invalid chat top field")
+    async with db_pool.acquire() as conn:
+        total = await conn.fetchval("SELECT COUNT(*) FROM chat_members WHERE chat_id=$1", chat_id)
+        rows = await conn.fetch(f"""
+            SELECT u.user_id, u.first_name, u.{field} AS value
+            FROM chat_members cm
+            JOIN users u ON u.user_id = cm.user_id
+            WHERE cm.chat_id = $1
+            ORDER BY u.{field} DESC, u.user_id
+            LIMIT $2 OFFSET $3
+        """, chat_id, limit, offset)
+    return [(r['user_id'], r['first_name'], float(r['value'] or 0)) for r in rows], total
+
+@db_retry()
+async def get_chat_leaderboard_rank(chat_id: int, field: str, user_id: int) -> Optional[int]:
+    if field not in CHAT_TOP_FIELDS:
+        raise ValueError("Invalid chat top field")
+    async with db_pool.acquire() as conn:
+        return await conn.fetchval(f"""
+            SELECT (
+                SELECT COUNT(*) FROM chat_members cm JOIN users o ON o.user_id = cm.user_id
+                WHERE cm.chat_id = $1 AND o.{field} > me.{field}
+            ) + 1
+            FROM chat_members mc JOIN users me ON me.user_id = mc.user_id
+            WHERE mc.chat_id = $1 AND mc.user_id = $2
+        """, chat_id, user_id)
 
 # ==================== РЕГИСТРАЦИЯ МИДЛВАРЕЙ ====================
-dp.message.middleware(ThrottlingMiddleware(rate_limit=0.5))
+# Порядок важен: учёт участников чата -> троттлинг -> загрузка строки пользователя из БД
+throttling_middleware = ThrottlingMiddleware()
+user_context_middleware = UserContextLoaderMiddleware()
+dp.message.outer_middleware(ChatMembershipMiddleware())
+dp.message.outer_middleware(throttling_middleware)
+dp.message.outer_middleware(user_context_middleware)
+dp.callback_query.outer_middleware(throttling_middleware)
+dp.callback_query.outer_middleware(user_context_middleware)
+dispatch_index_middleware = DispatchIndexMiddleware()
+dp.message.outer_middleware(dispatch_index_middleware)
+dp.callback_query.outer_middleware(dispatch_index_middleware)
 dp.message.middleware(GlobalCooldownMiddleware())
 
 # ==================== КОНЕЦ ЧАСТИ 1.2 ====================
@@ -3210,7 +5276,7 @@ from typing import List, Dict, Tuple, Optional
 # ==================== ПЕРЕМЕЩЁННЫЙ ХЕНДЛЕР ПОКУПКИ (ИЗ ЧАСТИ 3.2) ====================
 # Он должен быть в самом начале части 2 после импортов
 
-@dp.callback_query(F.data.startswith("buyproduct_"))
+@callback_prefix("buyproduct_")
 async def buy_callback(callback: CallbackQuery):
     await callback.answer()
     user_id = callback.from_user.id
@@ -3262,7 +5328,7 @@ async def buy_callback(callback: CallbackQuery):
         )
         await callback.answer()  # один раз в самом конце
 
-        if await get_setting("chat_notify_big_purchase") == "1" and price >= BIG_PURCHASE_THRESHOLD:
+        if settings_snapshot.chat_notify_big_purchase == 1 and price >= BIG_PURCHASE_THRESHOLD:
             user = callback.from_user
             chat_phrase = f"🛒 {user.first_name} купил {name} за {price:.2f} баксов!"
             await notify_chats(chat_phrase)
@@ -3998,6 +6064,7 @@ def settings_categories_keyboard():
             [KeyboardButton(text="⚙️ Подгон")],
             [KeyboardButton(text="⚙️ Биткоин-биржа")],
             [KeyboardButton(text="⚙️ Автоудаление")],
+            [KeyboardButton(text="⚙️ Антиспам")],
             [KeyboardButton(text="⚙️ Прокачка навыков")],
             [KeyboardButton(text="⚙️ Контрабанда")],
             [KeyboardButton(text="⚙️ Тюрьма")],
@@ -4069,14 +6136,10 @@ from aiogram.exceptions import TelegramBadRequest
 
 # ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
 async def get_level_reward_coins(level: int) -> float:
-    async with db_pool.acquire() as conn:
-        val = await conn.fetchval("SELECT coins FROM level_rewards WHERE level=$1", level)
-        return float(val) if val else 0.0
+    return get_level_curve().reward(level)[0]
 
 async def get_level_reward_rep(level: int) -> int:
-    async with db_pool.acquire() as conn:
-        val = await conn.fetchval("SELECT reputation FROM level_rewards WHERE level=$1", level)
-        return val if val else 0
+    return get_level_curve().reward(level)[1]
 
 # ==================== ГЛОБАЛЬНЫЙ ОБРАБОТЧИК /cancel ====================
 @dp.message(Command("cancel"))
@@ -4092,7 +6155,7 @@ async def cmd_cancel(message: Message, state: FSMContext):
     await message.answer("❌ Действие отменено.", reply_markup=main_menu_keyboard(await is_admin(user_id)))
 
 # ==================== УНИВЕРСАЛЬНЫЙ ОБРАБОТЧИК КНОПКИ "НАЗАД" ====================
-@dp.message(F.text == "◀️ Назад")
+@button("◀️ Назад")
 async def universal_back_handler(message: Message, state: FSMContext):
     if message.chat.type != 'private':
         return
@@ -4254,7 +6317,7 @@ async def cmd_start(message: Message):
                                     referrer_id, user_id, datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"), False
                                 )
                                 await conn.execute("UPDATE referrals SET clicks = clicks + 1 WHERE referred_id=$1", user_id)
-                                await safe_send_message(referrer_id, f"🔗 Новый пользователь {message.from_user.first_name} зарегистрировался по вашей ссылке! Награда будет выдана после того, как он совершит {await get_setting('referral_required_thefts')} успешных ограблений.")
+                                await safe_send_message(referrer_id, f"🔗 Новый пользователь {message.from_user.first_name} зарегистрировался по вашей ссылке! Награда будет выдана после того, как он совершит {settings_snapshot.referral_required_thefts} успешных ограблений.")
             except:
                 pass
 
@@ -4318,14 +6381,15 @@ async def cmd_help_private(message: Message):
     await message.answer(text)
 
 # ==================== ПРОВЕРКА ПОДПИСКИ ====================
-@dp.callback_query(F.data == "check_sub")
+@callback_exact("check_sub")
 async def check_subscription_callback(callback: CallbackQuery):
     user_id = callback.from_user.id
     if await is_banned(user_id) and not await is_admin(user_id):
         await callback.answer("⛔ Вы заблокированы.", show_alert=True)
         return
     await ensure_user_exists(user_id, callback.from_user.username, callback.from_user.first_name)
-    ok, not_subscribed = await check_subscription(user_id)
+    # Пользователь только что подписался — кэш отрицательных ответов не используем
+    ok, not_subscribed = await check_subscription(user_id, force=True)
     if ok:
         await callback.message.delete()
         is_admin_user = await is_admin(user_id)
@@ -4338,12 +6402,37 @@ async def check_subscription_callback(callback: CallbackQuery):
         await callback.message.edit_reply_markup(reply_markup=subscription_inline(not_subscribed))
     await callback.answer()
 
-@dp.callback_query(F.data == "no_link")
+@callback_exact("no_link")
 async def no_link_callback(callback: CallbackQuery):
     await callback.answer("Ссылка отсутствует. Подпишись вручную.", show_alert=True)
 
+@dp.my_chat_member()
+async def bot_member_updated(event: ChatMemberUpdated):
+    """Отмечает пользователей, заблокировавших бота (и снявших блокировку), чтобы рассылки их пропускали."""
+    if event.chat.type != 'private':
+        return
+    blocked = event.new_chat_member.status == 'kicked'
+    try:
+        async with db_pool.acquire() as conn:
+            await conn.execute("UPDATE users SET bot_blocked=$1 WHERE user_id=$2", blocked, event.chat.id)
+    except Exception as e:
+        logging.error(f"Не удалось обновить bot_blocked для {event.chat.id}: {e}")
+
+@dp.chat_member()
+async def channel_member_updated(event: ChatMemberUpdated):
+    """Обновляет кэш подписок по событиям каналов и убирает вышедших из индекса участников групп."""
+    user_id = event.new_chat_member.user.id
+    subscribed = event.new_chat_member.status not in ['left', 'kicked']
+    if event.chat.type in ('group', 'supergroup'):
+        if not subscribed:
+            await remove_chat_member(event.chat.id, user_id)
+        return
+    cache_subscription(event.chat.id, user_id, subscribed)
+    if event.chat.username:
+        cache_subscription(f"@{event.chat.username}", user_id, subscribed)
+
 # ==================== ПРОФИЛЬ ====================
-@dp.message(F.text == "👤 Профиль")
+@button("👤 Профиль")
 async def profile_handler(message: Message):
     if message.chat.type != 'private':
         return
@@ -4416,13 +6505,13 @@ async def profile_handler(message: Message):
     defense = row['defense'] or 1
 
     neg_text = f" (долг: {neg:.2f})" if neg > 0 else ""
-    level_mult = await get_setting_float("level_multiplier")
+    level_mult = settings_snapshot.level_multiplier
     exp_needed = level * level_mult
     bar = progress_bar(exp, exp_needed, 10)
 
-    share_bonus = skill_share * await get_setting_int("skill_share_bonus_per_level")
-    luck_bonus = skill_luck * await get_setting_int("skill_luck_bonus_per_level")
-    betray_bonus = skill_betray * await get_setting_int("skill_betray_bonus_per_level")
+    share_bonus = skill_share * settings_snapshot.skill_share_bonus_per_level
+    luck_bonus = skill_luck * settings_snapshot.skill_luck_bonus_per_level
+    betray_bonus = skill_betray * settings_snapshot.skill_betray_bonus_per_level
 
     joined_str = joined if joined else 'неизвестно'
 
@@ -4453,7 +6542,7 @@ async def profile_handler(message: Message):
     await send_with_media(user_id, text, media_key='profile', reply_markup=main_menu_keyboard(await is_admin(user_id)))
 
 # ==================== УРОВЕНЬ ====================
-@dp.message(F.text == "📊 Уровень")
+@button("📊 Уровень")
 async def level_handler(message: Message):
     if message.chat.type != 'private':
         return
@@ -4467,7 +6556,7 @@ async def level_handler(message: Message):
         return
     level = await get_user_level(user_id)
     exp = await get_user_exp(user_id)
-    level_mult = await get_setting_float("level_multiplier")
+    level_mult = settings_snapshot.level_multiplier
     exp_needed = level * level_mult
     bar = progress_bar(exp, exp_needed, 10)
     next_coins = await get_level_reward_coins(level+1)
@@ -4483,7 +6572,7 @@ async def level_handler(message: Message):
     await message.answer(text, reply_markup=main_menu_keyboard(await is_admin(user_id)))
 
 # ==================== БОНУС ====================
-@dp.message(F.text == "🎁 Бонус")
+@button("🎁 Бонус")
 async def bonus_handler(message: Message):
     if message.chat.type != 'private':
         return
@@ -4514,6 +6603,9 @@ async def bonus_handler(message: Message):
         bonus = random.randint(3, 12)
         phrase = f"🎉 Отлично, лови +{bonus} баксов!"
 
+        invalidate_user_context(user_id)
+
+        touch_leaderboards(user_id)
         await conn.execute(
             "UPDATE users SET balance = balance + $1, last_bonus = $2 WHERE user_id=$3",
             bonus, now, user_id
@@ -4521,7 +6613,7 @@ async def bonus_handler(message: Message):
     await message.answer(phrase, reply_markup=main_menu_keyboard(await is_admin(user_id)))
 
 # ==================== ТОП ИГРОКОВ ====================
-@dp.message(F.text == "🏆 Топ игроков")
+@button("🏆 Топ игроков")
 async def leaderboard_menu(message: Message):
     if message.chat.type != 'private':
         return
@@ -4547,30 +6639,27 @@ async def leaderboard_menu(message: Message):
     )
     await message.answer("Выбери категорию топа:", reply_markup=kb)
 
-async def show_top(message: Message, field: str, title: str, page: int = 1):
+async def show_top(message: Message, field: str, title: str, page: int = 1, user_id: int = None):
     """Универсальная функция для отображения топа с пагинацией."""
     offset = (page - 1) * ITEMS_PER_PAGE
-    async with db_pool.acquire() as conn:
-        if field == 'bitcoin_balance':
-            order_expr = "bitcoin_balance"
-        else:
-            order_expr = field
-        total = await conn.fetchval("SELECT COUNT(*) FROM users")
-        rows = await conn.fetch(
-            f"SELECT first_name, {order_expr} as value FROM users ORDER BY value DESC LIMIT $1 OFFSET $2",
-            ITEMS_PER_PAGE, offset
-        )
-    if not rows:
+    entries, total = await get_leaderboard_page(field, offset, ITEMS_PER_PAGE)
+    if not entries:
         await message.answer("Нет данных.")
         return
+    names = await get_first_names([uid for uid, _ in entries])
     text = f"{title} (страница {page}):\n\n"
-    for idx, row in enumerate(rows, start=offset+1):
-        val = row['value']
+    for idx, (uid, val) in enumerate(entries, start=offset+1):
         if field == 'bitcoin_balance':
             val = f"{float(val):.4f}"
         elif field in ['balance', 'total_spent']:
             val = f"{float(val):.2f}"
-        text += f"{idx}. {row['first_name']} – {val}\n"
+        else:
+            val = int(val)
+        text += f"{idx}. {names.get(uid)} – {val}\n"
+    if user_id is not None:
+        rank = await get_leaderboard_rank(field, user_id)
+        if rank:
+            text += f"\nТвоё место: #{rank}"
     kb = []
     nav_buttons = []
     if page > 1:
@@ -4584,31 +6673,31 @@ async def show_top(message: Message, field: str, title: str, page: int = 1):
     else:
         await message.answer(text)
 
-@dp.message(F.text == "💰 Самые богатые")
+@button("💰 Самые богатые")
 async def top_rich_handler(message: Message):
-    await show_top(message, "balance", "💰 Самые богатые")
+    await show_top(message, "balance", "💰 Самые богатые", user_id=message.from_user.id)
 
-@dp.message(F.text == "💸 Транжиры")
+@button("💸 Транжиры")
 async def top_spenders_handler(message: Message):
-    await show_top(message, "total_spent", "💸 Транжиры")
+    await show_top(message, "total_spent", "💸 Транжиры", user_id=message.from_user.id)
 
-@dp.message(F.text == "🔫 Крадуны")
+@button("🔫 Крадуны")
 async def top_thieves_handler(message: Message):
-    await show_top(message, "theft_success", "🔫 Крадуны")
+    await show_top(message, "theft_success", "🔫 Крадуны", user_id=message.from_user.id)
 
-@dp.message(F.text == "⭐️ По репутации")
+@button("⭐️ По репутации")
 async def top_reputation_handler(message: Message):
-    await show_top(message, "reputation", "⭐️ По репутации")
+    await show_top(message, "reputation", "⭐️ По репутации", user_id=message.from_user.id)
 
-@dp.message(F.text == "₿ По биткоинам")
+@button("₿ По биткоинам")
 async def top_bitcoin_handler(message: Message):
-    await show_top(message, "bitcoin_balance", "₿ По биткоинам")
+    await show_top(message, "bitcoin_balance", "₿ По биткоинам", user_id=message.from_user.id)
 
-@dp.message(F.text == "📈 По уровню")
+@button("📈 По уровню")
 async def top_level_handler(message: Message):
-    await show_top(message, "level", "📈 По уровню")
+    await show_top(message, "level", "📈 По уровню", user_id=message.from_user.id)
 
-@dp.callback_query(F.data.startswith("top:"))
+@callback_prefix("top:")
 async def top_page_callback(callback: CallbackQuery):
     parts = callback.data.split(":")
     field = parts[1]
@@ -4622,11 +6711,11 @@ async def top_page_callback(callback: CallbackQuery):
         "level": "📈 По уровню",
     }
     title = titles.get(field, "Топ")
-    await show_top(callback.message, field, title, page)
+    await show_top(callback.message, field, title, page, user_id=callback.from_user.id)
     await callback.answer()
 
 # ==================== КАЗИНО ====================
-@dp.message(F.text == "🎰 Казино")
+@button("🎰 Казино")
 async def casino_menu(message: Message):
     if message.chat.type != 'private':
         return
@@ -4638,7 +6727,7 @@ async def casino_menu(message: Message):
     if not ok:
         await message.answer("❗️ Сначала подпишись на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
-    min_level = await get_setting_int("min_level_casino")
+    min_level = settings_snapshot.min_level_casino
     level = await get_user_level(user_id)
     if level < min_level:
         await message.answer(f"❌ Для доступа к казино нужен {min_level} уровень. Твой уровень: {level}")
@@ -4646,7 +6735,7 @@ async def casino_menu(message: Message):
     await send_with_media(user_id, "Выбери игру:", media_key='casino', reply_markup=casino_menu_keyboard())
 
 # ----- Кости -----
-@dp.message(F.text == "🎲 Кости")
+@button("🎲 Кости")
 async def dice_start(message: Message, state: FSMContext):
     if message.chat.type != 'private':
         return
@@ -4654,7 +6743,7 @@ async def dice_start(message: Message, state: FSMContext):
     if await is_banned(user_id) and not await is_admin(user_id):
         await message.answer("⛔ Вы заблокированы.")
         return
-    min_level = await get_setting_int("min_level_casino")
+    min_level = settings_snapshot.min_level_casino
     level = await get_user_level(user_id)
     if level < min_level:
         await message.answer(f"❌ Для этой игры нужен {min_level} уровень. Твой уровень: {level}")
@@ -4673,12 +6762,6 @@ async def dice_bet(message: Message, state: FSMContext):
         await casino_menu(message)
         return
 
-    ok, remaining = await check_global_cooldown(message.from_user.id, "dice")
-    if not ok:
-        await message.answer(f"⏳ Подожди ещё {remaining} сек.")
-        await state.clear()
-        return
-
     try:
         amount = float(message.text)
         if amount <= 0:
@@ -4689,9 +6772,9 @@ async def dice_bet(message: Message, state: FSMContext):
         return
     user_id = message.from_user.id
     balance = await get_user_balance(user_id)
-    min_bet = await get_setting_float("casino_min_bet")
-    max_bet = await get_setting_float("casino_max_bet")
-    max_input = await get_setting_float("max_input_number")
+    min_bet = settings_snapshot.casino_min_bet
+    max_bet = settings_snapshot.casino_max_bet
+    max_input = settings_snapshot.max_input_number
     if amount < min_bet:
         await message.answer(f"❌ Минимальная ставка {min_bet:.2f} бакса.")
         await state.clear()
@@ -4713,41 +6796,44 @@ async def dice_bet(message: Message, state: FSMContext):
         await casino_menu(message)
         return
 
+    # Кулдаун захватывается атомарно до расчёта ставки: параллельные запросы сюда не пройдут
+    ok, remaining = await try_acquire_cooldown(user_id, "dice")
+    if not ok:
+        await message.answer(f"⏳ Подожди ещё {remaining} сек.")
+        await state.clear()
+        return
+
     dice1 = random.randint(1, 6)
     dice2 = random.randint(1, 6)
     total = dice1 + dice2
 
-    win_chance = await get_setting_float("casino_win_chance")
+    win_chance = settings_snapshot.casino_win_chance
     win = random.random() * 100 <= win_chance
 
-    async with db_pool.acquire() as conn:
-        success, new_balance, _ = await update_user_balance(user_id, -amount, conn=conn, allow_negative=False)
-        if not success:
-            await message.answer("❌ Ошибка при списании ставки.")
-            await state.clear()
-            return
-        await update_user_game_stats(user_id, 'dice', win, conn=conn)
-        if win:
-            multiplier = 2.0
-            profit = amount * multiplier
-            await update_user_balance(user_id, profit, conn=conn, allow_negative=False)
-            exp = await get_setting_int("exp_per_dice_win")
-            phrase = f"🎲 {dice1} + {dice2} = {total} — Победа! +{profit:.2f} баксов!"
-        else:
-            exp = await get_setting_int("exp_per_dice_lose")
-            phrase = f"🎲 {dice1} + {dice2} = {total} — Проигрыш. -{amount:.2f} баксов."
-        level_up_msg = await add_exp(user_id, exp, conn=conn)
-        if level_up_msg:
-            asyncio.create_task(safe_send_message(user_id, level_up_msg))
+    if win:
+        multiplier = 2.0
+        profit = amount * multiplier
+        exp = settings_snapshot.exp_per_dice_win
+        phrase = f"🎲 {dice1} + {dice2} = {total} — Победа! +{profit:.2f} баксов!"
+    else:
+        profit = 0.0
+        exp = settings_snapshot.exp_per_dice_lose
+        phrase = f"🎲 {dice1} + {dice2} = {total} — Проигрыш. -{amount:.2f} баксов."
+    success, new_balance, level_up_msg = await settle_casino_bet(user_id, 'dice', amount, profit, win, exp)
+    if not success:
+        await message.answer("❌ Ошибка при списании ставки.")
+        await state.clear()
+        return
+    if level_up_msg:
+        asyncio.create_task(safe_send_message(user_id, level_up_msg))
 
     await save_last_bet(user_id, 'dice', amount)
-    await set_global_cooldown(user_id, "dice")
 
     await message.answer(phrase, reply_markup=repeat_bet_keyboard('dice'))
     await state.clear()
 
 # ----- Угадай число (с кнопками) -----
-@dp.message(F.text == "🔢 Угадай число")
+@button("🔢 Угадай число")
 async def guess_start(message: Message, state: FSMContext):
     if message.chat.type != 'private':
         return
@@ -4755,7 +6841,7 @@ async def guess_start(message: Message, state: FSMContext):
     if await is_banned(user_id) and not await is_admin(user_id):
         await message.answer("⛔ Вы заблокированы.")
         return
-    min_level = await get_setting_int("min_level_casino")
+    min_level = settings_snapshot.min_level_casino
     level = await get_user_level(user_id)
     if level < min_level:
         await message.answer(f"❌ Для этой игры нужен {min_level} уровень. Твой уровень: {level}")
@@ -4790,9 +6876,9 @@ async def guess_bet(message: Message, state: FSMContext):
         return
     user_id = message.from_user.id
     balance = await get_user_balance(user_id)
-    min_bet = await get_setting_float("casino_min_bet")
-    max_bet = await get_setting_float("casino_max_bet")
-    max_input = await get_setting_float("max_input_number")
+    min_bet = settings_snapshot.casino_min_bet
+    max_bet = settings_snapshot.casino_max_bet
+    max_input = settings_snapshot.max_input_number
     if amount < min_bet:
         await message.answer(f"❌ Минимальная ставка {min_bet:.2f}.")
         await state.clear()
@@ -4826,36 +6912,40 @@ async def guess_number_callback(callback: CallbackQuery, state: FSMContext):
     amount = data['amount']
     user_id = callback.from_user.id
 
-    win_chance = await get_setting_float("casino_win_chance")
+    # На шаге суммы была лишь предпроверка; кулдаун захватывается атомарно здесь, до расчёта
+    ok, remaining = await try_acquire_cooldown(user_id, "guess")
+    if not ok:
+        await callback.answer(f"⏳ Подожди ещё {remaining} сек.", show_alert=True)
+        await state.clear()
+        return
+
+    win_chance = settings_snapshot.casino_win_chance
     win = random.random() * 100 <= win_chance
 
     multiplier = 2.0
     rep_reward = 1
 
-    async with db_pool.acquire() as conn:
-        success, new_balance, _ = await update_user_balance(user_id, -amount, conn=conn, allow_negative=False)
-        if not success:
-            await callback.answer("❌ Ошибка при списании ставки.", show_alert=True)
-            await state.clear()
-            return
-        await update_user_game_stats(user_id, 'guess', win, conn=conn)
-        if win:
-            profit = amount * multiplier
-            await update_user_balance(user_id, profit, conn=conn, allow_negative=False)
-            await update_user_reputation(user_id, rep_reward, conn=conn)
-            exp = await get_setting_int("exp_per_guess_win")
-            phrase = f"🔢 Ты угадал! Было {guess}. Выигрыш: +{profit:.2f} баксов и +{rep_reward} репутации!"
-        else:
-            exp = await get_setting_int("exp_per_guess_lose")
-            secret = random.randint(1, 5)
-            phrase = f"🔢 Не угадал. Было {secret}. -{amount:.2f} баксов."
-        level_up_msg = await add_exp(user_id, exp, conn=conn)
-        if level_up_msg:
-            asyncio.create_task(safe_send_message(user_id, level_up_msg))
+    if win:
+        profit = amount * multiplier
+        exp = settings_snapshot.exp_per_guess_win
+        phrase = f"🔢 Ты угадал! Было {guess}. Выигрыш: +{profit:.2f} баксов и +{rep_reward} репутации!"
+    else:
+        profit = 0.0
+        exp = settings_snapshot.exp_per_guess_lose
+        secret = random.randint(1, 5)
+        phrase = f"🔢 Не угадал. Было {secret}. -{amount:.2f} баксов."
+    success, new_balance, level_up_msg = await settle_casino_bet(
+        user_id, 'guess', amount, profit, win, exp, reputation=rep_reward if win else 0
+    )
+    if not success:
+        await callback.answer("❌ Ошибка при списании ставки.", show_alert=True)
+        await state.clear()
+        return
+    if level_up_msg:
+        asyncio.create_task(safe_send_message(user_id, level_up_msg))
 
     bet_data = {'number': guess}
     await save_last_bet(user_id, 'guess', amount, bet_data)
-    await set_global_cooldown(user_id, "guess")
 
     await callback.message.edit_text(phrase, reply_markup=repeat_bet_keyboard('guess'))
     await state.clear()
@@ -4867,7 +6957,7 @@ async def guess_cancel(callback: CallbackQuery, state: FSMContext):
     await casino_menu(callback.message)
 
 # ----- Слоты -----
-@dp.message(F.text == "🍒 Слоты")
+@button("🍒 Слоты")
 async def slots_start(message: Message, state: FSMContext):
     if message.chat.type != 'private':
         return
@@ -4875,7 +6965,7 @@ async def slots_start(message: Message, state: FSMContext):
     if await is_banned(user_id) and not await is_admin(user_id):
         await message.answer("⛔ Вы заблокированы.")
         return
-    min_level = await get_setting_int("min_level_casino")
+    min_level = settings_snapshot.min_level_casino
     level = await get_user_level(user_id)
     if level < min_level:
         await message.answer(f"❌ Для этой игры нужен {min_level} уровень. Твой уровень: {level}")
@@ -4894,12 +6984,6 @@ async def slots_bet(message: Message, state: FSMContext):
         await casino_menu(message)
         return
 
-    ok, remaining = await check_global_cooldown(message.from_user.id, "slots")
-    if not ok:
-        await message.answer(f"⏳ Подожди ещё {remaining} сек.")
-        await state.clear()
-        return
-
     try:
         amount = float(message.text)
         if amount <= 0:
@@ -4910,9 +6994,9 @@ async def slots_bet(message: Message, state: FSMContext):
         return
     user_id = message.from_user.id
     balance = await get_user_balance(user_id)
-    min_bet = await get_setting_float("casino_min_bet")
-    max_bet = await get_setting_float("casino_max_bet")
-    max_input = await get_setting_float("max_input_number")
+    min_bet = settings_snapshot.casino_min_bet
+    max_bet = settings_snapshot.casino_max_bet
+    max_input = settings_snapshot.max_input_number
     if amount < min_bet:
         await message.answer(f"❌ Минимальная ставка {min_bet:.2f}.")
         await state.clear()
@@ -4934,6 +7018,13 @@ async def slots_bet(message: Message, state: FSMContext):
         await casino_menu(message)
         return
 
+    # Кулдаун захватывается атомарно до расчёта ставки: параллельные запросы сюда не пройдут
+    ok, remaining = await try_acquire_cooldown(user_id, "slots")
+    if not ok:
+        await message.answer(f"⏳ Подожди ещё {remaining} сек.")
+        await state.clear()
+        return
+
     anim = await message.answer("🍒 Запускаем слоты...")
     stages = [
         "🍒 | 🍋 | 🍊",
@@ -4945,7 +7036,7 @@ async def slots_bet(message: Message, state: FSMContext):
         await asyncio.sleep(0.3)
         await anim.edit_text(stage)
 
-    win_prob = await get_setting_float("slots_win_probability")
+    win_prob = settings_snapshot.slots_win_probability
     win = random.random() * 100 <= win_prob
     symbols = ['🍒', '🍋', '🍊', '7️⃣', '💎']
     result = [random.choice(symbols) for _ in range(3)]
@@ -4959,37 +7050,33 @@ async def slots_bet(message: Message, state: FSMContext):
 
     if win and result[0] == result[1] == result[2]:
         if result[0] == '7️⃣':
-            multiplier = await get_setting_float("slots_multiplier_seven")
+            multiplier = settings_snapshot.slots_multiplier_seven
         elif result[0] == '💎':
-            multiplier = await get_setting_float("slots_multiplier_diamond")
+            multiplier = settings_snapshot.slots_multiplier_diamond
         else:
-            multiplier = await get_setting_float("slots_multiplier_three")
+            multiplier = settings_snapshot.slots_multiplier_three
     elif win:
         multiplier = 2.0
     else:
         multiplier = 0
 
-    async with db_pool.acquire() as conn:
-        success, new_balance, _ = await update_user_balance(user_id, -amount, conn=conn, allow_negative=False)
-        if not success:
-            await message.answer("❌ Ошибка при списании ставки.")
-            await state.clear()
-            return
-        await update_user_game_stats(user_id, 'slots', win, conn=conn)
-        if win:
-            profit = amount * multiplier
-            await update_user_balance(user_id, profit, conn=conn, allow_negative=False)
-            exp = await get_setting_int("exp_per_slots_win")
-            phrase = f"🍒 {result_str} — Ура! Выигрыш x{multiplier:.1f}! +{profit:.2f} баксов!"
-        else:
-            exp = await get_setting_int("exp_per_slots_lose")
-            phrase = f"🍒 {result_str} — Не повезло. -{amount:.2f} баксов."
-        level_up_msg = await add_exp(user_id, exp, conn=conn)
-        if level_up_msg:
-            asyncio.create_task(safe_send_message(user_id, level_up_msg))
+    if win:
+        profit = amount * multiplier
+        exp = settings_snapshot.exp_per_slots_win
+        phrase = f"🍒 {result_str} — Ура! Выигрыш x{multiplier:.1f}! +{profit:.2f} баксов!"
+    else:
+        profit = 0.0
+        exp = settings_snapshot.exp_per_slots_lose
+        phrase = f"🍒 {result_str} — Не повезло. -{amount:.2f} баксов."
+    success, new_balance, level_up_msg = await settle_casino_bet(user_id, 'slots', amount, profit, win, exp)
+    if not success:
+        await message.answer("❌ Ошибка при списании ставки.")
+        await state.clear()
+        return
+    if level_up_msg:
+        asyncio.create_task(safe_send_message(user_id, level_up_msg))
 
     await save_last_bet(user_id, 'slots', amount)
-    await set_global_cooldown(user_id, "slots")
 
     await anim.edit_text(phrase, reply_markup=repeat_bet_keyboard('slots'))
     await state.clear()
@@ -5012,7 +7099,7 @@ from aiogram.exceptions import TelegramBadRequest
 # Все функции и переменные из частей 1-2 и 3.1 предполагаются доступными
 
 # ==================== РУЛЕТКА (продолжение казино) ====================
-@dp.message(F.text == "🎡 Рулетка")
+@button("🎡 Рулетка")
 async def roulette_start(message: Message, state: FSMContext):
     if message.chat.type != 'private':
         return
@@ -5020,7 +7107,7 @@ async def roulette_start(message: Message, state: FSMContext):
     if await is_banned(user_id) and not await is_admin(user_id):
         await message.answer("⛔ Вы заблокированы.")
         return
-    min_level = await get_setting_int("min_level_casino")
+    min_level = settings_snapshot.min_level_casino
     level = await get_user_level(user_id)
     if level < min_level:
         await message.answer(f"❌ Для этой игры нужен {min_level} уровень. Твой уровень: {level}")
@@ -5055,9 +7142,9 @@ async def roulette_bet_amount(message: Message, state: FSMContext):
         return
     user_id = message.from_user.id
     balance = await get_user_balance(user_id)
-    min_bet = await get_setting_float("casino_min_bet")
-    max_bet = await get_setting_float("casino_max_bet")
-    max_input = await get_setting_float("max_input_number")
+    min_bet = settings_snapshot.casino_min_bet
+    max_bet = settings_snapshot.casino_max_bet
+    max_input = settings_snapshot.max_input_number
     if amount < min_bet:
         await message.answer(f"❌ Минимальная ставка {min_bet:.2f}.")
         await state.clear()
@@ -5112,6 +7199,12 @@ async def process_roulette_bet(message: Message, state: FSMContext, user_id: int
     amount = data['amount']
     bet_type = data['bet_type']
     bet_number = data.get('number')
+    # На шаге суммы была лишь предпроверка; кулдаун захватывается атомарно здесь, до расчёта
+    ok, remaining = await try_acquire_cooldown(user_id, "roulette")
+    if not ok:
+        await message.answer(f"⏳ Подожди ещё {remaining} сек.")
+        await state.clear()
+        return
     anim = await message.answer("🎡 Крутим рулетку...")
     for _ in range(3):
         await asyncio.sleep(0.5)
@@ -5124,7 +7217,7 @@ async def process_roulette_bet(message: Message, state: FSMContext, user_id: int
     number = random.randint(0, 36)
     color = 'зелёное' if number == 0 else ('красное' if number % 2 == 0 else 'чёрное')
 
-    win_chance = await get_setting_float("roulette_win_chance")
+    win_chance = settings_snapshot.roulette_win_chance
     if bet_type == 'green':
         win_chance = 1 / 37 * 100
     elif bet_type == 'number':
@@ -5140,40 +7233,36 @@ async def process_roulette_bet(message: Message, state: FSMContext, user_id: int
     elif bet_type == 'green':
         win = win and color == 'зелёное'
 
-    async with db_pool.acquire() as conn:
-        success, new_balance, _ = await update_user_balance(user_id, -amount, conn=conn, allow_negative=False)
-        if not success:
-            await message.answer("❌ Ошибка при списании ставки.")
-            await state.clear()
-            return
-        await update_user_game_stats(user_id, 'roulette', win, conn=conn)
-        if win:
-            if bet_type == 'number':
-                multiplier = await get_setting_float("roulette_number_multiplier")
-            elif bet_type == 'green':
-                multiplier = await get_setting_float("roulette_green_multiplier")
-            else:
-                multiplier = await get_setting_float("roulette_color_multiplier")
-            profit = amount * multiplier
-            await update_user_balance(user_id, profit, conn=conn, allow_negative=False)
-            exp = await get_setting_int("exp_per_roulette_win")
-            phrase = f"🎡 Выпало {number} {color}! Ты выиграл {profit:.2f} баксов!"
+    if win:
+        if bet_type == 'number':
+            multiplier = settings_snapshot.roulette_number_multiplier
+        elif bet_type == 'green':
+            multiplier = settings_snapshot.roulette_green_multiplier
         else:
-            exp = await get_setting_int("exp_per_roulette_lose")
-            phrase = f"🎡 Выпало {number} {color}. Твоя ставка не сыграла. -{amount:.2f} баксов."
-        level_up_msg = await add_exp(user_id, exp, conn=conn)
-        if level_up_msg:
-            asyncio.create_task(safe_send_message(user_id, level_up_msg))
+            multiplier = settings_snapshot.roulette_color_multiplier
+        profit = amount * multiplier
+        exp = settings_snapshot.exp_per_roulette_win
+        phrase = f"🎡 Выпало {number} {color}! Ты выиграл {profit:.2f} баксов!"
+    else:
+        profit = 0.0
+        exp = settings_snapshot.exp_per_roulette_lose
+        phrase = f"🎡 Выпало {number} {color}. Твоя ставка не сыграла. -{amount:.2f} баксов."
+    success, new_balance, level_up_msg = await settle_casino_bet(user_id, 'roulette', amount, profit, win, exp)
+    if not success:
+        await message.answer("❌ Ошибка при списании ставки.")
+        await state.clear()
+        return
+    if level_up_msg:
+        asyncio.create_task(safe_send_message(user_id, level_up_msg))
 
     bet_data = {'bet_type': bet_type, 'number': bet_number}
     await save_last_bet(user_id, 'roulette', amount, bet_data)
-    await set_global_cooldown(user_id, "roulette")
 
     await anim.edit_text(phrase, reply_markup=repeat_bet_keyboard('roulette'))
     await state.clear()
 
 # ----- Повтор ставки -----
-@dp.callback_query(F.data.startswith("repeat_"))
+@callback_prefix("repeat_")
 async def repeat_bet_callback(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     game = callback.data.split("_")[1]
@@ -5202,6 +7291,12 @@ async def repeat_bet_callback(callback: CallbackQuery, state: FSMContext):
         await callback.answer("❌ Недостаточно баксов для повтора ставки.", show_alert=True)
         return
 
+    # Параллельные нажатия «повторить» (или другой воркер) пройдут предпроверку вместе — лочит только захват
+    ok, remaining = await try_acquire_cooldown(user_id, game)
+    if not ok:
+        await callback.answer(f"⏳ Подожди ещё {remaining} сек.", show_alert=True)
+        return
+
     chat_id = callback.message.chat.id
 
     if game == 'dice':
@@ -5216,73 +7311,67 @@ async def repeat_bet_callback(callback: CallbackQuery, state: FSMContext):
         number = bet_data.get('number')
         await process_roulette_repeat(user_id, amount, bet_type, number, chat_id)
     else:
+        await release_cooldown(user_id, game)
         await callback.answer("Нет данных для повтора.", show_alert=True)
         return
 
-    await set_global_cooldown(user_id, game)
-
 async def process_dice_repeat(user_id: int, amount: float, chat_id: int):
     dice1 = random.randint(1, 6)
     dice2 = random.randint(1, 6)
     total = dice1 + dice2
-    win_chance = await get_setting_float("casino_win_chance")
+    win_chance = settings_snapshot.casino_win_chance
     win = random.random() * 100 <= win_chance
 
-    async with db_pool.acquire() as conn:
-        success, new_balance, _ = await update_user_balance(user_id, -amount, conn=conn, allow_negative=False)
-        if not success:
-            await safe_send_message(chat_id, "❌ Ошибка при списании ставки.")
-            return
-        await update_user_game_stats(user_id, 'dice', win, conn=conn)
-        if win:
-            multiplier = 2.0
-            profit = amount * multiplier
-            await update_user_balance(user_id, profit, conn=conn, allow_negative=False)
-            exp = await get_setting_int("exp_per_dice_win")
-            phrase = f"🎲 {dice1} + {dice2} = {total} — Победа! +{profit:.2f} баксов!"
-        else:
-            exp = await get_setting_int("exp_per_dice_lose")
-            phrase = f"🎲 {dice1} + {dice2} = {total} — Проигрыш. -{amount:.2f} баксов."
-        level_up_msg = await add_exp(user_id, exp, conn=conn)
-        if level_up_msg:
-            asyncio.create_task(safe_send_message(user_id, level_up_msg))
+    if win:
+        multiplier = 2.0
+        profit = amount * multiplier
+        exp = settings_snapshot.exp_per_dice_win
+        phrase = f"🎲 {dice1} + {dice2} = {total} — Победа! +{profit:.2f} баксов!"
+    else:
+        profit = 0.0
+        exp = settings_snapshot.exp_per_dice_lose
+        phrase = f"🎲 {dice1} + {dice2} = {total} — Проигрыш. -{amount:.2f} баксов."
+    success, new_balance, level_up_msg = await settle_casino_bet(user_id, 'dice', amount, profit, win, exp)
+    if not success:
+        await safe_send_message(chat_id, "❌ Ошибка при списании ставки.")
+        return
+    if level_up_msg:
+        asyncio.create_task(safe_send_message(user_id, level_up_msg))
 
     await save_last_bet(user_id, 'dice', amount)
     await safe_send_message(chat_id, phrase, reply_markup=repeat_bet_keyboard('dice'))
 
 async def process_guess_repeat(user_id: int, amount: float, number: int, chat_id: int):
-    win_chance = await get_setting_float("casino_win_chance")
+    win_chance = settings_snapshot.casino_win_chance
     win = random.random() * 100 <= win_chance
     secret = random.randint(1, 5)
 
     multiplier = 2.0
     rep_reward = 1
 
-    async with db_pool.acquire() as conn:
-        success, new_balance, _ = await update_user_balance(user_id, -amount, conn=conn, allow_negative=False)
-        if not success:
-            await safe_send_message(chat_id, "❌ Ошибка при списании ставки.")
-            return
-        await update_user_game_stats(user_id, 'guess', win, conn=conn)
-        if win:
-            profit = amount * multiplier
-            await update_user_balance(user_id, profit, conn=conn, allow_negative=False)
-            await update_user_reputation(user_id, rep_reward, conn=conn)
-            exp = await get_setting_int("exp_per_guess_win")
-            phrase = f"🔢 Ты угадал! Было {secret}. Выигрыш: +{profit:.2f} баксов и +{rep_reward} репутации!"
-        else:
-            exp = await get_setting_int("exp_per_guess_lose")
-            phrase = f"🔢 Не угадал. Было {secret}. -{amount:.2f} баксов."
-        level_up_msg = await add_exp(user_id, exp, conn=conn)
-        if level_up_msg:
-            asyncio.create_task(safe_send_message(user_id, level_up_msg))
+    if win:
+        profit = amount * multiplier
+        exp = settings_snapshot.exp_per_guess_win
+        phrase = f"🔢 Ты угадал! Было {secret}. Выигрыш: +{profit:.2f} баксов и +{rep_reward} репутации!"
+    else:
+        profit = 0.0
+        exp = settings_snapshot.exp_per_guess_lose
+        phrase = f"🔢 Не угадал. Было {secret}. -{amount:.2f} баксов."
+    success, new_balance, level_up_msg = await settle_casino_bet(
+        user_id, 'guess', amount, profit, win, exp, reputation=rep_reward if win else 0
+    )
+    if not success:
+        await safe_send_message(chat_id, "❌ Ошибка при списании ставки.")
+        return
+    if level_up_msg:
+        asyncio.create_task(safe_send_message(user_id, level_up_msg))
 
     bet_data = {'number': number}
     await save_last_bet(user_id, 'guess', amount, bet_data)
     await safe_send_message(chat_id, phrase, reply_markup=repeat_bet_keyboard('guess'))
 
 async def process_slots_repeat(user_id: int, amount: float, chat_id: int):
-    win_prob = await get_setting_float("slots_win_probability")
+    win_prob = settings_snapshot.slots_win_probability
     win = random.random() * 100 <= win_prob
     symbols = ['🍒', '🍋', '🍊', '7️⃣', '💎']
     result = [random.choice(symbols) for _ in range(3)]
@@ -5296,33 +7385,30 @@ async def process_slots_repeat(user_id: int, amount: float, chat_id: int):
 
     if win and result[0] == result[1] == result[2]:
         if result[0] == '7️⃣':
-            multiplier = await get_setting_float("slots_multiplier_seven")
+            multiplier = settings_snapshot.slots_multiplier_seven
         elif result[0] == '💎':
-            multiplier = await get_setting_float("slots_multiplier_diamond")
+            multiplier = settings_snapshot.slots_multiplier_diamond
         else:
-            multiplier = await get_setting_float("slots_multiplier_three")
+            multiplier = settings_snapshot.slots_multiplier_three
     elif win:
         multiplier = 2.0
     else:
         multiplier = 0
 
-    async with db_pool.acquire() as conn:
-        success, new_balance, _ = await update_user_balance(user_id, -amount, conn=conn, allow_negative=False)
-        if not success:
-            await safe_send_message(chat_id, "❌ Ошибка при списании ставки.")
-            return
-        await update_user_game_stats(user_id, 'slots', win, conn=conn)
-        if win:
-            profit = amount * multiplier
-            await update_user_balance(user_id, profit, conn=conn, allow_negative=False)
-            exp = await get_setting_int("exp_per_slots_win")
-            phrase = f"🍒 {result_str} — Ура! Выигрыш x{multiplier:.1f}! +{profit:.2f} баксов!"
-        else:
-            exp = await get_setting_int("exp_per_slots_lose")
-            phrase = f"🍒 {result_str} — Не повезло. -{amount:.2f} баксов."
-        level_up_msg = await add_exp(user_id, exp, conn=conn)
-        if level_up_msg:
-            asyncio.create_task(safe_send_message(user_id, level_up_msg))
+    if win:
+        profit = amount * multiplier
+        exp = settings_snapshot.exp_per_slots_win
+        phrase = f"🍒 {result_str} — Ура! Выигрыш x{multiplier:.1f}! +{profit:.2f} баксов!"
+    else:
+        profit = 0.0
+        exp = settings_snapshot.exp_per_slots_lose
+        phrase = f"🍒 {result_str} — Не повезло. -{amount:.2f} баксов."
+    success, new_balance, level_up_msg = await settle_casino_bet(user_id, 'slots', amount, profit, win, exp)
+    if not success:
+        await safe_send_message(chat_id, "❌ Ошибка при списании ставки.")
+        return
+    if level_up_msg:
+        asyncio.create_task(safe_send_message(user_id, level_up_msg))
 
     await save_last_bet(user_id, 'slots', amount)
     await safe_send_message(chat_id, phrase, reply_markup=repeat_bet_keyboard('slots'))
@@ -5331,7 +7417,7 @@ async def process_roulette_repeat(user_id: int, amount: float, bet_type: str, nu
     spin = random.randint(0, 36)
     color = 'зелёное' if spin == 0 else ('красное' if spin % 2 == 0 else 'чёрное')
 
-    win_chance = await get_setting_float("roulette_win_chance")
+    win_chance = settings_snapshot.roulette_win_chance
     if bet_type == 'green':
         win_chance = 1 / 37 * 100
     elif bet_type == 'number':
@@ -5347,36 +7433,33 @@ async def process_roulette_repeat(user_id: int, amount: float, bet_type: str, nu
     elif bet_type == 'green':
         win = win and color == 'зелёное'
 
-    async with db_pool.acquire() as conn:
-        success, new_balance, _ = await update_user_balance(user_id, -amount, conn=conn, allow_negative=False)
-        if not success:
-            await safe_send_message(chat_id, "❌ Ошибка при списании ставки.")
-            return
-        await update_user_game_stats(user_id, 'roulette', win, conn=conn)
-        if win:
-            if bet_type == 'number':
-                multiplier = await get_setting_float("roulette_number_multiplier")
-            elif bet_type == 'green':
-                multiplier = await get_setting_float("roulette_green_multiplier")
-            else:
-                multiplier = await get_setting_float("roulette_color_multiplier")
-            profit = amount * multiplier
-            await update_user_balance(user_id, profit, conn=conn, allow_negative=False)
-            exp = await get_setting_int("exp_per_roulette_win")
-            phrase = f"🎡 Выпало {spin} {color}! Ты выиграл {profit:.2f} баксов!"
+    if win:
+        if bet_type == 'number':
+            multiplier = settings_snapshot.roulette_number_multiplier
+        elif bet_type == 'green':
+            multiplier = settings_snapshot.roulette_green_multiplier
         else:
-            exp = await get_setting_int("exp_per_roulette_lose")
-            phrase = f"🎡 Выпало {spin} {color}. Твоя ставка не сыграла. -{amount:.2f} баксов."
-        level_up_msg = await add_exp(user_id, exp, conn=conn)
-        if level_up_msg:
-            asyncio.create_task(safe_send_message(user_id, level_up_msg))
+            multiplier = settings_snapshot.roulette_color_multiplier
+        profit = amount * multiplier
+        exp = settings_snapshot.exp_per_roulette_win
+        phrase = f"🎡 Выпало {spin} {color}! Ты выиграл {profit:.2f} баксов!"
+    else:
+        profit = 0.0
+        exp = settings_snapshot.exp_per_roulette_lose
+        phrase = f"🎡 Выпало {spin} {color}. Твоя ставка не сыграла. -{amount:.2f} баксов."
+    success, new_balance, level_up_msg = await settle_casino_bet(user_id, 'roulette', amount, profit, win, exp)
+    if not success:
+        await safe_send_message(chat_id, "❌ Ошибка при списании ставки.")
+        return
+    if level_up_msg:
+        asyncio.create_task(safe_send_message(user_id, level_up_msg))
 
     bet_data = {'bet_type': bet_type, 'number': number}
     await save_last_bet(user_id, 'roulette', amount, bet_data)
     await safe_send_message(chat_id, phrase, reply_markup=repeat_bet_keyboard('roulette'))
 
 # ==================== УНИВЕРСИТЕТ (ПРОКАЧКА НАВЫКОВ) С ИСПРАВЛЕНИЯМИ ====================
-@dp.message(F.text == "🎓 Университет")
+@button("🎓 Университет")
 async def university_menu(message: Message):
     if message.chat.type != 'private':
         return
@@ -5390,13 +7473,13 @@ async def university_menu(message: Message):
         return
     skills = await get_user_skills(user_id)
     authority = await get_user_authority(user_id)
-    max_level = await get_setting_int("skill_max_level")
-    share_cost = await get_setting_int("skill_share_cost_per_level")
-    luck_cost = await get_setting_int("skill_luck_cost_per_level")
-    betray_cost = await get_setting_int("skill_betray_cost_per_level")
-    share_bonus = skills['skill_share'] * await get_setting_int("skill_share_bonus_per_level")
-    luck_bonus = skills['skill_luck'] * await get_setting_int("skill_luck_bonus_per_level")
-    betray_bonus = skills['skill_betray'] * await get_setting_int("skill_betray_bonus_per_level")
+    max_level = settings_snapshot.skill_max_level
+    share_cost = settings_snapshot.skill_share_cost_per_level
+    luck_cost = settings_snapshot.skill_luck_cost_per_level
+    betray_cost = settings_snapshot.skill_betray_cost_per_level
+    share_bonus = skills['skill_share'] * settings_snapshot.skill_share_bonus_per_level
+    luck_bonus = skills['skill_luck'] * settings_snapshot.skill_luck_bonus_per_level
+    betray_bonus = skills['skill_betray'] * settings_snapshot.skill_betray_bonus_per_level
     text = (
         f"🎓 Криминальный университет\n\n"
         f"Твой авторитет: {authority}\n\n"
@@ -5420,18 +7503,18 @@ async def university_menu(message: Message):
     kb.append([InlineKeyboardButton("◀️ Назад", callback_data="university_back")])
     await message.answer(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
 
-@dp.callback_query(F.data.startswith("upgrade_"))
+@callback_prefix("upgrade_")
 async def upgrade_skill_callback(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     skill = callback.data.split("_")[1]
     user_id = callback.from_user.id
     skills = await get_user_skills(user_id)
     current_level = skills[f'skill_{skill}']
-    max_level = await get_setting_int("skill_max_level")
+    max_level = settings_snapshot.skill_max_level
     if current_level >= max_level:
         await callback.answer("Уже максимальный уровень!", show_alert=True)
         return
-    cost = await get_setting_int(f"skill_{skill}_cost_per_level")
+    cost = settings_snapshot.get_int(f"skill_{skill}_cost_per_level")
     authority = await get_user_authority(user_id)
     if authority < cost:
         await callback.answer(f"Недостаточно авторитета. Нужно {cost}, у тебя {authority}.", show_alert=True)
@@ -5509,14 +7592,14 @@ async def upgrade_skill_confirm(message: Message, state: FSMContext):
     else:
         await message.answer("Введи 'да' или 'нет'.")
 
-@dp.callback_query(F.data == "university_back")
+@callback_exact("university_back")
 async def university_back(callback: CallbackQuery):
     await callback.answer()
     await callback.message.delete()
     await university_menu(callback.message)
 
 # ==================== МАГАЗИН ПОДАРКОВ (хендлер покупки перенесён в Часть 2) ====================
-@dp.message(F.text == "🛒 Магазин подарков")
+@button("🛒 Магазин подарков")
 async def shop_handler(message: Message):
     if message.chat.type != 'private':
         return
@@ -5566,14 +7649,14 @@ async def shop_handler(message: Message):
         kb.append(nav_buttons)
     await send_with_media(message.chat.id, text, media_key='shop', reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
 
-@dp.callback_query(F.data.startswith("shop_page_"))
+@callback_prefix("shop_page_")
 async def shop_page_callback(callback: CallbackQuery):
     await callback.answer()
     page = int(callback.data.split("_")[2])
     await shop_handler(callback.message)
 
 # ==================== МОИ ПОКУПКИ ====================
-@dp.message(F.text == "💰 Мои покупки")
+@button("💰 Мои покупки")
 async def my_purchases(message: Message):
     if message.chat.type != 'private':
         return
@@ -5630,14 +7713,14 @@ async def my_purchases(message: Message):
     else:
         await message.answer(text, reply_markup=main_menu_keyboard(await is_admin(user_id)))
 
-@dp.callback_query(F.data.startswith("mypurchases_page_"))
+@callback_prefix("mypurchases_page_")
 async def mypurchases_page_callback(callback: CallbackQuery):
     await callback.answer()
     page = int(callback.data.split("_")[2])
     await my_purchases(callback.message)
 
 # ==================== ПРОМОКОД ====================
-@dp.message(F.text == "🎟 Промокод")
+@button("🎟 Промокод")
 async def promo_handler(message: Message, state: FSMContext):
     if message.chat.type != 'private':
         return
@@ -5679,12 +7762,15 @@ async def perform_theft(message: Message, robber_id: int, victim_id: int, cost:
         await message.answer("❌ Этот пользователь заблокирован и не может быть ограблен.")
         return
 
+    cfg = settings_snapshot
+    invalidate_user_context(robber_id)
+    touch_leaderboards(robber_id)
     success_chance = await get_theft_success_chance(robber_id)
     defense_chance = await get_defense_chance(victim_id)
-    defense_penalty = await get_setting_int("theft_defense_penalty")
-    min_amount = await get_setting_float("min_theft_amount")
-    max_amount = await get_setting_float("max_theft_amount")
-    bitcoin_reward = await get_setting_int("bitcoin_per_theft")
+    defense_penalty = cfg.get_int("theft_defense_penalty")
+    min_amount = cfg.get_float("min_theft_amount")
+    max_amount = cfg.get_float("max_theft_amount")
+    bitcoin_reward = cfg.get_int("bitcoin_per_theft")
 
     async with db_pool.acquire() as conn:
         async with conn.transaction():
@@ -5719,14 +7805,11 @@ async def perform_theft(message: Message, robber_id: int, victim_id: int, cost:
                 await conn.execute("UPDATE users SET theft_protected = theft_protected + 1 WHERE user_id=$1", victim_id)
                 await conn.execute("UPDATE users SET last_theft_time = $1 WHERE user_id=$2", datetime.now(timezone.utc), robber_id)
 
-                exp_defense = await get_setting_int("exp_per_theft_defense")
-                level_up_msg_v = await add_exp(victim_id, exp_defense, conn=conn)
-                exp_fail = await get_setting_int("exp_per_theft_fail")
-                level_up_msg_r = await add_exp(robber_id, exp_fail, conn=conn)
-                if level_up_msg_v:
-                    asyncio.create_task(safe_send_message(victim_id, level_up_msg_v))
-                if level_up_msg_r:
-                    asyncio.create_task(safe_send_message(robber_id, level_up_msg_r))
+                exp_defense = cfg.get_int("exp_per_theft_defense")
+                exp_fail = cfg.get_int("exp_per_theft_fail")
+                level_ups = await add_exp_bulk([(victim_id, exp_defense), (robber_id, exp_fail)], conn)
+                for uid, level_up_msg in level_ups.items():
+                    asyncio.create_task(safe_send_message(uid, level_up_msg))
 
                 robber_phrase = f"🛡️ {victim_name} отразил атаку! Ты потерял {penalty} баксов."
                 victim_phrase = f"🛡️ Твоя защита сработала! {message.from_user.first_name} ничего не украл и потерял {penalty} баксов."
@@ -5749,19 +7832,19 @@ async def perform_theft(message: Message, robber_id: int, victim_id: int, cost:
                         await update_user_bitcoin(robber_id, float(bitcoin_reward), conn=conn)
                     await conn.execute("UPDATE users SET theft_attempts = theft_attempts + 1, theft_success = theft_success + 1 WHERE user_id=$1", robber_id)
 
-                    exp_success = await get_setting_int("exp_per_theft_success")
+                    exp_success = cfg.get_int("exp_per_theft_success")
                     level_up_msg_r = await add_exp(robber_id, exp_success, conn=conn)
                     if level_up_msg_r:
                         asyncio.create_task(safe_send_message(robber_id, level_up_msg_r))
 
-                    required_thefts = await get_setting_int("referral_required_thefts")
+                    required_thefts = cfg.get_int("referral_required_thefts")
                     new_success = await conn.fetchval("SELECT theft_success FROM users WHERE user_id=$1", robber_id)
                     if new_success >= required_thefts:
                         ref = await conn.fetchrow("SELECT referrer_id FROM referrals WHERE referred_id=$1 AND reward_given=FALSE", robber_id)
                         if ref:
                             referrer_id = ref['referrer_id']
-                            bonus_coins = await get_setting_float("referral_bonus")
-                            bonus_rep = await get_setting_int("referral_reputation")
+                            bonus_coins = cfg.get_float("referral_bonus")
+                            bonus_rep = cfg.get_int("referral_reputation")
                             await update_user_balance(referrer_id, bonus_coins, conn=conn, allow_negative=False)
                             await update_user_reputation(referrer_id, bonus_rep, conn=conn)
                             await conn.execute("UPDATE referrals SET reward_given=TRUE WHERE referred_id=$1", robber_id)
@@ -5774,7 +7857,7 @@ async def perform_theft(message: Message, robber_id: int, victim_id: int, cost:
                     await safe_send_message(victim_id, f"🔫 Вас ограбили! {message.from_user.first_name} украл {steal_amount:.2f} баксов.")
                 else:
                     await conn.execute("UPDATE users SET theft_attempts = theft_attempts + 1, theft_failed = theft_failed + 1 WHERE user_id=$1", robber_id)
-                    exp_fail = await get_setting_int("exp_per_theft_fail")
+                    exp_fail = cfg.get_int("exp_per_theft_fail")
                     level_up_msg_r = await add_exp(robber_id, exp_fail, conn=conn)
                     if level_up_msg_r:
                         asyncio.create_task(safe_send_message(robber_id, level_up_msg_r))
@@ -5782,7 +7865,7 @@ async def perform_theft(message: Message, robber_id: int, victim_id: int, cost:
                     await message.answer(phrase, reply_markup=main_menu_keyboard(await is_admin(robber_id)))
             else:
                 await conn.execute("UPDATE users SET theft_attempts = theft_attempts + 1, theft_failed = theft_failed + 1 WHERE user_id=$1", robber_id)
-                exp_fail = await get_setting_int("exp_per_theft_fail")
+                exp_fail = cfg.get_int("exp_per_theft_fail")
                 level_up_msg_r = await add_exp(robber_id, exp_fail, conn=conn)
                 if level_up_msg_r:
                     asyncio.create_task(safe_send_message(robber_id, level_up_msg_r))
@@ -5791,7 +7874,7 @@ async def perform_theft(message: Message, robber_id: int, victim_id: int, cost:
 
             await conn.execute("UPDATE users SET last_theft_time = $1 WHERE user_id=$2", datetime.now(timezone.utc), robber_id)
 
-@dp.message(F.text == "🔫 Ограбить")
+@button("🔫 Ограбить")
 async def theft_menu(message: Message):
     if message.chat.type != 'private':
         return
@@ -5806,12 +7889,12 @@ async def theft_menu(message: Message):
     phrase = "🔫 Выбери цель:"
     await send_with_media(user_id, phrase, media_key='theft', reply_markup=theft_choice_keyboard())
 
-@dp.message(F.text == "🎲 Случайная цель")
+@button("🎲 Случайная цель")
 async def theft_random(message: Message, state: FSMContext):
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    cooldown_minutes = await get_setting_int("theft_cooldown_minutes")
+    cooldown_minutes = settings_snapshot.theft_cooldown_minutes
     async with db_pool.acquire() as conn:
         last_time_str = await conn.fetchval("SELECT last_theft_time FROM users WHERE user_id=$1", user_id)
         if last_time_str:
@@ -5828,15 +7911,15 @@ async def theft_random(message: Message, state: FSMContext):
     if not target_id:
         await message.answer("😕 В игре пока нет других игроков.", reply_markup=main_menu_keyboard(await is_admin(user_id)))
         return
-    cost = await get_setting_float("random_attack_cost")
+    cost = settings_snapshot.random_attack_cost
     await perform_theft(message, user_id, target_id, cost)
 
-@dp.message(F.text == "👤 Выбрать пользователя")
+@button("👤 Выбрать пользователя")
 async def theft_choose_user(message: Message, state: FSMContext):
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
-    cooldown_minutes = await get_setting_int("theft_cooldown_minutes")
+    cooldown_minutes = settings_snapshot.theft_cooldown_minutes
     async with db_pool.acquire() as conn:
         last_time_str = await conn.fetchval("SELECT last_theft_time FROM users WHERE user_id=$1", user_id)
         if last_time_str:
@@ -5881,21 +7964,21 @@ async def theft_target_entered(message: Message, state: FSMContext):
         await state.clear()
         return
 
-    cost = await get_setting_float("targeted_attack_cost")
+    cost = settings_snapshot.targeted_attack_cost
     await perform_theft(message, robber_id, target_id, cost)
     await state.clear()
 
 # ==================== РЕФЕРАЛЬНАЯ ССЫЛКА ====================
-@dp.message(F.text == "🔗 Рефералка")
+@button("🔗 Рефералка")
 async def referral_link(message: Message):
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
     bot_username = (await bot.me()).username
     link = f"https://t.me/{bot_username}?start=ref{user_id}"
-    bonus_coins = await get_setting_float("referral_bonus")
-    bonus_rep = await get_setting_int("referral_reputation")
-    required_thefts = await get_setting_int("referral_required_thefts")
+    bonus_coins = settings_snapshot.referral_bonus
+    bonus_rep = settings_snapshot.referral_reputation
+    required_thefts = settings_snapshot.referral_required_thefts
 
     async with db_pool.acquire() as conn:
         clicks = await conn.fetchval("SELECT SUM(clicks) FROM referrals WHERE referrer_id=$1", user_id) or 0
@@ -5913,7 +7996,7 @@ async def referral_link(message: Message):
     await send_with_media(user_id, text, media_key='referral', reply_markup=main_menu_keyboard(await is_admin(user_id)))
 
 # ==================== ЗАДАНИЯ (ПОЛЬЗОВАТЕЛЬСКАЯ ЧАСТЬ) ====================
-@dp.message(F.text == "📋 Задания")
+@button("📋 Задания")
 async def tasks_user_menu(message: Message):
     if message.chat.type != 'private':
         return
@@ -5940,7 +8023,7 @@ async def tasks_user_menu(message: Message):
         kb.append([InlineKeyboardButton(text=f"📌 {row['name']}", callback_data=f"task_detail_{row['id']}")])
     await send_with_media(message.chat.id, text, media_key='tasks', reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
 
-@dp.callback_query(F.data.startswith("task_detail_"))
+@callback_prefix("task_detail_")
 async def task_detail_callback(callback: CallbackQuery):
     await callback.answer()
     task_id = int(callback.data.split("_")[2])
@@ -5975,7 +8058,7 @@ async def task_detail_callback(callback: CallbackQuery):
     else:
         await callback.message.edit_text(text, reply_markup=task_detail_keyboard(task_id, task['button_link']))
 
-@dp.callback_query(F.data.startswith("check_task_"))
+@callback_prefix("check_task_")
 async def check_task_callback(callback: CallbackQuery):
     await callback.answer()
     task_id = int(callback.data.split("_")[2])
@@ -6004,13 +8087,13 @@ async def check_task_callback(callback: CallbackQuery):
         else:
             await callback.answer("❌ Неподдерживаемый тип задания.", show_alert=True)
 
-@dp.callback_query(F.data == "tasks_back")
+@callback_exact("tasks_back")
 async def tasks_back_callback(callback: CallbackQuery):
     await callback.answer()
     await tasks_user_menu(callback.message)
 
 # ==================== БИЗНЕСЫ (ПОЛЬЗОВАТЕЛЬСКАЯ ЧАСТЬ) ====================
-@dp.message(F.text == "🏪 Мои бизнесы")
+@button("🏪 Мои бизнесы")
 async def my_businesses(message: Message):
     if message.chat.type != 'private':
         return
@@ -6024,7 +8107,7 @@ async def my_businesses(message: Message):
         return
 
     businesses = await get_user_businesses(user_id)
-    max_businesses = await get_setting_int("business_max_businesses")
+    max_businesses = settings_snapshot.business_max_businesses
 
     if not businesses:
         kb = InlineKeyboardMarkup(inline_keyboard=[
@@ -6047,7 +8130,7 @@ async def my_businesses(message: Message):
     kb = business_main_keyboard(businesses)
     await send_with_media(user_id, text, media_key='business', reply_markup=kb)
 
-@dp.callback_query(F.data == "buy_business_menu")
+@callback_exact("buy_business_menu")
 async def buy_business_menu(callback: CallbackQuery):
     await callback.answer()
     user_id = callback.from_user.id
@@ -6055,7 +8138,7 @@ async def buy_business_menu(callback: CallbackQuery):
     async with db_pool.acquire() as conn:
         owned = await conn.fetch("SELECT business_type_id FROM user_businesses WHERE user_id=$1", user_id)
         owned_ids = [r['business_type_id'] for r in owned]
-    max_businesses = await get_setting_int("business_max_businesses")
+    max_businesses = settings_snapshot.business_max_businesses
     available = [bt for bt in all_types if bt['id'] not in owned_ids]
 
     if not available:
@@ -6071,7 +8154,7 @@ async def buy_business_menu(callback: CallbackQuery):
     kb = business_buy_keyboard(available)
     await callback.message.edit_text(text, reply_markup=kb)
 
-@dp.callback_query(F.data.startswith("bizbuy_preview_"))
+@callback_prefix("bizbuy_preview_")
 async def bizbuy_preview(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     biz_type_id = int(callback.data.split("_")[2])
@@ -6087,7 +8170,7 @@ async def bizbuy_preview(callback: CallbackQuery, state: FSMContext):
         await callback.answer("❌ У тебя уже есть такой бизнес!", show_alert=True)
         return
 
-    max_businesses = await get_setting_int("business_max_businesses")
+    max_businesses = settings_snapshot.business_max_businesses
     async with db_pool.acquire() as conn:
         count = await conn.fetchval("SELECT COUNT(*) FROM user_businesses WHERE user_id=$1", user_id)
 
@@ -6128,7 +8211,7 @@ async def bizbuy_preview(callback: CallbackQuery, state: FSMContext):
     else:
         await callback.message.edit_text(text, reply_markup=kb)
 
-@dp.callback_query(F.data.startswith("bizbuy_confirm_"))
+@callback_prefix("bizbuy_confirm_")
 async def bizbuy_confirm(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     biz_type_id = int(callback.data.split("_")[2])
@@ -6159,7 +8242,7 @@ async def bizbuy_confirm(callback: CallbackQuery, state: FSMContext):
                     await state.clear()
                     return
 
-                max_businesses = await get_setting_int("business_max_businesses")
+                max_businesses = settings_snapshot.business_max_businesses
                 count = await conn.fetchval("SELECT COUNT(*) FROM user_businesses WHERE user_id=$1", user_id)
                 if count >= max_businesses:
                     await callback.answer(f"❌ Лимит бизнесов ({max_businesses}) исчерпан!", show_alert=True)
@@ -6183,13 +8266,13 @@ async def bizbuy_confirm(callback: CallbackQuery, state: FSMContext):
         await callback.answer("❌ Ошибка при покупке бизнеса.", show_alert=True)
     await state.clear()
 
-@dp.callback_query(F.data == "bizbuy_cancel")
+@callback_exact("bizbuy_cancel")
 async def bizbuy_cancel(callback: CallbackQuery):
     await callback.answer()
     await callback.message.delete()
     await my_businesses(callback.message)
 
-@dp.callback_query(F.data.startswith("biz_view_"))
+@callback_prefix("biz_view_")
 async def business_view(callback: CallbackQuery):
     await callback.answer()
     biz_id = int(callback.data.split("_")[2])
@@ -6208,8 +8291,8 @@ async def business_view(callback: CallbackQuery):
             await callback.answer("❌ Бизнес не найден", show_alert=True)
             return
 
-    collect_interval = await get_setting_int("business_collect_interval_minutes")
-    max_storage_hours = await get_setting_int("business_max_storage_hours")
+    collect_interval = settings_snapshot.business_collect_interval_minutes
+    max_storage_hours = settings_snapshot.business_max_storage_hours
 
     last_col = biz['last_collection']
     if last_col:
@@ -6266,7 +8349,7 @@ async def business_view(callback: CallbackQuery):
     else:
         await callback.message.edit_text(text, reply_markup=kb)
 
-@dp.callback_query(F.data.startswith("biz_collect_"))
+@callback_prefix("biz_collect_")
 async def business_collect(callback: CallbackQuery):
     await callback.answer()
     biz_id = int(callback.data.split("_")[2])
@@ -6281,7 +8364,7 @@ async def business_collect(callback: CallbackQuery):
 
     await business_view(callback)
 
-@dp.callback_query(F.data.startswith("biz_upgrade_"))
+@callback_prefix("biz_upgrade_")
 async def business_upgrade(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     biz_id = int(callback.data.split("_")[2])
@@ -6306,18 +8389,18 @@ async def upgrade_confirm(message: Message, state: FSMContext):
     else:
         await message.answer("Введи 'да' или 'нет'.")
 
-@dp.callback_query(F.data == "biz_back")
+@callback_exact("biz_back")
 async def business_back(callback: CallbackQuery):
     await callback.answer()
     await my_businesses(callback.message)
 
-@dp.callback_query(F.data == "biz_back_to_main")
+@callback_exact("biz_back_to_main")
 async def business_back_to_main(callback: CallbackQuery):
     await callback.answer()
     await my_businesses(callback.message)
 
 # ==================== БИТКОИН-БИРЖА (ПОЛЬЗОВАТЕЛЬСКАЯ ЧАСТЬ) С ИСПРАВЛЕНИЕМ ГОНОК ====================
-@dp.message(F.text == "💼 Биткоин-биржа")
+@button("💼 Биткоин-биржа")
 async def bitcoin_exchange_menu(message: Message):
     if message.chat.type != 'private':
         return
@@ -6331,7 +8414,7 @@ async def bitcoin_exchange_menu(message: Message):
         return
     await send_with_media(user_id, "💼 Биткоин-биржа: продавай и покупай BTC за баксы.", media_key='exchange', reply_markup=bitcoin_exchange_keyboard())
 
-@dp.message(F.text == "📊 Стакан заявок")
+@button("📊 Стакан заявок")
 async def exchange_order_book(message: Message):
     if message.chat.type != 'private':
         return
@@ -6353,29 +8436,17 @@ async def exchange_order_book(message: Message):
     text += "\nВыбери действие ниже:"
     await message.answer(text, reply_markup=order_book_keyboard(book))
 
-@dp.callback_query(F.data.startswith("buy_from_"))
+@callback_prefix("buy_from_")
 async def buy_from_price(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     price = int(callback.data.split("_")[2])
-    user_id = callback.from_user.id
-    # Добавляем FOR UPDATE при выборке
-    async with db_pool.acquire() as conn:
-        orders = await conn.fetch(
-            "SELECT * FROM bitcoin_orders WHERE type='sell' AND status='active' AND price=$1 ORDER BY created_at ASC FOR UPDATE",
-            price
-        )
+    await ensure_order_book_loaded()
+    orders = order_book.level_orders('sell', price)
     if not orders:
         await callback.answer("Заявок по этой цене больше нет.", show_alert=True)
         return
-    orders_list = []
-    total_available = 0.0
-    for o in orders:
-        d = dict(o)
-        d['amount'] = float(d['amount'])
-        d['total_locked'] = float(d['total_locked'])
-        orders_list.append(d)
-        total_available += d['amount']
-    await state.update_data(price=price, orders=orders_list, total_available=total_available)
+    total_available = sum(o['amount'] for o in orders)
+    await state.update_data(price=price, total_available=total_available)
     await callback.message.answer(
         f"📉 Продажа по цене {price} $/BTC. Доступно всего: {total_available:.4f} BTC.\n"
         f"Введи количество BTC, которое хочешь купить (можно дробное):",
@@ -6399,26 +8470,16 @@ async def buy_from_price_amount(message: Message, state: FSMContext):
         return
     data = await state.get_data()
     price = data['price']
-    # Снова выбираем с FOR UPDATE, чтобы убедиться в актуальности
-    async with db_pool.acquire() as conn:
-        orders = await conn.fetch(
-            "SELECT * FROM bitcoin_orders WHERE type='sell' AND status='active' AND price=$1 ORDER BY created_at ASC FOR UPDATE",
-            price
-        )
+    # Актуальный объём уровня берём из стакана в памяти
+    await ensure_order_book_loaded()
+    orders = order_book.level_orders('sell', price)
     if not orders:
         await message.answer("❌ К сожалению, заявки по этой цене уже исполнены. Попробуйте снова.")
         await state.clear()
         return
-    orders_list = []
-    total_available = 0.0
-    for o in orders:
-        d = dict(o)
-        d['amount'] = float(d['amount'])
-        d['total_locked'] = float(d['total_locked'])
-        orders_list.append(d)
-        total_available += d['amount']
+    total_available = sum(o['amount'] for o in orders)
 
-    min_amount = await get_setting_float("exchange_min_amount_btc")
+    min_amount = settings_snapshot.exchange_min_amount_btc
     if amount < min_amount:
         await message.answer(f"❌ Минимальное количество для покупки: {min_amount} BTC.")
         return
@@ -6432,66 +8493,30 @@ async def buy_from_price_amount(message: Message, state: FSMContext):
     if balance < total_cost:
         await message.answer(f"❌ Недостаточно баксов. Нужно {total_cost:.2f}.")
         return
-    max_input = await get_setting_float("max_input_number")
+    max_input = settings_snapshot.max_input_number
     if total_cost > max_input:
         await message.answer(f"❌ Сумма слишком большая (максимум {max_input:.2f}).")
         return
-    remaining = amount
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():
-            await conn.execute("SET LOCAL statement_timeout = '5s'")
-            for order in orders_list:
-                if remaining <= 0.0001:
-                    break
-                order_id = order['id']
-                seller_id = order['user_id']
-                order_amount = order['amount']
-                take = min(remaining, order_amount)
-                current = await conn.fetchrow("SELECT * FROM bitcoin_orders WHERE id=$1 AND status='active' FOR UPDATE", order_id)
-                if not current or float(current['amount']) < take - 0.0001:
-                    continue
-                success, _, _ = await update_user_balance(user_id, -take * price, conn=conn, allow_negative=False)
-                if not success:
-                    logging.error(f"Не удалось списать {take * price} у покупателя {user_id} при покупке BTC")
-                    continue
-                await update_user_bitcoin(user_id, take, conn=conn)
-                await update_user_balance(seller_id, take * price, conn=conn, allow_negative=False)
-                new_amount = float(current['amount']) - take
-                new_locked = float(current['total_locked']) - take
-                if new_amount <= 0.0001:
-                    await conn.execute("UPDATE bitcoin_orders SET status='completed', amount=0, total_locked=0 WHERE id=$1", order_id)
-                else:
-                    await conn.execute("UPDATE bitcoin_orders SET amount=$1, total_locked=$2 WHERE id=$3", new_amount, new_locked, order_id)
-                await conn.execute(
-                    "INSERT INTO bitcoin_trades (sell_order_id, amount, price, buyer_id, seller_id) VALUES ($1, $2, $3, $4, $5)",
-                    order_id, take, price, user_id, seller_id
-                )
-                remaining -= take
-    await message.answer(f"✅ Ты купил {amount:.4f} BTC за {total_cost:.2f} баксов.", reply_markup=bitcoin_exchange_keyboard())
+    try:
+        filled = await take_bitcoin_orders(user_id, 'sell', price, amount)
+    except ValueError as e:
+        await message.answer(f"❌ {e}")
+        await state.clear()
+        return
+    await message.answer(f"✅ Ты купил {filled:.4f} BTC за {filled * price:.2f} баксов.", reply_markup=bitcoin_exchange_keyboard())
     await state.clear()
 
-@dp.callback_query(F.data.startswith("sell_to_"))
+@callback_prefix("sell_to_")
 async def sell_to_price(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     price = int(callback.data.split("_")[2])
-    user_id = callback.from_user.id
-    async with db_pool.acquire() as conn:
-        orders = await conn.fetch(
-            "SELECT * FROM bitcoin_orders WHERE type='buy' AND status='active' AND price=$1 ORDER BY created_at ASC FOR UPDATE",
-            price
-        )
+    await ensure_order_book_loaded()
+    orders = order_book.level_orders('buy', price)
     if not orders:
         await callback.answer("Заявок по этой цене больше нет.", show_alert=True)
         return
-    orders_list = []
-    total_available = 0.0
-    for o in orders:
-        d = dict(o)
-        d['amount'] = float(d['amount'])
-        d['total_locked'] = float(d['total_locked'])
-        orders_list.append(d)
-        total_available += d['amount']
-    await state.update_data(price=price, orders=orders_list, total_available=total_available)
+    total_available = sum(o['amount'] for o in orders)
+    await state.update_data(price=price, total_available=total_available)
     await callback.message.answer(
         f"📈 Покупка по цене {price} $/BTC. Требуется всего: {total_available:.4f} BTC.\n"
         f"Введи количество BTC, которое хочешь продать (можно дробное):",
@@ -6515,25 +8540,15 @@ async def sell_to_price_amount(message: Message, state: FSMContext):
         return
     data = await state.get_data()
     price = data['price']
-    async with db_pool.acquire() as conn:
-        orders = await conn.fetch(
-            "SELECT * FROM bitcoin_orders WHERE type='buy' AND status='active' AND price=$1 ORDER BY created_at ASC FOR UPDATE",
-            price
-        )
+    await ensure_order_book_loaded()
+    orders = order_book.level_orders('buy', price)
     if not orders:
         await message.answer("❌ К сожалению, заявки по этой цене уже исполнены. Попробуйте снова.")
         await state.clear()
         return
-    orders_list = []
-    total_available = 0.0
-    for o in orders:
-        d = dict(o)
-        d['amount'] = float(d['amount'])
-        d['total_locked'] = float(d['total_locked'])
-        orders_list.append(d)
-        total_available += d['amount']
+    total_available = sum(o['amount'] for o in orders)
 
-    min_amount = await get_setting_float("exchange_min_amount_btc")
+    min_amount = settings_snapshot.exchange_min_amount_btc
     if amount < min_amount:
         await message.answer(f"❌ Минимальное количество для продажи: {min_amount} BTC.")
         return
@@ -6547,52 +8562,27 @@ async def sell_to_price_amount(message: Message, state: FSMContext):
         await message.answer(f"❌ Недостаточно BTC. У тебя {btc_balance:.4f} BTC.")
         return
     total_profit = amount * price
-    max_input = await get_setting_float("max_input_number")
+    max_input = settings_snapshot.max_input_number
     if total_profit > max_input:
         await message.answer(f"❌ Сумма слишком большая (максимум {max_input:.2f}).")
         return
-    remaining = amount
-    async with db_pool.acquire() as conn:
-        async with conn.transaction():
-            await conn.execute("SET LOCAL statement_timeout = '5s'")
-            for order in orders_list:
-                if remaining <= 0.0001:
-                    break
-                order_id = order['id']
-                buyer_id = order['user_id']
-                order_amount = order['amount']
-                take = min(remaining, order_amount)
-                current = await conn.fetchrow("SELECT * FROM bitcoin_orders WHERE id=$1 AND status='active' FOR UPDATE", order_id)
-                if not current or float(current['amount']) < take - 0.0001:
-                    continue
-                success, _ = await update_user_bitcoin(user_id, -take, conn=conn)
-                if not success:
-                    logging.error(f"Не удалось списать {take} BTC у продавца {user_id} при продаже BTC")
-                    continue
-                await update_user_balance(user_id, take * price, conn=conn, allow_negative=False)
-                await update_user_bitcoin(buyer_id, take, conn=conn)
-                new_amount = float(current['amount']) - take
-                new_locked = float(current['total_locked']) - take * price
-                if new_amount <= 0.0001:
-                    await conn.execute("UPDATE bitcoin_orders SET status='completed', amount=0, total_locked=0 WHERE id=$1", order_id)
-                else:
-                    await conn.execute("UPDATE bitcoin_orders SET amount=$1, total_locked=$2 WHERE id=$3", new_amount, new_locked, order_id)
-                await conn.execute(
-                    "INSERT INTO bitcoin_trades (buy_order_id, amount, price, buyer_id, seller_id) VALUES ($1, $2, $3, $4, $5)",
-                    order_id, take, price, buyer_id, user_id
-                )
-                remaining -= take
-    await message.answer(f"✅ Ты продал {amount:.4f} BTC за {total_profit:.2f} баксов.", reply_markup=bitcoin_exchange_keyboard())
+    try:
+        filled = await take_bitcoin_orders(user_id, 'buy', price, amount)
+    except ValueError as e:
+        await message.answer(f"❌ {e}")
+        await state.clear()
+        return
+    await message.answer(f"✅ Ты продал {filled:.4f} BTC за {filled * price:.2f} баксов.", reply_markup=bitcoin_exchange_keyboard())
     await state.clear()
 
-@dp.message(F.text == "📉 Продать BTC")
+@button("📉 Продать BTC")
 async def sell_bitcoin_start(message: Message, state: FSMContext):
     if message.chat.type != 'private':
         return
     user_id = message.from_user.id
     btc_balance = await get_user_bitcoin(user_id)
-    min_amount = await get_setting_float("exchange_min_amount_btc")
-    max_input = await get_setting_float("max_input_number")
+    min_amount = settings_snapshot.exchange_min_amount_btc
+    max_input = settings_snapshot.max_input_number
     await message.answer(
         f"У тебя {btc_balance:.4f} BTC.\n"
         f"Минимальная сумма заявки: {min_amount} BTC.\n"
@@ -6621,11 +8611,11 @@ async def sell_bitcoin_amount(message: Message, state: FSMContext):
     if btc_balance < amount - 0.0001:
         await message.answer(f"❌ Недостаточно BTC. У тебя {btc_balance:.4f} BTC.")
         return
-    min_amount = await get_setting_float("exchange_min_amount_btc")
+    min_amount = settings_snapshot.exchange_min_amount_btc
     if amount < min_amount:
         await message.answer(f"❌ Минимальное количество для продажи: {min_amount} BTC.")
         return
-    max_input = await get_setting_float("max_input_number")
+    max_input = settings_snapshot.max_input_number
     if amount > max_input:
         await message.answer(f"❌ Сумма слишком большая (максимум {max_input:.4f}).")
         return
@@ -6646,8 +8636,8 @@ async def sell_bitcoin_price(message: Message, state: FSMContext):
     except ValueError:
         await message.answer("❌ Введи целое положительное число.")
         return
-    min_price = await get_setting_int("exchange_min_price")
-    max_price = await get_setting_int("exchange_max_price")
+    min_price = settings_snapshot.exchange_min_price
+    max_price = settings_snapshot.exchange_max_price
     if price < min_price:
         await message.answer(f"❌ Цена не может быть меньше {min_price}.")
         return
@@ -6671,12 +8661,12 @@ async def sell_bitcoin_price(message: Message, state: FSMContext):
         await message.answer("❌ Ошибка при создании заявки.")
     await state.clear()
 
-@dp.message(F.text == "📈 Купить BTC")
+@button("📈 Купить BTC")
 async def buy_bitcoin_start(message: Message, state: FSMContext):
     if message.chat.type != 'private':
         return
-    min_amount = await get_setting_float("exchange_min_amount_btc")
-    max_input = await get_setting_float("max_input_number")
+    min_amount = settings_snapshot.exchange_min_amount_btc
+    max_input = settings_snapshot.max_input_number
     await message.answer(
         f"Минимальная сумма заявки: {min_amount} BTC.\n"
         f"Максимальная сумма заявки: {max_input:.4f} BTC.\n"
@@ -6699,11 +8689,11 @@ async def buy_bitcoin_amount(message: Message, state: FSMContext):
     except ValueError:
         await message.answer("❌ Введи положительное число (можно дробное).")
         return
-    min_amount = await get_setting_float("exchange_min_amount_btc")
+    min_amount = settings_snapshot.exchange_min_amount_btc
     if amount < min_amount:
         await message.answer(f"❌ Минимальное количество для покупки: {min_amount} BTC.")
         return
-    max_input = await get_setting_float("max_input_number")
+    max_input = settings_snapshot.max_input_number
     if amount > max_input:
         await message.answer(f"❌ Сумма слишком большая (максимум {max_input:.4f}).")
         return
@@ -6724,8 +8714,8 @@ async def buy_bitcoin_price(message: Message, state: FSMContext):
     except ValueError:
         await message.answer("❌ Введи целое положительное число.")
         return
-    min_price = await get_setting_int("exchange_min_price")
-    max_price = await get_setting_int("exchange_max_price")
+    min_price = settings_snapshot.exchange_min_price
+    max_price = settings_snapshot.exchange_max_price
     if price < min_price:
         await message.answer(f"❌ Цена не может быть меньше {min_price}.")
         return
@@ -6749,7 +8739,7 @@ async def buy_bitcoin_price(message: Message, state: FSMContext):
         await message.answer("❌ Ошибка при создании заявки.")
     await state.clear()
 
-@dp.message(F.text == "📋 Мои заявки")
+@button("📋 Мои заявки")
 async def my_orders(message: Message, page: int = 1):
     if message.chat.type != 'private':
         return
@@ -6776,7 +8766,7 @@ async def my_orders(message: Message, page: int = 1):
     kb = my_orders_keyboard(page_orders, page, total_pages)
     await message.answer("Твои активные заявки:", reply_markup=kb)
 
-@dp.callback_query(F.data.startswith("myorder_"))
+@callback_prefix("myorder_")
 async def my_order_detail(callback: CallbackQuery):
     await callback.answer()
     order_id = int(callback.data.split("_")[1])
@@ -6801,7 +8791,7 @@ async def my_order_detail(callback: CallbackQuery):
     ])
     await callback.message.edit_text(text, reply_markup=kb)
 
-@dp.callback_query(F.data.startswith("cancel_order_"))
+@callback_prefix("cancel_order_")
 async def cancel_order_callback(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     order_id = int(callback.data.split("_")[2])
@@ -6813,24 +8803,24 @@ async def cancel_order_callback(callback: CallbackQuery, state: FSMContext):
         await callback.answer("❌ Не удалось отменить заявку.", show_alert=True)
     await my_orders(callback.message)
 
-@dp.callback_query(F.data == "my_orders_back")
+@callback_exact("my_orders_back")
 async def my_orders_back(callback: CallbackQuery):
     await callback.answer()
     await my_orders(callback.message)
 
-@dp.callback_query(F.data.startswith("myorders_page_"))
+@callback_prefix("myorders_page_")
 async def myorders_page_callback(callback: CallbackQuery):
     await callback.answer()
     page = int(callback.data.split("_")[2])
     await my_orders(callback.message, page=page)
 
-@dp.callback_query(F.data == "exchange_back")
+@callback_exact("exchange_back")
 async def exchange_back(callback: CallbackQuery):
     await callback.answer()
     await bitcoin_exchange_menu(callback.message)
 
 # ==================== РОЗЫГРЫШИ (ПОЛЬЗОВАТЕЛЬСКАЯ ЧАСТЬ) ====================
-@dp.message(F.text == "🎁 Розыгрыши")
+@button("🎁 Розыгрыши")
 async def giveaways_user_menu(message: Message):
     if message.chat.type != 'private':
         return
@@ -6844,7 +8834,7 @@ async def giveaways_user_menu(message: Message):
         return
     await send_with_media(message.chat.id, "🎁 Розыгрыши:", media_key='giveaway', reply_markup=giveaways_user_keyboard())
 
-@dp.message(F.text == "📋 Активные розыгрыши")
+@button("📋 Активные розыгрыши")
 async def active_giveaways_user(message: Message, page: int = 1):
     if message.chat.type != 'private':
         return
@@ -6882,7 +8872,7 @@ async def active_giveaway_detail(callback: CallbackQuery):
             await callback.answer("Розыгрыш не найден или уже завершён.", show_alert=True)
             return
         participant = await conn.fetchval("SELECT 1 FROM participants WHERE user_id=$1 AND giveaway_id=$2", user_id, gw_id)
-        participants_count = await conn.fetchval("SELECT COUNT(*) FROM participants WHERE giveaway_id=$1", gw_id)
+    participants_count = gw['participants_count']
     end_str = gw['end_date'].strftime("%Y-%m-%d %H:%M") if gw['end_date'] else "не указано"
     text = (
         f"🎁 <b>{gw['prize']}</b>\n"
@@ -6898,46 +8888,71 @@ async def active_giveaway_detail(callback: CallbackQuery):
     else:
         await callback.message.edit_text(text, reply_markup=kb)
 
-@dp.callback_query(F.data.startswith("join_giveaway_"))
+@callback_prefix("join_giveaway_")
 async def join_giveaway(callback: CallbackQuery):
     await callback.answer()
     gw_id = int(callback.data.split("_")[2])
     user_id = callback.from_user.id
     async with db_pool.acquire() as conn:
-        status = await conn.fetchval("SELECT status FROM giveaways WHERE id=$1", gw_id)
-        if status != 'active':
-            await callback.answer("Розыгрыш уже завершён.", show_alert=True)
-            return
-        exists = await conn.fetchval("SELECT 1 FROM participants WHERE user_id=$1 AND giveaway_id=$2", user_id, gw_id)
-        if exists:
-            await callback.answer("Ты уже участвуешь.", show_alert=True)
-            return
-        await conn.execute("INSERT INTO participants (user_id, giveaway_id) VALUES ($1, $2)", user_id, gw_id)
+        async with conn.transaction():
+            # Блокировка строки розыгрыша: завершение не пропустит вступивших в этот момент
+            gw = await conn.fetchrow(
+                "SELECT status, condition_type, min_participants FROM giveaways WHERE id=$1 FOR UPDATE", gw_id
+            )
+            if not gw or gw['status'] != 'active':
+                await callback.answer("Розыгрыш уже завершён.", show_alert=True)
+                return
+            inserted = await conn.fetchval(
+                "INSERT INTO participants (user_id, giveaway_id) VALUES ($1, $2) ON CONFLICT DO NOTHING RETURNING 1",
+                user_id, gw_id
+            )
+            if not inserted:
+                await callback.answer("Ты уже участвуешь.", show_alert=True)
+                return
+            count = await conn.fetchval(
+                "UPDATE giveaways SET participants_count = participants_count + 1 WHERE id=$1 RETURNING participants_count",
+                gw_id
+            )
+    if gw['condition_type'] == 'participants' and count >= gw['min_participants']:
+        asyncio.create_task(complete_giveaway(gw_id))
+        await callback.answer("✅ Ты участвуешь в розыгрыше! Набрано нужное число участников — подводим итоги.", show_alert=True)
+        return
     await callback.answer("✅ Ты участвуешь в розыгрыше!", show_alert=True)
     await active_giveaway_detail(callback)
 
-@dp.callback_query(F.data.startswith("leave_giveaway_"))
+@callback_prefix("leave_giveaway_")
 async def leave_giveaway(callback: CallbackQuery):
     await callback.answer()
     gw_id = int(callback.data.split("_")[2])
     user_id = callback.from_user.id
     async with db_pool.acquire() as conn:
-        await conn.execute("DELETE FROM participants WHERE user_id=$1 AND giveaway_id=$2", user_id, gw_id)
+        async with conn.transaction():
+            status = await conn.fetchval("SELECT status FROM giveaways WHERE id=$1 FOR UPDATE", gw_id)
+            if status != 'active':
+                await callback.answer("Розыгрыш уже завершён.", show_alert=True)
+                return
+            deleted = await conn.fetchval(
+                "DELETE FROM participants WHERE user_id=$1 AND giveaway_id=$2 RETURNING 1", user_id, gw_id
+            )
+            if deleted:
+                await conn.execute(
+                    "UPDATE giveaways SET participants_count = GREATEST(participants_count - 1, 0) WHERE id=$1", gw_id
+                )
     await callback.answer("❌ Ты отказался от участия.", show_alert=True)
     await active_giveaway_detail(callback)
 
-@dp.callback_query(F.data == "active_gw_back")
+@callback_exact("active_gw_back")
 async def active_gw_back(callback: CallbackQuery):
     await callback.answer()
     await active_giveaways_user(callback.message)
 
-@dp.callback_query(F.data.startswith("active_gw_page_"))
+@callback_prefix("active_gw_page_")
 async def active_gw_page_callback(callback: CallbackQuery):
     await callback.answer()
     page = int(callback.data.split("_")[3])
     await active_giveaways_user(callback.message, page=page)
 
-@dp.message(F.text == "🏁 Завершённые розыгрыши")
+@button("🏁 Завершённые розыгрыши")
 async def completed_giveaways_user(message: Message, page: int = 1):
     if message.chat.type != 'private':
         return
@@ -6993,19 +9008,19 @@ async def completed_giveaway_detail(callback: CallbackQuery):
         await callback.message.edit_text(text)
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("completed_gw_page_"))
+@callback_prefix("completed_gw_page_")
 async def completed_gw_page_callback(callback: CallbackQuery):
     await callback.answer()
     page = int(callback.data.split("_")[3])
     await completed_giveaways_user(callback.message, page=page)
 
-@dp.callback_query(F.data == "completed_gw_back")
+@callback_exact("completed_gw_back")
 async def completed_gw_back(callback: CallbackQuery):
     await callback.answer()
     await completed_giveaways_user(callback.message)
 
 # ==================== НОВЫЕ ХЕНДЛЕРЫ ДЛЯ НАЛЁТОВ (В ЛС) ====================
-@dp.callback_query(F.data.startswith("betray_choice_"))
+@callback_prefix("betray_choice_")
 async def betray_choice_callback(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     parts = callback.data.split("_")
@@ -7106,34 +9121,41 @@ async def activate_chat_command(message: Message):
 @dp.message(F.chat.type.in_({'group', 'supergroup'}), F.text & ~F.text.startswith('/'))
 async def heist_keyword_handler(message: Message):
     """Обрабатывает ключевые слова налётов в чатах. При вводе кодового слова добавляет участника."""
-    if not await check_chat(message):
+    chat_id = message.chat.id
+    # Обычная переписка отсекается сверкой с реестром, без запросов к БД
+    active = await get_active_heist(chat_id)
+    if active is None or message.text.strip().upper() != active['keyword']:
         return
     user_id = message.from_user.id
+
+    if user_id in active['participants']:
+        if await can_delete_message(chat_id, message):
+            await message.delete()
+        await auto_delete_reply(message, "Ты уже в деле! Жди начала распила.")
+        return
+
+    if not await check_chat(message):
+        return
     if await is_banned(user_id) and not await is_admin(user_id):
         await auto_delete_command(message, "⛔ Вы заблокированы.")
         return
 
     await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
 
-    cooldown_hours = await get_setting_int("global_chat_cooldown_hours")
-    ok, remaining = await check_global_cooldown(user_id, "chat_activity", cooldown_hours * 3600)
+    cooldown_hours = settings_snapshot.global_chat_cooldown_hours
+    ok, remaining = await check_global_cooldown(user_id, "chat_activity")
     if not ok:
         await auto_delete_command(message, f"⏳ Глобальный кулдаун! Ты сможешь снова участвовать через {format_time_remaining(remaining)}")
         return
 
-    text = message.text.strip().upper()
-    chat_id = message.chat.id
-
     async with db_pool.acquire() as conn:
         async with conn.transaction():
             heist = await conn.fetchrow(
-                "SELECT * FROM heists WHERE chat_id=$1 AND status='joining' AND join_until > NOW()",
-                chat_id
+                "SELECT * FROM heists WHERE id=$1 AND status='joining' AND join_until > NOW() FOR UPDATE",
+                active['id']
             )
             if not heist:
-                return
-
-            if text != heist['keyword']:
+                unregister_active_heist(chat_id)
                 return
 
             if await can_delete_message(message.chat.id, message):
@@ -7144,11 +9166,12 @@ async def heist_keyword_handler(message: Message):
                 heist['id'], user_id
             )
             if exists:
+                active['participants'].add(user_id)
                 await auto_delete_reply(message, "Ты уже в деле! Жди начала распила.")
                 return
 
             # === ДОБАВЛЕНА ПРОВЕРКА МАКСИМАЛЬНОГО КОЛИЧЕСТВА УЧАСТНИКОВ ===
-            max_participants = await get_setting_int("heist_max_participants")
+            max_participants = settings_snapshot.heist_max_participants
             if max_participants > 0:
                 current_count = await conn.fetchval("SELECT COUNT(*) FROM heist_participants WHERE heist_id=$1", heist['id'])
                 if current_count >= max_participants:
@@ -7156,15 +9179,15 @@ async def heist_keyword_handler(message: Message):
                     return
             # =================================================================
 
-            participant_cooldown = await get_setting_int("heist_participant_cooldown_hours") * 3600
-            ok, remaining = await check_global_cooldown(user_id, "heist_participate", participant_cooldown)
+            participant_cooldown = settings_snapshot.heist_participant_cooldown_hours * 3600
+            ok, remaining = await check_global_cooldown(user_id, "heist_participate")
             if not ok:
                 await auto_delete_reply(message, f"⏳ Ты ещё не остыл после прошлого налёта. Подожди {format_time_remaining(remaining)}.")
                 return
 
             # Используем настройки для доли
-            share_min = await get_setting_int("heist_share_min")
-            share_max = await get_setting_int("heist_share_max")
+            share_min = settings_snapshot.heist_share_min
+            share_max = settings_snapshot.heist_share_max
             share = random.randint(share_min, share_max)
 
             # ИСПРАВЛЕНИЕ: не начисляем деньги на баланс, только увеличиваем банк налёта
@@ -7179,17 +9202,20 @@ async def heist_keyword_handler(message: Message):
                 "VALUES ($1, $2, $3, $3, 0, $4)",
                 heist['id'], user_id, share, datetime.now(timezone.utc)
             )
+            user_info = await conn.fetchrow("SELECT first_name FROM users WHERE user_id=$1", user_id)
 
-            await set_global_cooldown(user_id, "heist_participate", participant_cooldown)
-            # Устанавливаем глобальный кулдаун чата
-            await set_global_cooldown(user_id, "chat_activity", cooldown_hours * 3600)
+    # Кулдауны и реестр — только после коммита: при откате пользователь не должен остаться запертым
+    # (повторное вступление до этого момента отсекает блокировка налёта и проверка участия).
+    # Поэтому здесь не try_acquire_cooldown: отказы внутри транзакции не должны ставить кулдаун
+    active['participants'].add(user_id)
+    await set_global_cooldown(user_id, "heist_participate", participant_cooldown)
+    await set_global_cooldown(user_id, "chat_activity", cooldown_hours * 3600)
 
-            user_info = await conn.fetchrow("SELECT first_name FROM users WHERE user_id=$1", user_id)
-            name = user_info['first_name'] if user_info else f"ID{user_id}"
-            config = HEIST_TYPES[heist['event_type']]
-            phrase = get_random_phrase(config.get('phrases_join', ["✅ {name} присоединился к налёту!"]),
-                                      name=name)
-            await auto_delete_reply(message, phrase)
+    name = user_info['first_name'] if user_info else f"ID{user_id}"
+    config = HEIST_TYPES[heist['event_type']]
+    phrase = get_random_phrase(config.get('phrases_join', ["✅ {name} присоединился к налёту!"]),
+                              name=name)
+    await auto_delete_reply(message, phrase)
 
 # ==================== КОМАНДА /mlb_heist (СТАТУС НАЛЁТА) ====================
 @dp.message(Command("mlb_heist"))
@@ -7249,8 +9275,8 @@ async def cmd_smuggle(message: Message):
         await auto_delete_command(message, "❗️ Для использования контрабанды необходимо подписаться на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
 
-    cooldown_hours = await get_setting_int("global_chat_cooldown_hours")
-    ok, remaining = await check_global_cooldown(user_id, "chat_activity", cooldown_hours * 3600)
+    cooldown_hours = settings_snapshot.global_chat_cooldown_hours
+    ok, remaining = await check_global_cooldown(user_id, "chat_activity")
     if not ok:
         await auto_delete_command(message, f"⏳ Глобальный кулдаун! Подожди {format_time_remaining(remaining)}.")
         return
@@ -7264,28 +9290,37 @@ async def cmd_smuggle(message: Message):
             await auto_delete_command(message, "❌ Ты уже в рейсе. Дождись возвращения.")
             return
 
-    ok, remaining = await check_smuggle_cooldown(user_id)
+    # Кулдауны захватываются атомарно до записи рейса: параллельная команда или другой воркер сюда не пройдут
+    ok, remaining = await try_acquire_smuggle_cooldown(user_id)
     if not ok:
         minutes = remaining // 60
         seconds = remaining % 60
         await auto_delete_command(message, f"⏳ Ты ещё не вернулся из рейса. Подожди {minutes} мин {seconds} сек.")
         return
+    ok, remaining = await try_acquire_cooldown(user_id, "chat_activity", cooldown_hours * 3600)
+    if not ok:
+        await release_cooldown(user_id, "smuggle")
+        await auto_delete_command(message, f"⏳ Глобальный кулдаун! Подожди {format_time_remaining(remaining)}.")
+        return
 
-    min_dur = await get_setting_int("smuggle_min_duration")
-    max_dur = await get_setting_int("smuggle_max_duration")
+    min_dur = settings_snapshot.smuggle_min_duration
+    max_dur = settings_snapshot.smuggle_max_duration
     duration = random.randint(min_dur, max_dur)
     end_time = datetime.now(timezone.utc) + timedelta(minutes=duration)
     cargo_list = ["ящики с сигарами", "партия виски", "контрабандное оружие", "драгоценные камни", "золотые слитки"]
     cargo = random.choice(cargo_list)
 
-    async with db_pool.acquire() as conn:
-        run_id = await conn.fetchval(
-            "INSERT INTO smuggle_runs (user_id, start_time, end_time, chat_id) VALUES ($1, $2, $3, $4) RETURNING id",
-            user_id, datetime.now(timezone.utc), end_time, message.chat.id
-        )
-    await set_smuggle_cooldown(user_id, 0)
-    # Устанавливаем глобальный кулдаун чата
-    await set_global_cooldown(user_id, "chat_activity", cooldown_hours * 3600)
+    try:
+        async with db_pool.acquire() as conn:
+            run_id = await conn.fetchval(
+                "INSERT INTO smuggle_runs (user_id, start_time, end_time, chat_id) VALUES ($1, $2, $3, $4) RETURNING id",
+                user_id, datetime.now(timezone.utc), end_time, message.chat.id
+            )
+    except Exception:
+        await release_cooldown(user_id, "smuggle")
+        await release_cooldown(user_id, "chat_activity")
+        raise
+    schedule_deadline('smuggle', run_id, end_time)
 
     name = message.from_user.first_name
     phrase = get_random_phrase(SMUGGLE_START_PHRASES, name=name, cargo=cargo, duration=duration)
@@ -7293,7 +9328,7 @@ async def cmd_smuggle(message: Message):
     file_id = await get_media_file_id('smuggle_start')
     if file_id:
         sent = await bot.send_photo(message.chat.id, file_id, caption=phrase)
-        delete_seconds = int(await get_setting("auto_delete_commands_seconds"))
+        delete_seconds = settings_snapshot.auto_delete_commands_seconds
         asyncio.create_task(delete_after(sent, delete_seconds))
     else:
         await auto_delete_command(message, phrase)
@@ -7316,8 +9351,7 @@ async def cmd_jail(message: Message, state: FSMContext):
         await auto_delete_command(message, "❗️ Для использования тюрьмы необходимо подписаться на каналы.", reply_markup=subscription_inline(not_subscribed))
         return
 
-    cooldown_hours = await get_setting_int("global_chat_cooldown_hours")
-    ok, remaining = await check_global_cooldown(user_id, "chat_activity", cooldown_hours * 3600)
+    ok, remaining = await check_global_cooldown(user_id, "chat_activity")
     if not ok:
         await auto_delete_command(message, f"⏳ Глобальный кулдаун! Подожди {format_time_remaining(remaining)}.")
         return
@@ -7331,8 +9365,8 @@ async def cmd_jail(message: Message, state: FSMContext):
             await auto_delete_command(message, "❌ Ты уже отбываешь срок. Дождись окончания.")
             return
 
-    cooldown_hours_jail = await get_setting_int("jail_cooldown_hours")
-    ok, remaining = await check_global_cooldown(user_id, 'jail', cooldown_hours_jail * 3600)
+    cooldown_hours_jail = settings_snapshot.jail_cooldown_hours
+    ok, remaining = await check_global_cooldown(user_id, 'jail')
     if not ok:
         await auto_delete_command(message, f"⏳ В тюрьму можно попасть раз в {cooldown_hours_jail} ч. Осталось {format_time_remaining(remaining)}.")
         return
@@ -7394,15 +9428,35 @@ async def jail_article_message(message: Message, state: FSMContext):
     cell = data.get('cell')
     user_id = message.from_user.id
 
-    min_duration = await get_setting_int("jail_min_duration")
-    max_duration = await get_setting_int("jail_max_duration")
+    # В /mlb_jail была лишь предпроверка; кулдауны захватываются атомарно здесь, до записи срока
+    cooldown_hours_jail = settings_snapshot.jail_cooldown_hours
+    cooldown_hours = settings_snapshot.global_chat_cooldown_hours
+    ok, remaining = await try_acquire_cooldown(user_id, 'jail', cooldown_hours_jail * 3600)
+    if not ok:
+        await state.clear()
+        await message.answer(f"⏳ В тюрьму можно попасть раз в {cooldown_hours_jail} ч. Осталось {format_time_remaining(remaining)}.")
+        return
+    ok, remaining = await try_acquire_cooldown(user_id, "chat_activity", cooldown_hours * 3600)
+    if not ok:
+        await release_cooldown(user_id, 'jail')
+        await state.clear()
+        await message.answer(f"⏳ Глобальный кулдаун! Подожди {format_time_remaining(remaining)}.")
+        return
+
+    min_duration = settings_snapshot.jail_min_duration
+    max_duration = settings_snapshot.jail_max_duration
     duration = random.randint(min_duration, max_duration)
 
-    await start_jail_sentence(user_id, chat_id, duration, cell, article)
+    try:
+        await start_jail_sentence(user_id, chat_id, duration, cell, article)
+    except Exception:
+        await release_cooldown(user_id, 'jail')
+        await release_cooldown(user_id, "chat_activity")
+        raise
 
     # Проверка на золотой билет (1% шанс)
     if random.random() < 0.01:
-        gift_amount = await get_setting_float("golden_ticket_gift")
+        gift_amount = settings_snapshot.golden_ticket_gift
         await update_user_balance(user_id, gift_amount, allow_negative=False)
         await safe_send_chat(
             chat_id,
@@ -7413,13 +9467,6 @@ async def jail_article_message(message: Message, state: FSMContext):
     name = message.from_user.first_name
     phrase = get_random_phrase(JAIL_START_PHRASES, name=name, duration=duration)
 
-    cooldown_hours_jail = await get_setting_int("jail_cooldown_hours")
-    await set_global_cooldown(user_id, 'jail', cooldown_hours_jail * 3600)
-
-    # Устанавливаем глобальный кулдаун чата
-    cooldown_hours = await get_setting_int("global_chat_cooldown_hours")
-    await set_global_cooldown(user_id, "chat_activity", cooldown_hours * 3600)
-
     if chat_id:
         try:
             await safe_send_chat(chat_id, phrase)
@@ -7447,12 +9494,12 @@ async def cmd_chat_top(message: Message):
     await auto_delete_message(message)
 
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton("💰 По богатству", callback_data="chat_top_balance_1"),
-         InlineKeyboardButton("⭐️ По репутации", callback_data="chat_top_reputation_1")]
+        [InlineKeyboardButton(text="💰 По богатству", callback_data="chat_top_balance_1"),
+         InlineKeyboardButton(text="⭐️ По репутации", callback_data="chat_top_reputation_1")]
     ])
     await auto_delete_reply(message, "🏆 Выбери категорию топа:", reply_markup=kb)
 
-@dp.callback_query(F.data.startswith("chat_top_"))
+@callback_prefix("chat_top_")
 async def chat_top_callback(callback: CallbackQuery):
     await callback.answer()
     parts = callback.data.split("_")
@@ -7461,37 +9508,42 @@ async def chat_top_callback(callback: CallbackQuery):
 
     offset = (page - 1) * ITEMS_PER_PAGE
     if category == "balance":
-        order_field = "balance"
-        title = "💰 Самые богатые"
-    else:
-        order_field = "reputation"
-        title = "⭐️ По репутации"
-
-    async with db_pool.acquire() as conn:
-        total = await conn.fetchval("SELECT COUNT(*) FROM users")
-        rows = await conn.fetch(
-            f"SELECT first_name, {order_field} as value FROM users ORDER BY value DESC LIMIT $1 OFFSET $2",
-            ITEMS_PER_PAGE, offset
-        )
+        order_field = "balance"
+        title = "💰 Самые богатые"
+    else:
+        order_field = "reputation"
+        title = "⭐️ По репутации"
 
-    if not rows:
+    chat_id = callback.message.chat.id
+    if callback.message.chat.type == 'private':
+        entries, total = await get_leaderboard_page(order_field, offset, ITEMS_PER_PAGE)
+        names = await get_first_names([uid for uid, _ in entries])
+        entries = [(uid, names.get(uid), val) for uid, val in entries]
+        rank = await get_leaderboard_rank(order_field, callback.from_user.id)
+    else:
+        # Топ только по участникам этого чата; свежие записи сначала сбрасываем в БД
+        await flush_chat_members()
+        entries, total = await get_chat_leaderboard_page(chat_id, order_field, offset, ITEMS_PER_PAGE)
+        rank = await get_chat_leaderboard_rank(chat_id, order_field, callback.from_user.id)
+    if not entries:
         await callback.message.edit_text("Нет данных.")
         return
 
     text = f"{title} (страница {page}):\n\n"
-    for idx, row in enumerate(rows, start=offset+1):
-        val = row['value']
+    for idx, (uid, name, val) in enumerate(entries, start=offset+1):
         if category == "balance":
             val = f"{float(val):.2f} $"
         else:
-            val = f"{val} ⭐"
-        text += f"{idx}. {row['first_name']} – {val}\n"
+            val = f"{int(val)} ⭐"
+        text += f"{idx}. {name} – {val}\n"
+    if rank:
+        text += f"\nТвоё место: #{rank}"
 
     nav = []
     if page > 1:
-        nav.append(InlineKeyboardButton("⬅️", callback_data=f"chat_top_{category}_{page-1}"))
+        nav.append(InlineKeyboardButton(text="⬅️", callback_data=f"chat_top_{category}_{page-1}"))
     if offset + ITEMS_PER_PAGE < total:
-        nav.append(InlineKeyboardButton("➡️", callback_data=f"chat_top_{category}_{page+1}"))
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=f"chat_top_{category}_{page+1}"))
 
     kb = InlineKeyboardMarkup(inline_keyboard=[nav] if nav else [])
     await callback.message.edit_text(text, reply_markup=kb)
@@ -7562,7 +9614,7 @@ async def cmd_my_heist(message: Message):
         await auto_delete_reply(message, text)
 
 # ==================== ПОДГОН (GIFT) В ЧАТЕ ====================
-@dp.message(F.text == "🎁 Подгон")
+@button("🎁 Подгон")
 async def chat_gift(message: Message):
     if not await check_chat(message):
         return
@@ -7573,18 +9625,18 @@ async def chat_gift(message: Message):
 
     await ensure_user_exists(user_id, message.from_user.username, message.from_user.first_name)
 
-    cooldown_hours = await get_setting_int("global_chat_cooldown_hours")
-    ok, remaining = await check_global_cooldown(user_id, "chat_activity", cooldown_hours * 3600)
+    cooldown_hours = settings_snapshot.global_chat_cooldown_hours
+    ok, remaining = await check_global_cooldown(user_id, "chat_activity")
     if not ok:
         await auto_delete_command(message, f"⏳ Глобальный кулдаун! Подожди {format_time_remaining(remaining)}.")
         return
 
     await auto_delete_message(message)
 
-    gift_amount = await get_setting_float("gift_amount")
-    gift_limit_per_chat = await get_setting_int("gift_limit_per_day")
-    gift_global_limit = await get_setting_int("gift_global_limit_per_user")
-    gift_cooldown = await get_setting_int("gift_cooldown")
+    gift_amount = settings_snapshot.gift_amount
+    gift_limit_per_chat = settings_snapshot.gift_limit_per_day
+    gift_global_limit = settings_snapshot.gift_global_limit_per_user
+    gift_cooldown = settings_snapshot.gift_cooldown
     today_date = date.today()
     now = datetime.now(timezone.utc)
 
@@ -7598,13 +9650,8 @@ async def chat_gift(message: Message):
 
     # Фильтруем: исключаем самого пользователя, бота, и забаненных
     admin_ids = [a.user.id for a in admins if a.user.id != user_id and a.user.id != bot.id]
-    # Проверяем, кто из них забанен (один запрос)
-    banned_ids = []
-    if admin_ids:
-        async with db_pool.acquire() as conn:
-            rows = await conn.fetch("SELECT user_id FROM banned_users WHERE user_id = ANY($1)", admin_ids)
-            banned_ids = [r['user_id'] for r in rows]
-    eligible_ids = [uid for uid in admin_ids if uid not in banned_ids]
+    # Исключаем забаненных (проверка по кэшу в памяти)
+    eligible_ids = [uid for uid in admin_ids if not await is_banned(uid)]
 
     if not eligible_ids:
         await auto_delete_reply(message, "❌ Нет подходящих получателей для подарка.")
@@ -7647,6 +9694,13 @@ async def chat_gift(message: Message):
                     await auto_delete_reply(message, f"⏳ Подгон можно будет использовать через {remaining_minutes} мин.")
                     return
 
+            # Все отказы позади: кулдаун захватывается атомарно до записи,
+            # параллельное действие в чате (или другой воркер) сюда уже не пройдёт
+            ok, remaining = await try_acquire_cooldown(user_id, "chat_activity", cooldown_hours * 3600)
+            if not ok:
+                await auto_delete_reply(message, f"⏳ Глобальный кулдаун! Подожди {format_time_remaining(remaining)}.")
+                return
+
             # Убедимся, что получатель существует в БД
             await conn.execute(
                 "INSERT INTO users (user_id, username, first_name, joined_date) VALUES ($1, $2, $3, $4) ON CONFLICT DO NOTHING",
@@ -7655,6 +9709,7 @@ async def chat_gift(message: Message):
 
             success, new_balance, _ = await update_user_balance(recipient_id, gift_amount, conn=conn, allow_negative=False)
             if not success:
+                await release_cooldown(user_id, "chat_activity")
                 await auto_delete_reply(message, "❌ Ошибка при начислении подарка.")
                 return
 
@@ -7664,14 +9719,13 @@ async def chat_gift(message: Message):
                 await conn.execute("UPDATE confirmed_chats SET last_gift_date=$1, gift_count_today=1 WHERE chat_id=$2", today_date, message.chat.id)
 
             new_user_gift_count = user_gift_count + 1
+            invalidate_user_context(user_id)
+            touch_leaderboards(user_id)
             await conn.execute(
                 "UPDATE users SET last_gift_time=$1, gift_count_today=$2 WHERE user_id=$3",
                 now, new_user_gift_count, user_id
             )
 
-            # Устанавливаем глобальный кулдаун чата
-            await set_global_cooldown(user_id, "chat_activity", cooldown_hours * 3600)
-
             remaining_chat = gift_limit_per_chat - (gift_count_today + 1)
 
     # Отправляем сообщение о подгоне
@@ -7724,7 +9778,7 @@ def safe_split_text(text: str, limit: int = 4000) -> list:
     return parts
 
 # ==================== ГЛАВНОЕ МЕНЮ АДМИНКИ ====================
-@dp.message(F.text == "Админка")
+@button("Админка")
 async def admin_panel(message: Message):
     try:
         user_id = message.from_user.id
@@ -7742,7 +9796,7 @@ async def admin_panel(message: Message):
         logging.error(f"Admin panel error: {e}", exc_info=True)
         await message.answer("❌ Произошла внутренняя ошибка. Попробуйте позже.")
 
-@dp.message(F.text == "◀️ Назад в админку")
+@button("◀️ Назад в админку")
 async def back_to_admin_panel(message: Message):
     user_id = message.from_user.id
     if not await is_admin(user_id):
@@ -7756,7 +9810,7 @@ async def back_to_admin_panel(message: Message):
     )
 
 # ==================== УПРАВЛЕНИЕ ПОЛЬЗОВАТЕЛЯМИ ====================
-@dp.message(F.text == "👥 Пользователи")
+@button("👥 Пользователи")
 async def admin_users_menu(message: Message):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -7764,7 +9818,7 @@ async def admin_users_menu(message: Message):
     await send_with_media(message.chat.id, "Управление пользователями:", media_key='admin_users', reply_markup=admin_users_keyboard())
 
 # ----- Начисление/списание баксов -----
-@dp.message(F.text == "💰 Начислить баксы")
+@button("💰 Начислить баксы")
 async def add_balance_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недотаточно прав.")
@@ -7799,7 +9853,7 @@ async def add_balance_amount(message: Message, state: FSMContext):
         if amount <= 0:
             raise ValueError
         amount = round(amount, 2)
-        max_input = await get_setting_float("max_input_number")
+        max_input = settings_snapshot.max_input_number
         if amount > max_input:
             await message.answer(f"❌ Сумма слишком большая (максимум {max_input:.2f}).")
             return
@@ -7822,7 +9876,7 @@ async def add_balance_amount(message: Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.clear()
 
-@dp.message(F.text == "💸 Списать баксы")
+@button("💸 Списать баксы")
 async def remove_balance_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -7857,7 +9911,7 @@ async def remove_balance_amount(message: Message, state: FSMContext):
         if amount <= 0:
             raise ValueError
         amount = round(amount, 2)
-        max_input = await get_setting_float("max_input_number")
+        max_input = settings_snapshot.max_input_number
         if amount > max_input:
             await message.answer(f"❌ Сумма слишком большая (максимум {max_input:.2f}).")
             return
@@ -7881,7 +9935,7 @@ async def remove_balance_amount(message: Message, state: FSMContext):
     await state.clear()
 
 # ----- Начисление/списание репутации -----
-@dp.message(F.text == "⭐️ Начислить репутацию")
+@button("⭐️ Начислить репутацию")
 async def add_reputation_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -7931,7 +9985,7 @@ async def add_reputation_amount(message: Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.clear()
 
-@dp.message(F.text == "🔻 Снять репутацию")
+@button("🔻 Снять репутацию")
 async def remove_reputation_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -7982,7 +10036,7 @@ async def remove_reputation_amount(message: Message, state: FSMContext):
     await state.clear()
 
 # ----- Начисление опыта -----
-@dp.message(F.text == "📈 Начислить опыт")
+@button("📈 Начислить опыт")
 async def add_exp_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -8030,7 +10084,7 @@ async def add_exp_amount(message: Message, state: FSMContext):
     await state.clear()
 
 # ----- Установка уровня -----
-@dp.message(F.text == "🔝 Установить уровень")
+@button("🔝 Установить уровень")
 async def set_level_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -8071,6 +10125,8 @@ async def set_level_value(message: Message, state: FSMContext):
     uid = data['user_id']
     try:
         async with db_pool.acquire() as conn:
+            invalidate_user_context(uid)
+            touch_leaderboards(uid)
             await conn.execute("UPDATE users SET level=$1 WHERE user_id=$2", level, uid)
         await message.answer(f"✅ Пользователю {uid} установлен уровень {level}.")
         await safe_send_message(uid, f"🔝 Ваш уровень изменён на {level} администратором.")
@@ -8080,7 +10136,7 @@ async def set_level_value(message: Message, state: FSMContext):
     await state.clear()
 
 # ----- Начисление/списание биткоинов -----
-@dp.message(F.text == "₿ Начислить биткоины")
+@button("₿ Начислить биткоины")
 async def add_bitcoin_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -8115,7 +10171,7 @@ async def add_bitcoin_amount(message: Message, state: FSMContext):
         if amount <= 0:
             raise ValueError
         amount = round(amount, 4)
-        max_input = await get_setting_float("max_input_number")
+        max_input = settings_snapshot.max_input_number
         if amount > max_input:
             await message.answer(f"❌ Сумма слишком большая (максимум {max_input:.4f}).")
             return
@@ -8138,7 +10194,7 @@ async def add_bitcoin_amount(message: Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.clear()
 
-@dp.message(F.text == "₿ Списать биткоины")
+@button("₿ Списать биткоины")
 async def remove_bitcoin_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -8173,7 +10229,7 @@ async def remove_bitcoin_amount(message: Message, state: FSMContext):
         if amount <= 0:
             raise ValueError
         amount = round(amount, 4)
-        max_input = await get_setting_float("max_input_number")
+        max_input = settings_snapshot.max_input_number
         if amount > max_input:
             await message.answer(f"❌ Сумма слишком большая (максимум {max_input:.4f}).")
             return
@@ -8197,7 +10253,7 @@ async def remove_bitcoin_amount(message: Message, state: FSMContext):
     await state.clear()
 
 # ----- Начисление/списание авторитета -----
-@dp.message(F.text == "⚔️ Начислить авторитет")
+@button("⚔️ Начислить авторитет")
 async def add_authority_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -8247,7 +10303,7 @@ async def add_authority_amount(message: Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.clear()
 
-@dp.message(F.text == "⚔️ Списать авторитет")
+@button("⚔️ Списать авторитет")
 async def remove_authority_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -8298,7 +10354,7 @@ async def remove_authority_amount(message: Message, state: FSMContext):
     await state.clear()
 
 # ----- Поиск пользователя -----
-@dp.message(F.text == "👥 Найти пользователя")
+@button("👥 Найти пользователя")
 async def find_user_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -8353,7 +10409,7 @@ async def find_user_result(message: Message, state: FSMContext):
     await state.clear()
 
 # ----- Экспорт пользователей -----
-@dp.message(F.text == "📊 Экспорт пользователей")
+@button("📊 Экспорт пользователей")
 async def export_users(message: Message):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         return
@@ -8371,7 +10427,7 @@ async def export_users(message: Message):
         await message.answer("❌ Ошибка при экспорте.")
 
 # ----- Сброс статистики (для админа, с подтверждением по ключу) -----
-@dp.message(F.text == "🔄 Сброс статистики")
+@button("🔄 Сброс статистики")
 async def reset_stats_admin_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -8403,7 +10459,7 @@ async def reset_stats_admin_user(message: Message, state: FSMContext):
     )
     # Состояние не завершаем, ждём подтверждения по кнопке
 
-@dp.callback_query(F.data.startswith("reset_stats_confirm_"))
+@callback_prefix("reset_stats_confirm_")
 async def reset_stats_confirm(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     if not await check_admin_permissions(callback.from_user.id, "manage_users"):
@@ -8417,24 +10473,22 @@ async def reset_stats_confirm(callback: CallbackQuery, state: FSMContext):
         return
     key = data.get('generated_key')
     if await verify_reset_key(key, uid):
-        # Используем транзакцию для сброса статистики
-        async with db_pool.acquire() as conn:
-            async with conn.transaction():
-                await reset_user_stats(uid, conn=conn)  # предполагается, что функция принимает conn
+        # Сброс идёт одной транзакцией под блокировкой стакана (снимаются и заявки)
+        await reset_user_stats(uid)
         await callback.message.edit_text(f"✅ Статистика пользователя {uid} успешно сброшена.")
         await safe_send_message(uid, "🔄 Ваша статистика была сброшена администратором.")
     else:
         await callback.message.edit_text("❌ Ошибка при сбросе (ключ недействителен). Попробуйте снова.")
     await state.clear()
 
-@dp.callback_query(F.data == "reset_stats_cancel")
+@callback_exact("reset_stats_cancel")
 async def reset_stats_cancel(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     await state.clear()
     await callback.message.edit_text("❌ Сброс отменён.")
 
 # ----- Блокировка и разблокировка пользователей -----
-@dp.message(F.text == "⛔ Заблокировать")
+@button("⛔ Заблокировать")
 async def block_user_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -8477,6 +10531,9 @@ async def block_user_reason(message: Message, state: FSMContext):
                 "INSERT INTO banned_users (user_id, banned_by, banned_date, reason) VALUES ($1, $2, $3, $4) ON CONFLICT (user_id) DO UPDATE SET banned_by=$2, banned_date=$3, reason=$4",
                 uid, message.from_user.id, datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"), reason
             )
+            banned_user_ids.add(uid)
+            remove_theft_target(uid)
+            await notify_cache_invalidation("bans", str(uid), conn=conn)
         await message.answer(f"✅ Пользователь {uid} заблокирован.")
         await safe_send_message(uid, f"⛔ Вы заблокированы в боте. Причина: {reason if reason else 'не указана'}")
     except Exception as e:
@@ -8484,7 +10541,7 @@ async def block_user_reason(message: Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.clear()
 
-@dp.message(F.text == "✅ Разблокировать")
+@button("✅ Разблокировать")
 async def unblock_user_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         await message.answer("❌ Недостаточно прав.")
@@ -8507,6 +10564,9 @@ async def unblock_user_finish(message: Message, state: FSMContext):
     try:
         async with db_pool.acquire() as conn:
             await conn.execute("DELETE FROM banned_users WHERE user_id=$1", uid)
+            banned_user_ids.discard(uid)
+            touch_leaderboards(uid)  # вернёт пользователя в пул случайных целей
+            await notify_cache_invalidation("bans", str(uid), conn=conn)
         await message.answer(f"✅ Пользователь {uid} разблокирован.")
         await safe_send_message(uid, f"✅ Вы разблокированы в боте.")
     except Exception as e:
@@ -8515,14 +10575,14 @@ async def unblock_user_finish(message: Message, state: FSMContext):
     await state.clear()
 
 # ==================== УПРАВЛЕНИЕ МАГАЗИНОМ ====================
-@dp.message(F.text == "🛒 Магазин (админ)")
+@button("🛒 Магазин (админ)")
 async def admin_shop_menu(message: Message):
     if not await check_admin_permissions(message.from_user.id, "manage_shop"):
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Управление магазином:", media_key='admin_shop', reply_markup=admin_shop_keyboard())
 
-@dp.message(F.text == "➕ Добавить товар")
+@button("➕ Добавить товар")
 async def add_shop_item_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_shop"):
         return
@@ -8560,7 +10620,7 @@ async def add_shop_item_price(message: Message, state: FSMContext):
         if price <= 0:
             raise ValueError
         price = round(price, 2)
-        max_input = await get_setting_float("max_input_number")
+        max_input = settings_snapshot.max_input_number
         if price > max_input:
             await message.answer(f"❌ Цена слишком большая (максимум {max_input:.2f}).")
             return
@@ -8579,7 +10639,7 @@ async def add_shop_item_stock(message: Message, state: FSMContext):
         return
     try:
         stock = int(message.text)
-        max_input = await get_setting_float("max_input_number")
+        max_input = settings_snapshot.max_input_number
         if stock > max_input:
             await message.answer(f"❌ Количество слишком большое (максимум {max_input}).")
             return
@@ -8617,7 +10677,7 @@ async def add_shop_item_photo(message: Message, state: FSMContext):
         await message.answer("❌ Ошибка при добавлении товара.")
     await state.clear()
 
-@dp.message(F.text == "➖ Удалить товар")
+@button("➖ Удалить товар")
 async def remove_shop_item_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_shop"):
         return
@@ -8655,7 +10715,7 @@ async def remove_shop_item(message: Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.clear()
 
-@dp.message(F.text == "✏️ Редактировать товар")
+@button("✏️ Редактировать товар")
 async def edit_shop_item_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_shop"):
         return
@@ -8707,13 +10767,13 @@ async def edit_shop_item_value(message: Message, state: FSMContext):
             if value <= 0:
                 raise ValueError
             value = round(value, 2)
-            max_input = await get_setting_float("max_input_number")
+            max_input = settings_snapshot.max_input_number
             if value > max_input:
                 await message.answer(f"❌ Цена слишком большая (максимум {max_input:.2f}).")
                 return
         else:  # stock
             value = int(message.text)
-            max_input = await get_setting_float("max_input_number")
+            max_input = settings_snapshot.max_input_number
             if value > max_input:
                 await message.answer(f"❌ Количество слишком большое (максимум {max_input}).")
                 return
@@ -8730,7 +10790,7 @@ async def edit_shop_item_value(message: Message, state: FSMContext):
     await state.clear()
 
 # ----- Список товаров (с исправленной пагинацией) -----
-@dp.message(F.text == "📋 Список товаров")
+@button("📋 Список товаров")
 async def list_shop_items(message: Message, page: int = 1):
     if not await check_admin_permissions(message.from_user.id, "manage_shop"):
         return
@@ -8765,14 +10825,14 @@ async def list_shop_items(message: Message, page: int = 1):
         logging.error(f"List shop items error: {e}")
         await message.answer("❌ Ошибка.")
 
-@dp.callback_query(F.data.startswith("shopitems_page_"))
+@callback_prefix("shopitems_page_")
 async def shopitems_page_callback(callback: CallbackQuery):
     await callback.answer()
     page = int(callback.data.split("_")[2])
     await list_shop_items(callback.message, page=page)
 
 # ----- Список покупок (с исправленной пагинацией и возвратом средств при отказе) -----
-@dp.message(F.text == "🛍️ Список покупок")
+@button("🛍️ Список покупок")
 async def admin_purchases(message: Message, page: int = 1):
     """Вывод списка необработанных покупок с пагинацией."""
     if not await check_admin_permissions(message.from_user.id, "manage_shop"):
@@ -8813,13 +10873,13 @@ async def admin_purchases(message: Message, page: int = 1):
         logging.error(f"Admin purchases error: {e}")
         await message.answer("❌ Ошибка загрузки покупок.")
 
-@dp.callback_query(F.data.startswith("admin_purchases_page_"))
+@callback_prefix("admin_purchases_page_")
 async def admin_purchases_page_callback(callback: CallbackQuery):
     await callback.answer()
     page = int(callback.data.split("_")[3])
     await admin_purchases(callback.message, page=page)
 
-@dp.callback_query(F.data.startswith("purchase_done_"))
+@callback_prefix("purchase_done_")
 async def purchase_done(callback: CallbackQuery):
     await callback.answer()
     if not await check_admin_permissions(callback.from_user.id, "manage_shop"):
@@ -8843,7 +10903,7 @@ async def purchase_done(callback: CallbackQuery):
         logging.error(f"Purchase done error: {e}")
         await callback.answer("Ошибка", show_alert=True)
 
-@dp.callback_query(F.data.startswith("purchase_reject_"))
+@callback_prefix("purchase_reject_")
 async def purchase_reject(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     if not await check_admin_permissions(callback.from_user.id, "manage_shop"):
@@ -8907,14 +10967,14 @@ async def purchase_reject_comment(message: Message, state: FSMContext):
     await admin_purchases(message)
 
 # ==================== УПРАВЛЕНИЕ КАНАЛАМИ ====================
-@dp.message(F.text == "📢 Каналы")
+@button("📢 Каналы")
 async def admin_channel_menu(message: Message):
     if not await check_admin_permissions(message.from_user.id, "manage_channels"):
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Управление каналами:", media_key='admin_channels', reply_markup=admin_channel_keyboard())
 
-@dp.message(F.text == "➕ Добавить канал")
+@button("➕ Добавить канал")
 async def add_channel_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_channels"):
         return
@@ -8955,6 +11015,7 @@ async def add_channel_link(message: Message, state: FSMContext):
                 "INSERT INTO channels (chat_id, title, invite_link) VALUES ($1, $2, $3)",
                 data['chat_id'], data['title'], link
             )
+            await notify_cache_invalidation("channels", conn=conn)
         await message.answer("✅ Канал добавлен!", reply_markup=admin_channel_keyboard())
     except asyncpg.UniqueViolationError:
         await message.answer("❌ Канал с таким chat_id уже существует.")
@@ -8963,7 +11024,7 @@ async def add_channel_link(message: Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.clear()
 
-@dp.message(F.text == "➖ Удалить канал")
+@button("➖ Удалить канал")
 async def remove_channel_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_channels"):
         return
@@ -8980,13 +11041,14 @@ async def remove_channel(message: Message, state: FSMContext):
     try:
         async with db_pool.acquire() as conn:
             await conn.execute("DELETE FROM channels WHERE chat_id=$1", chat_id)
+            await notify_cache_invalidation("channels", conn=conn)
         await message.answer("✅ Канал удалён, если существовал.", reply_markup=admin_channel_keyboard())
     except Exception as e:
         logging.error(f"Remove channel error: {e}")
         await message.answer("❌ Ошибка.")
     await state.clear()
 
-@dp.message(F.text == "📋 Список каналов")
+@button("📋 Список каналов")
 async def list_channels(message: Message):
     if not await check_admin_permissions(message.from_user.id, "manage_channels"):
         return
@@ -9002,14 +11064,14 @@ async def list_channels(message: Message):
         await message.answer(part, reply_markup=admin_channel_keyboard())
 
 # ==================== УПРАВЛЕНИЕ ПРОМОКОДАМИ ====================
-@dp.message(F.text == "🎫 Промокоды")
+@button("🎫 Промокоды")
 async def admin_promo_menu(message: Message):
     if not await check_admin_permissions(message.from_user.id, "manage_promocodes"):
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Управление промокодами:", media_key='admin_promo', reply_markup=admin_promo_keyboard())
 
-@dp.message(F.text == "➕ Создать промокод")
+@button("➕ Создать промокод")
 async def create_promo_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_promocodes"):
         return
@@ -9038,7 +11100,7 @@ async def create_promo_reward(message: Message, state: FSMContext):
         if reward <= 0:
             raise ValueError
         reward = round(reward, 4) if reward < 1 else round(reward, 2)
-        max_input = await get_setting_float("max_input_number")
+        max_input = settings_snapshot.max_input_number
         if reward > max_input:
             await message.answer(f"❌ Сумма слишком большая (максимум {max_input:.4f}).")
             return
@@ -9086,7 +11148,7 @@ async def create_promo_max_uses(message: Message, state: FSMContext):
     await state.clear()
 
 # ----- Список промокодов (с исправленной пагинацией) -----
-@dp.message(F.text == "📋 Список промокодов")
+@button("📋 Список промокодов")
 async def list_promos(message: Message, page: int = 1):
     if not await check_admin_permissions(message.from_user.id, "manage_promocodes"):
         return
@@ -9127,21 +11189,21 @@ async def list_promos(message: Message, page: int = 1):
         logging.error(f"List promos error: {e}")
         await message.answer("❌ Ошибка.")
 
-@dp.callback_query(F.data.startswith("promos_page_"))
+@callback_prefix("promos_page_")
 async def promos_page_callback(callback: CallbackQuery):
     await callback.answer()
     page = int(callback.data.split("_")[2])
     await list_promos(callback.message, page=page)
 
 # ==================== УПРАВЛЕНИЕ ЧАТАМИ ====================
-@dp.message(F.text == "🤖 Чаты")
+@button("🤖 Чаты")
 async def admin_chats_menu(message: Message):
     if not await check_admin_permissions(message.from_user.id, "manage_chats"):
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Управление чатами:", media_key='admin_chats', reply_markup=admin_chats_keyboard())
 
-@dp.message(F.text == "📋 Список запросов на подтверждение")
+@button("📋 Список запросов на подтверждение")
 async def list_pending_requests(message: Message):
     if not await check_admin_permissions(message.from_user.id, "manage_chats"):
         return
@@ -9156,7 +11218,7 @@ async def list_pending_requests(message: Message):
     for part in parts:
         await message.answer(part)
 
-@dp.message(F.text == "✅ Подтвердить чат")
+@button("✅ Подтвердить чат")
 async def confirm_chat_manual(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_chats"):
         return
@@ -9164,7 +11226,7 @@ async def confirm_chat_manual(message: Message, state: FSMContext):
     await state.set_state(ManageChats.chat_id)
     await state.update_data(action="confirm")
 
-@dp.message(F.text == "❌ Отклонить запрос")
+@button("❌ Отклонить запрос")
 async def reject_chat_manual(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_chats"):
         return
@@ -9172,7 +11234,7 @@ async def reject_chat_manual(message: Message, state: FSMContext):
     await state.set_state(ManageChats.chat_id)
     await state.update_data(action="reject")
 
-@dp.message(F.text == "🗑 Удалить чат из подтверждённых")
+@button("🗑 Удалить чат из подтверждённых")
 async def remove_confirmed_chat_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_chats"):
         return
@@ -9223,7 +11285,7 @@ async def process_chat_id(message: Message, state: FSMContext):
             await message.answer(f"✅ Чат {chat_id} удалён из подтверждённых.")
     await state.clear()
 
-@dp.message(F.text == "📋 Список подтверждённых чатов")
+@button("📋 Список подтверждённых чатов")
 async def list_confirmed_chats(message: Message):
     if not await check_admin_permissions(message.from_user.id, "manage_chats"):
         return
@@ -9239,7 +11301,7 @@ async def list_confirmed_chats(message: Message):
         await message.answer(part)
 
 # ==================== ОБРАБОТЧИКИ ИНЛАЙН-КНОПОК ДЛЯ ПОДТВЕРЖДЕНИЯ ЧАТА ====================
-@dp.callback_query(F.data.startswith("confirm_chat_"))
+@callback_prefix("confirm_chat_")
 async def confirm_chat_callback(callback: CallbackQuery):
     await callback.answer()
     if not await check_admin_permissions(callback.from_user.id, "manage_chats"):
@@ -9257,7 +11319,7 @@ async def confirm_chat_callback(callback: CallbackQuery):
         await safe_send_message(request['requested_by'], f"✅ Ваш чат «{request['title']}» активирован!")
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("reject_chat_"))
+@callback_prefix("reject_chat_")
 async def reject_chat_callback(callback: CallbackQuery):
     await callback.answer()
     if not await check_admin_permissions(callback.from_user.id, "manage_chats"):
@@ -9307,14 +11369,14 @@ from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, Teleg
 # (bot, dp, db_pool, redis_client, вспомогательные функции, клавиатуры, состояния)
 
 # ==================== УПРАВЛЕНИЕ БИЗНЕСАМИ ====================
-@dp.message(F.text == "🏪 Бизнесы (админ)")
+@button("🏪 Бизнесы (админ)")
 async def admin_business_menu(message: Message):
     if not await check_admin_permissions(message.from_user.id, "manage_businesses"):
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Управление бизнесами:", media_key='admin_business', reply_markup=admin_business_keyboard())
 
-@dp.message(F.text == "📋 Список бизнесов")
+@button("📋 Список бизнесов")
 async def admin_list_businesses(message: Message, page: int = 1):
     if not await check_admin_permissions(message.from_user.id, "manage_businesses"):
         return
@@ -9351,13 +11413,13 @@ async def admin_list_businesses(message: Message, page: int = 1):
     else:
         await message.answer(text, reply_markup=admin_business_keyboard())
 
-@dp.callback_query(F.data.startswith("admin_business_page_"))
+@callback_prefix("admin_business_page_")
 async def admin_business_page_callback(callback: CallbackQuery):
     await callback.answer()
     page = int(callback.data.split("_")[3])
     await admin_list_businesses(callback.message, page=page)
 
-@dp.message(F.text == "➕ Добавить бизнес")
+@button("➕ Добавить бизнес")
 async def add_business_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_businesses"):
         return
@@ -9395,7 +11457,7 @@ async def add_business_price(message: Message, state: FSMContext):
         if price <= 0:
             raise ValueError
         price = round(price, 2)
-        max_input = await get_setting_float("max_input_number")
+        max_input = settings_snapshot.max_input_number
         if price > max_input:
             await message.answer(f"❌ Цена слишком большая (максимум {max_input:.2f}).")
             return
@@ -9490,7 +11552,7 @@ async def add_business_image_key(message: Message, state: FSMContext):
         await message.answer("❌ Ошибка при добавлении бизнеса.")
     await state.clear()
 
-@dp.message(F.text == "✏️ Редактировать бизнес")
+@button("✏️ Редактировать бизнес")
 async def edit_business_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_businesses"):
         return
@@ -9562,7 +11624,7 @@ async def edit_business_value(message: Message, state: FSMContext):
             if val <= 0:
                 raise ValueError
             val = round(val, 2)
-            max_input = await get_setting_float("max_input_number")
+            max_input = settings_snapshot.max_input_number
             if val > max_input:
                 await message.answer(f"❌ Сумма слишком большая (максимум {max_input:.2f}).")
                 return
@@ -9601,7 +11663,7 @@ async def edit_business_value(message: Message, state: FSMContext):
         await message.answer("❌ Ошибка при обновлении.")
     await state.clear()
 
-@dp.message(F.text == "🔄 Переключить доступность")
+@button("🔄 Переключить доступность")
 async def toggle_business_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_businesses"):
         return
@@ -9653,14 +11715,14 @@ async def toggle_business_finish(message: Message, state: FSMContext):
         await message.answer("Введи 'да' или 'нет'.")
 
 # ==================== УПРАВЛЕНИЕ БИРЖЕЙ ====================
-@dp.message(F.text == "💼 Биржа (админ)")
+@button("💼 Биржа (админ)")
 async def admin_exchange_menu(message: Message):
     if not await check_admin_permissions(message.from_user.id, "manage_exchange"):
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Управление биткоин-биржей:", media_key='admin_exchange', reply_markup=admin_exchange_keyboard())
 
-@dp.message(F.text == "📋 Активные заявки")
+@button("📋 Активные заявки")
 async def admin_list_orders(message: Message, page: int = 1):
     """Вывод активных заявок с пагинацией."""
     if not await check_admin_permissions(message.from_user.id, "manage_exchange"):
@@ -9697,13 +11759,13 @@ async def admin_list_orders(message: Message, page: int = 1):
         kb = InlineKeyboardMarkup(inline_keyboard=[nav])
     await message.answer(text, reply_markup=kb)
 
-@dp.callback_query(F.data.startswith("admin_orders_page_"))
+@callback_prefix("admin_orders_page_")
 async def admin_orders_page_callback(callback: CallbackQuery):
     await callback.answer()
     page = int(callback.data.split("_")[3])
     await admin_list_orders(callback.message, page=page)
 
-@dp.message(F.text == "❌ Удалить заявку (по ID)")
+@button("❌ Удалить заявку (по ID)")
 async def admin_remove_order_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_exchange"):
         return
@@ -9729,7 +11791,7 @@ async def admin_remove_order_finish(message: Message, state: FSMContext):
         await message.answer(f"❌ Не удалось отменить заявку {order_id} (возможно, она уже не активна).")
     await state.clear()
 
-@dp.message(F.text == "📊 История сделок")
+@button("📊 История сделок")
 async def admin_trade_history(message: Message):
     if not await check_admin_permissions(message.from_user.id, "manage_exchange"):
         return
@@ -9749,14 +11811,14 @@ async def admin_trade_history(message: Message):
         await message.answer(part, reply_markup=admin_exchange_keyboard())
 
 # ==================== УПРАВЛЕНИЕ МЕДИА ====================
-@dp.message(F.text == "🖼 Медиа")
+@button("🖼 Медиа")
 async def admin_media_menu(message: Message):
     if not await check_admin_permissions(message.from_user.id, "manage_media"):
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Управление медиафайлами:", media_key='admin_media', reply_markup=admin_media_keyboard())
 
-@dp.message(F.text == "➕ Добавить медиа")
+@button("➕ Добавить медиа")
 async def add_media_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_media"):
         return
@@ -9801,6 +11863,7 @@ async def add_media_file(message: Message, state: FSMContext):
                 "INSERT INTO media (key, file_id, description) VALUES ($1, $2, $3) ON CONFLICT (key) DO UPDATE SET file_id=$2, description=$3",
                 key, file_id, f"Медиа для {key}"
             )
+            await notify_cache_invalidation("media", key, conn=conn)
         if redis_client:
             await redis_set(f"media:{key}", file_id, 3600)
         await message.answer(f"✅ Медиа с ключом '{key}' сохранено.")
@@ -9810,7 +11873,7 @@ async def add_media_file(message: Message, state: FSMContext):
     await state.clear()
     await admin_media_menu(message)
 
-@dp.message(F.text == "➖ Удалить медиа")
+@button("➖ Удалить медиа")
 async def remove_media_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_media"):
         return
@@ -9827,6 +11890,8 @@ async def remove_media_finish(message: Message, state: FSMContext):
     try:
         async with db_pool.acquire() as conn:
             await conn.execute("DELETE FROM media WHERE key=$1", key)
+            media_cache.pop(key, None)
+            await notify_cache_invalidation("media", key, conn=conn)
         if redis_client:
             await redis_delete(f"media:{key}")
         await message.answer(f"✅ Медиа с ключом '{key}' удалено, если существовало.")
@@ -9835,7 +11900,7 @@ async def remove_media_finish(message: Message, state: FSMContext):
         await message.answer("❌ Ошибка.")
     await state.clear()
 
-@dp.message(F.text == "📋 Список медиа")
+@button("📋 Список медиа")
 async def list_media(message: Message):
     if not await check_admin_permissions(message.from_user.id, "manage_media"):
         return
@@ -9852,14 +11917,14 @@ async def list_media(message: Message):
         await message.answer(part, reply_markup=admin_media_keyboard())
 
 # ==================== УПРАВЛЕНИЕ ЗАДАНИЯМИ ====================
-@dp.message(F.text == "📋 Задания (админ)")
+@button("📋 Задания (админ)")
 async def admin_tasks_menu(message: Message):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):  # manage_users включает и задания
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Управление заданиями:", media_key='admin_tasks', reply_markup=admin_tasks_keyboard())
 
-@dp.message(F.text == "➕ Создать задание")
+@button("➕ Создать задание")
 async def create_task_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         return
@@ -9935,7 +12000,7 @@ async def create_task_reward_coins(message: Message, state: FSMContext):
         if coins < 0:
             raise ValueError
         coins = round(coins, 2)
-        max_input = await get_setting_float("max_input_number")
+        max_input = settings_snapshot.max_input_number
         if coins > max_input:
             await message.answer(f"❌ Награда слишком большая (максимум {max_input:.2f}).")
             return
@@ -10069,7 +12134,7 @@ async def create_task_media(message: Message, state: FSMContext):
     await state.clear()
 
 # ----- Список заданий (с исправленной пагинацией) -----
-@dp.message(F.text == "📋 Список заданий")
+@button("📋 Список заданий")
 async def list_tasks(message: Message, page: int = 1):
     if not await check_admin_permissions(message.from_user.id, "manage_users"):
         return
@@ -10111,7 +12176,7 @@ async def list_tasks(message: Message, page: int = 1):
         logging.error(f"List tasks error: {e}")
         await message.answer("❌ Ошибка.")
 
-@dp.callback_query(F.data.startswith("delete_task_"))
+@callback_prefix("delete_task_")
 async def delete_task_callback(callback: CallbackQuery):
     await callback.answer()
     if not await check_admin_permissions(callback.from_user.id, "manage_users"):
@@ -10129,21 +12194,21 @@ async def delete_task_callback(callback: CallbackQuery):
         logging.error(f"Delete task error: {e}")
         await callback.answer("❌ Ошибка.", show_alert=True)
 
-@dp.callback_query(F.data.startswith("tasks_page_"))
+@callback_prefix("tasks_page_")
 async def tasks_page_callback(callback: CallbackQuery):
     await callback.answer()
     page = int(callback.data.split("_")[2])
     await list_tasks(callback.message, page=page)
 
 # ==================== УПРАВЛЕНИЕ РОЗЫГРЫШАМИ (АДМИНКА) ====================
-@dp.message(F.text == "🎁 Розыгрыши (админ)")
+@button("🎁 Розыгрыши (админ)")
 async def admin_giveaway_menu(message: Message):
     if not await check_admin_permissions(message.from_user.id, "manage_giveaways"):
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Управление розыгрышами:", media_key='admin_giveaway', reply_markup=admin_giveaway_keyboard())
 
-@dp.message(F.text == "➕ Создать розыгрыш")
+@button("➕ Создать розыгрыш")
 async def create_giveaway_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_giveaways"):
         return
@@ -10267,13 +12332,15 @@ async def create_giveaway_media(message: Message, state: FSMContext):
             else:
                 end_date = None
                 min_participants = data['min_participants']
-            await conn.execute(
+            giveaway_id = await conn.fetchval(
                 """INSERT INTO giveaways 
                    (prize, description, end_date, media_file_id, media_type, status, winners_count, min_participants, condition_type)
-                   VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)""",
+                   VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9) RETURNING id""",
                 data['prize'], data['description'], end_date, media_file_id, media_type, 'active',
                 data.get('winners_count', 1), min_participants, data['condition_type']
             )
+        if end_date:
+            schedule_deadline('giveaway', giveaway_id, end_date)
         await message.answer("✅ Розыгрыш создан!", reply_markup=admin_giveaway_keyboard())
     except Exception as e:
         logging.error(f"Create giveaway error: {e}")
@@ -10281,7 +12348,7 @@ async def create_giveaway_media(message: Message, state: FSMContext):
     await state.clear()
 
 # ----- Активные розыгрыши (админ) с исправленной пагинацией -----
-@dp.message(F.text == "📋 Активные розыгрыши (админ)")
+@button("📋 Активные розыгрыши (админ)")
 async def admin_active_giveaways(message: Message, page: int = 1):
     if not await check_admin_permissions(message.from_user.id, "manage_giveaways"):
         return
@@ -10315,13 +12382,13 @@ async def admin_active_giveaways(message: Message, page: int = 1):
         kb.append(nav)
     await message.answer(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
 
-@dp.callback_query(F.data.startswith("admin_gw_page_"))
+@callback_prefix("admin_gw_page_")
 async def admin_gw_page_callback(callback: CallbackQuery):
     await callback.answer()
     page = int(callback.data.split("_")[3])
     await admin_active_giveaways(callback.message, page=page)
 
-@dp.callback_query(F.data.startswith("admin_end_giveaway_"))
+@callback_prefix("admin_end_giveaway_")
 async def admin_end_giveaway(callback: CallbackQuery):
     await callback.answer()
     if not await check_admin_permissions(callback.from_user.id, "manage_giveaways"):
@@ -10330,33 +12397,19 @@ async def admin_end_giveaway(callback: CallbackQuery):
     gw_id = int(callback.data.split("_")[3])
     async with db_pool.acquire() as conn:
         async with conn.transaction():
-            giveaway = await conn.fetchrow("SELECT * FROM giveaways WHERE id=$1 AND status='active'", gw_id)
-            if not giveaway:
-                await callback.answer("❌ Розыгрыш не найден или уже завершён.", show_alert=True)
-                return
-            participants = await conn.fetch("SELECT user_id FROM participants WHERE giveaway_id=$1", gw_id)
-            if not participants:
-                # Если нет участников, просто помечаем как завершённый
-                await conn.execute("UPDATE giveaways SET status='completed' WHERE id=$1", gw_id)
-                await callback.answer("❌ Нет участников, розыгрыш завершён без победителя.", show_alert=True)
-                return
-            winners_count = giveaway['winners_count']
-            winners = random.sample([p['user_id'] for p in participants], min(winners_count, len(participants)))
-            winners_list = json.dumps(winners)
-            await conn.execute(
-                "UPDATE giveaways SET status='completed', winners_list=$1 WHERE id=$2",
-                winners_list, gw_id
-            )
-    # Отправляем уведомления после транзакции
-    for uid in [p['user_id'] for p in participants]:
-        if uid in winners:
-            await safe_send_message(uid, f"🎉 Поздравляем! Вы выиграли в розыгрыше #{gw_id}! Приз: {giveaway['prize']}")
-        else:
-            await safe_send_message(uid, f"😢 К сожалению, вы не выиграли в розыгрыше #{gw_id}.")
+            drawn = await draw_giveaway_winners(conn, gw_id)
+    if not drawn:
+        await callback.answer("❌ Розыгрыш не найден или уже завершён.", show_alert=True)
+        return
+    giveaway, winners = drawn
+    if not winners:
+        await callback.answer("❌ Нет участников, розыгрыш завершён без победителя.", show_alert=True)
+        return
+    asyncio.create_task(notify_giveaway_result(giveaway, winners))
     await callback.answer("✅ Розыгрыш завершён, победители уведомлены.")
     await admin_active_giveaways(callback.message)
 
-@dp.callback_query(F.data.startswith("admin_delete_giveaway_"))
+@callback_prefix("admin_delete_giveaway_")
 async def admin_delete_giveaway(callback: CallbackQuery):
     await callback.answer()
     if not await check_admin_permissions(callback.from_user.id, "manage_giveaways"):
@@ -10371,7 +12424,7 @@ async def admin_delete_giveaway(callback: CallbackQuery):
     await admin_active_giveaways(callback.message)
 
 # ----- Редактирование розыгрышей -----
-@dp.callback_query(F.data.startswith("edit_giveaway_"))
+@callback_prefix("edit_giveaway_")
 async def edit_giveaway_start(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     if not await check_admin_permissions(callback.from_user.id, "manage_giveaways"):
@@ -10481,6 +12534,7 @@ async def edit_giveaway_end_date(message: Message, state: FSMContext):
     gw_id = data['giveaway_id']
     async with db_pool.acquire() as conn:
         await conn.execute("UPDATE giveaways SET end_date=$1 WHERE id=$2", end_date, gw_id)
+    schedule_deadline('giveaway', gw_id, end_date)
     await message.answer("✅ Дата окончания обновлена.")
     await state.clear()
     await admin_active_giveaways(message)
@@ -10501,8 +12555,14 @@ async def edit_giveaway_min_participants(message: Message, state: FSMContext):
     data = await state.get_data()
     gw_id = data['giveaway_id']
     async with db_pool.acquire() as conn:
-        await conn.execute("UPDATE giveaways SET min_participants=$1 WHERE id=$2", min_part, gw_id)
+        reached = await conn.fetchval(
+            """UPDATE giveaways SET min_participants=$1 WHERE id=$2
+               RETURNING status='active' AND condition_type='participants' AND participants_count >= $1""",
+            min_part, gw_id
+        )
     await message.answer("✅ Минимальное количество участников обновлено.")
+    if reached:
+        asyncio.create_task(complete_giveaway(gw_id))
     await state.clear()
     await admin_active_giveaways(message)
 
@@ -10551,7 +12611,7 @@ async def edit_giveaway_media(message: Message, state: FSMContext):
     await state.clear()
     await admin_active_giveaways(message)
 
-@dp.message(F.text == "✅ Завершить розыгрыш")
+@button("✅ Завершить розыгрыш")
 async def complete_giveaway_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_giveaways"):
         return
@@ -10590,40 +12650,31 @@ async def complete_giveaway_winners(message: Message, state: FSMContext):
     gw_id = data['giveaway_id']
     async with db_pool.acquire() as conn:
         async with conn.transaction():
-            giveaway = await conn.fetchrow("SELECT * FROM giveaways WHERE id=$1 AND status='active'", gw_id)
-            if not giveaway:
+            count = await conn.fetchval(
+                "SELECT participants_count FROM giveaways WHERE id=$1 AND status='active' FOR UPDATE", gw_id
+            )
+            if count is None:
                 await message.answer("❌ Розыгрыш не найден или уже завершён.")
                 await state.clear()
                 return
-            participants = await conn.fetch("SELECT user_id FROM participants WHERE giveaway_id=$1", gw_id)
-            if not participants:
+            if not count:
                 await message.answer("❌ Нет участников.")
                 await state.clear()
                 return
-            winners = random.sample([p['user_id'] for p in participants], min(wc, len(participants)))
-            winners_list = json.dumps(winners)
-            await conn.execute(
-                "UPDATE giveaways SET status='completed', winners_list=$1 WHERE id=$2",
-                winners_list, gw_id
-            )
-    # Отправляем уведомления после транзакции
-    for uid in [p['user_id'] for p in participants]:
-        if uid in winners:
-            await safe_send_message(uid, f"🎉 Поздравляем! Вы выиграли в розыгрыше #{gw_id}! Приз: {giveaway['prize']}")
-        else:
-            await safe_send_message(uid, f"😢 К сожалению, вы не выиграли в розыгрыше #{gw_id}.")
+            giveaway, winners = await draw_giveaway_winners(conn, gw_id, wc)
+    asyncio.create_task(notify_giveaway_result(giveaway, winners))
     await message.answer("✅ Розыгрыш завершён.")
     await state.clear()
 
 # ==================== УПРАВЛЕНИЕ АДМИНИСТРАТОРАМИ ====================
-@dp.message(F.text == "👑 Администраторы")
+@button("👑 Администраторы")
 async def admin_admins_menu(message: Message):
     if not await check_admin_permissions(message.from_user.id, "manage_admins"):
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Управление администраторами:", media_key='admin', reply_markup=admin_admins_keyboard())
 
-@dp.message(F.text == "➕ Добавить администратора")
+@button("➕ Добавить администратора")
 async def add_admin_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_admins"):
         return
@@ -10692,6 +12743,8 @@ async def add_admin_permissions(message: Message, state: FSMContext):
                 "INSERT INTO admins (user_id, added_by, added_date, permissions) VALUES ($1, $2, $3, $4)",
                 uid, message.from_user.id, datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"), json.dumps(selected)
             )
+            admin_permissions_cache[uid] = list(selected)
+            await notify_cache_invalidation("admins", str(uid), conn=conn)
         await message.answer(f"✅ Пользователь {first_name} (ID: {uid}) теперь администратор с правами:\n" + "\n".join(selected))
         await safe_send_message(uid, f"✅ Вам назначены права администратора в боте.")
     except Exception as e:
@@ -10699,7 +12752,7 @@ async def add_admin_permissions(message: Message, state: FSMContext):
         await message.answer("❌ Ошибка при добавлении администратора.")
     await state.clear()
 
-@dp.message(F.text == "✏️ Редактировать права")
+@button("✏️ Редактировать права")
 async def edit_admin_permissions_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_admins"):
         return
@@ -10772,6 +12825,8 @@ async def edit_admin_permissions_confirm(message: Message, state: FSMContext):
                     "UPDATE admins SET permissions=$1 WHERE user_id=$2",
                     json.dumps(new_perms), uid
                 )
+                admin_permissions_cache[uid] = list(new_perms)
+                await notify_cache_invalidation("admins", str(uid), conn=conn)
             await message.answer(f"✅ Права администратора {uid} обновлены.")
             await safe_send_message(uid, f"⚙️ Ваши права администратора изменены.")
         except Exception as e:
@@ -10781,7 +12836,7 @@ async def edit_admin_permissions_confirm(message: Message, state: FSMContext):
     else:
         await message.answer("Введи 'да' или 'нет'.")
 
-@dp.message(F.text == "➖ Удалить администратора")
+@button("➖ Удалить администратора")
 async def remove_admin_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "manage_admins"):
         return
@@ -10806,6 +12861,8 @@ async def remove_admin_finish(message: Message, state: FSMContext):
     try:
         async with db_pool.acquire() as conn:
             await conn.execute("DELETE FROM admins WHERE user_id=$1", uid)
+            admin_permissions_cache.pop(uid, None)
+            await notify_cache_invalidation("admins", str(uid), conn=conn)
         await message.answer(f"✅ Администратор {uid} удалён.")
         await safe_send_message(uid, f"❌ Ваши права администратора отозваны.")
     except Exception as e:
@@ -10813,7 +12870,7 @@ async def remove_admin_finish(message: Message, state: FSMContext):
         await message.answer("❌ Ошибка при удалении.")
     await state.clear()
 
-@dp.message(F.text == "📋 Список администраторов")
+@button("📋 Список администраторов")
 async def list_admins(message: Message):
     if not await check_admin_permissions(message.from_user.id, "manage_admins"):
         return
@@ -10833,7 +12890,7 @@ async def list_admins(message: Message):
         await message.answer(part)
 
 # ==================== СТАТИСТИКА ====================
-@dp.message(F.text == "📊 Статистика")
+@button("📊 Статистика")
 async def stats_handler(message: Message):
     if not await check_admin_permissions(message.from_user.id, "view_stats"):
         await message.answer("❌ Недостаточно прав.")
@@ -10875,7 +12932,8 @@ async def stats_handler(message: Message):
             f"✅ Подтверждённых чатов: {confirmed_chats}\n"
             f"💼 Активных заявок на бирже: {active_orders}\n"
             f"🏪 Всего бизнесов у игроков: {total_businesses}\n"
-            f"📋 Активных заданий: {total_tasks}"
+            f"📋 Активных заданий: {total_tasks}\n\n"
+            f"{outbound_queue.format_metrics()}"
         )
         permissions = await get_admin_permissions(message.from_user.id)
         await message.answer(text, reply_markup=admin_main_keyboard(permissions))
@@ -10884,7 +12942,7 @@ async def stats_handler(message: Message):
         await message.answer("❌ Ошибка получения статистики.")
 
 # ==================== РАССЫЛКА ====================
-@dp.message(F.text == "📢 Рассылка")
+@button("📢 Рассылка")
 async def broadcast_start(message: Message, state: FSMContext):
     if not await check_admin_permissions(message.from_user.id, "broadcast"):
         await message.answer("❌ Недостаточно прав.")
@@ -10923,59 +12981,22 @@ async def broadcast_media(message: Message, state: FSMContext):
     await state.clear()
 
     status_msg = await message.answer("⏳ Рассылка начата... Это может занять некоторое время.")
+    job_id = await create_broadcast_job(message.from_user.id, content, status_msg.chat.id, status_msg.message_id)
+    start_broadcast_job(job_id)
 
+@callback_prefix("broadcast_cancel_")
+async def broadcast_cancel_callback(callback: CallbackQuery):
+    if not await check_admin_permissions(callback.from_user.id, "broadcast"):
+        await callback.answer("❌ Недостаточно прав.", show_alert=True)
+        return
+    job_id = int(callback.data.split("_")[-1])
     async with db_pool.acquire() as conn:
-        users = await conn.fetch("SELECT user_id FROM users")
-        users = [r['user_id'] for r in users]
-
-    sent = 0
-    failed = 0
-    total = len(users)
-
-    for i, uid in enumerate(users):
-        if await is_banned(uid):
-            continue
-        try:
-            if content['type'] == 'text':
-                await bot.send_message(uid, content['text'])
-            elif content['type'] == 'photo':
-                await bot.send_photo(uid, content['file_id'], caption=content['caption'])
-            elif content['type'] == 'video':
-                await bot.send_video(uid, content['file_id'], caption=content['caption'])
-            elif content['type'] == 'document':
-                await bot.send_document(uid, content['file_id'], caption=content['caption'])
-            sent += 1
-        except (TelegramForbiddenError, TelegramBadRequest):
-            failed += 1
-        except TelegramRetryAfter as e:
-            logging.warning(f"Flood limit, waiting {e.retry_after} seconds")
-            await asyncio.sleep(e.retry_after)
-            try:
-                if content['type'] == 'text':
-                    await bot.send_message(uid, content['text'])
-                else:
-                    if content['type'] == 'photo':
-                        await bot.send_photo(uid, content['file_id'], caption=content['caption'])
-                    elif content['type'] == 'video':
-                        await bot.send_video(uid, content['file_id'], caption=content['caption'])
-                    elif content['type'] == 'document':
-                        await bot.send_document(uid, content['file_id'], caption=content['caption'])
-                sent += 1
-            except:
-                failed += 1
-        except Exception as e:
-            failed += 1
-            logging.warning(f"Failed to send to {uid}: {e}")
-
-        if (i + 1) % 10 == 0:
-            try:
-                await status_msg.edit_text(f"⏳ Прогресс: {i+1}/{total}\n✅ Отправлено: {sent}\n❌ Ошибок: {failed}")
-            except:
-                pass
-
-        await asyncio.sleep(0.05)
-
-    await status_msg.edit_text(f"✅ Рассылка завершена!\n📊 Отправлено: {sent}\n❌ Ошибок: {failed}\n👥 Всего: {total}")
+        await conn.execute("UPDATE broadcast_jobs SET status='cancelled', finished_at=NOW() WHERE id=$1 AND status='running'", job_id)
+    # Если рассылку ведёт этот воркер — останавливаем отправителей сразу, иначе её воркер увидит отмену на ближайшей отметке
+    stop = broadcast_stop_events.get(job_id)
+    if stop is not None:
+        stop.set()
+    await callback.answer("Рассылка будет остановлена.")
 
 # ==================== НАСТРОЙКИ ====================
 # Категории настроек (определены здесь, так как используются только в этой части)
@@ -11003,6 +13024,7 @@ SETTINGS_CATEGORIES = {
         ("theft_defense_penalty", "💸 Штраф при защите"),
         ("min_theft_amount", "⬇️ Мин. сумма кражи"),
         ("max_theft_amount", "⬆️ Макс. сумма кражи"),
+        ("random_target_require_balance", "🎲 Случайная цель только с деньгами (1/0)"),
     ],
     "⚙️ Кидалово (PVP)": [
         ("betray_base_chance", "🎲 Базовый шанс успеха (%)"),
@@ -11079,6 +13101,16 @@ SETTINGS_CATEGORIES = {
     "⚙️ Автоудаление": [
         ("auto_delete_commands_seconds", "⏳ Автоудаление команд (секунд)"),
     ],
+    "⚙️ Антиспам": [
+        ("throttle_private_burst", "💬 Личка: запас запросов"),
+        ("throttle_private_rate", "💬 Личка: запросов в секунду"),
+        ("throttle_group_burst", "👥 Группы: запас на пользователя"),
+        ("throttle_group_rate", "👥 Группы: в секунду на пользователя"),
+        ("throttle_chat_burst", "🏠 Чат целиком: запас"),
+        ("throttle_chat_rate", "🏠 Чат целиком: в секунду"),
+        ("throttle_callback_burst", "🔘 Кнопки: запас нажатий"),
+        ("throttle_callback_rate", "🔘 Кнопки: нажатий в секунду"),
+    ],
     "⚙️ Прокачка навыков": [
         ("skill_share_cost_per_level", "🎯 Стоимость уровня Доли"),
         ("skill_luck_cost_per_level", "🍀 Стоимость уровня Удачи"),
@@ -11115,14 +13147,14 @@ SETTINGS_CATEGORIES = {
     ],
 }
 
-@dp.message(F.text == "⚙️ Настройки")
+@button("⚙️ Настройки")
 async def settings_menu(message: Message):
     if not await check_admin_permissions(message.from_user.id, "edit_settings"):
         await message.answer("❌ Недостаточно прав.")
         return
     await send_with_media(message.chat.id, "Выбери категорию настроек:", media_key='admin_settings', reply_markup=settings_categories_keyboard())
 
-@dp.message(F.text.in_(SETTINGS_CATEGORIES.keys()))
+@button(*SETTINGS_CATEGORIES.keys())
 async def settings_category_handler(message: Message):
     if not await check_admin_permissions(message.from_user.id, "edit_settings"):
         await message.answer("❌ Недостаточно прав.")
@@ -11134,14 +13166,14 @@ async def settings_category_handler(message: Message):
     text = f"<b>{category}</b>\n\n"
     kb_params = []
     for key, desc in params:
-        value = await get_setting(key)
+        value = settings_snapshot.get(key)
         text += f"{desc}: <code>{value}</code>\n"
         kb_params.append((key, desc))
 
     kb = settings_param_keyboard(kb_params, category)
     await message.answer(text, reply_markup=kb)
 
-@dp.callback_query(F.data.startswith("settings_back_"))
+@callback_prefix("settings_back_")
 async def settings_back_callback(callback: CallbackQuery):
     await callback.answer()
     category = callback.data.split("_", 2)[2]
@@ -11149,7 +13181,7 @@ async def settings_back_callback(callback: CallbackQuery):
     await settings_menu(callback.message)
 
 # ==================== ИСПРАВЛЕННЫЙ ХЕНДЛЕР edit_setting_start С StateFilter(None) ====================
-@dp.callback_query(F.data.startswith("edit_"), StateFilter(None))
+@callback_prefix("edit_", StateFilter(None))
 async def edit_setting_start(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     if not await check_admin_permissions(callback.from_user.id, "edit_settings"):
@@ -11157,7 +13189,7 @@ async def edit_setting_start(callback: CallbackQuery, state: FSMContext):
         return
 
     key = callback.data[5:]
-    current_value = await get_setting(key)
+    current_value = settings_snapshot.get(key)
 
     # Сохраняем категорию, чтобы вернуться после редактирования
     category = None
@@ -11192,7 +13224,11 @@ async def edit_setting_value(message: Message, state: FSMContext):
 
     try:
         await set_setting(key, new_value)
-        await message.answer(f"✅ Настройка <b>{key}</b> обновлена!\nНовое значение: <code>{new_value}</code>")
+        text = f"✅ Настройка <b>{key}</b> обновлена!\nНовое значение: <code>{new_value}</code>"
+        if key in LEVEL_REWARD_SETTINGS:
+            # Таблица level_rewards не трогается: только перечитываем кривую наград на всех воркерах
+            await notify_cache_invalidation("level_rewards")
+        await message.answer(text)
     except Exception as e:
         logging.error(f"Error setting {key}: {e}")
         await message.answer("❌ Ошибка при сохранении настройки.")
@@ -11204,7 +13240,7 @@ async def edit_setting_value(message: Message, state: FSMContext):
         text = f"<b>{category}</b>\n\n"
         kb_params = []
         for k, desc in params:
-            value = await get_setting(k)
+            value = settings_snapshot.get(k)
             text += f"{desc}: <code>{value}</code>\n"
             kb_params.append((k, desc))
         kb = settings_param_keyboard(kb_params, category)
@@ -11213,7 +13249,7 @@ async def edit_setting_value(message: Message, state: FSMContext):
         await settings_menu(message)
 
 # ==================== ОЧИСТКА ====================
-@dp.message(F.text == "🧹 Очистка")
+@button("🧹 Очистка")
 async def cleanup_old_data(message: Message):
     if not await check_admin_permissions(message.from_user.id, "cleanup"):
         await message.answer("❌ Недостаточно прав.")
@@ -11222,11 +13258,11 @@ async def cleanup_old_data(message: Message):
     await message.answer("✅ Старые записи очищены согласно настройкам.")
 
 # ==================== ПЕРЕМЕЩЁННЫЕ ХЕНДЛЕРЫ ИЗ ЧАСТИ 2 ====================
-@dp.callback_query(F.data == "noop")
+@callback_exact("noop")
 async def noop_callback(callback: CallbackQuery):
     await callback.answer()
 
-@dp.callback_query(F.data == "cancel_action")
+@callback_exact("cancel_action")
 async def cancel_action_callback(callback: CallbackQuery, state: FSMContext):
     await state.clear()
     await callback.message.delete()
@@ -11251,9 +13287,9 @@ async def heist_spawner():
     """Периодически создаёт налёты во всех подтверждённых чатах с учётом кулдауна."""
     while True:
         try:
-            interval_minutes = await get_setting_int("heist_min_interval_minutes")
+            interval_minutes = settings_snapshot.heist_min_interval_minutes
             # Для разнообразия можно использовать случайный интервал между min и max
-            max_interval = await get_setting_int("heist_max_interval_minutes")
+            max_interval = settings_snapshot.heist_max_interval_minutes
             if max_interval > interval_minutes:
                 interval_minutes = random.randint(interval_minutes, max_interval)
             await asyncio.sleep(interval_minutes * 60)
@@ -11263,33 +13299,39 @@ async def heist_spawner():
                 continue
 
             for chat_id, chat_data in confirmed.items():
+                # Каждый воркер спавнит налёты только в своих чатах
+                if not owns_shard(chat_id):
+                    continue
                 try:
-                    # Проверяем, нет ли уже активного налёта
                     async with db_pool.acquire() as conn:
-                        existing = await conn.fetchval(
-                            "SELECT 1 FROM heists WHERE chat_id=$1 AND status IN ('joining', 'splitting')",
-                            chat_id
-                        )
-                        if existing:
-                            continue
+                        async with conn.transaction():
+                            # Блокировка чата до коммита: при смене состава воркеров два «владельца» шарда
+                            # не создадут по налёту. Ключ — сам chat_id (отрицательный, с LEADER_LOCK_ID не пересекается)
+                            if not await conn.fetchval("SELECT pg_try_advisory_xact_lock($1)", chat_id):
+                                continue
 
-                        # Проверяем время последнего налёта
-                        last_heist = chat_data.get('last_heist_time')
-                        if last_heist:
-                            if last_heist.tzinfo is None:
-                                last_heist = last_heist.replace(tzinfo=timezone.utc)
-                            if datetime.now(timezone.utc) - last_heist < timedelta(minutes=interval_minutes):
+                            # Проверяем, нет ли уже активного налёта
+                            existing = await conn.fetchval(
+                                "SELECT 1 FROM heists WHERE chat_id=$1 AND status IN ('joining', 'splitting')",
+                                chat_id
+                            )
+                            if existing:
                                 continue
 
-                    # Создаём налёт
-                    await spawn_heist(chat_id)
+                            # Время последнего налёта — из БД под блокировкой, а не из локального кэша
+                            last_heist = await conn.fetchval(
+                                "SELECT last_heist_time FROM confirmed_chats WHERE chat_id=$1", chat_id
+                            )
+                            if last_heist:
+                                if last_heist.tzinfo is None:
+                                    last_heist = last_heist.replace(tzinfo=timezone.utc)
+                                if datetime.now(timezone.utc) - last_heist < timedelta(minutes=interval_minutes):
+                                    continue
+
+                            heist = await spawn_heist(chat_id, conn)
 
-                    # Обновляем время последнего налёта
-                    async with db_pool.acquire() as conn:
-                        await conn.execute(
-                            "UPDATE confirmed_chats SET last_heist_time=$1 WHERE chat_id=$2",
-                            datetime.now(timezone.utc), chat_id
-                        )
+                    chat_data['last_heist_time'] = heist['started_at']
+                    await announce_heist(chat_id, heist)
 
                     await asyncio.sleep(2)  # задержка между чатами
 
@@ -11301,250 +13343,267 @@ async def heist_spawner():
             logging.error(f"Ошибка в heist_spawner: {e}")
             await asyncio.sleep(60)
 
-# ==================== ФОНОВАЯ ЗАДАЧА: ОБРАБОТКА КОНТРАБАНДНЫХ РЕЙСОВ ====================
-async def process_smuggle_runs():
-    """Проверяет завершённые контрабандные рейсы и начисляет награду."""
-    while True:
-        try:
-            await asyncio.sleep(30)
-            now = datetime.now(timezone.utc)
-            async with db_pool.acquire() as conn:
-                runs = await conn.fetch("""
-                    SELECT * FROM smuggle_runs
-                    WHERE status = 'in_progress' AND end_time <= $1 AND notified = FALSE
-                """, now)
-
-                for run in runs:
-                    run_id = run['id']
-                    user_id = run['user_id']
-                    chat_id = run['chat_id']
-
-                    # Получаем навыки пользователя
-                    skills = await get_user_skills(user_id)
-                    luck = skills['skill_luck']
-                    share = skills['skill_share']
-
-                    # Базовые шансы из настроек
-                    success_chance = await get_setting_int("smuggle_success_chance")
-                    caught_chance = await get_setting_int("smuggle_caught_chance")
-                    lost_chance = await get_setting_int("smuggle_lost_chance")
-
-                    # Модифицируем удачей
-                    luck_bonus = luck * await get_setting_int("skill_luck_bonus_per_level")
-                    success_chance = min(success_chance + luck_bonus, 90)
-                    remaining = 100 - success_chance
-                    total_other = caught_chance + lost_chance
-                    
-                    # Защита от деления на ноль
-                    if total_other > 0:
-                        adjusted_caught = int(remaining * caught_chance / total_other)
-                        adjusted_lost = remaining - adjusted_caught
-                    else:
-                        adjusted_caught = 0
-                        adjusted_lost = 0
+# ==================== ОБРАБОТКА КОНТРАБАНДНЫХ РЕЙСОВ ====================
+async def process_smuggle_run(run_id: int):
+    """Завершает контрабандный рейс и начисляет награду (вызывается планировщиком в end_time)."""
+    async with db_pool.acquire() as conn:
+        run = await conn.fetchrow(
+            "SELECT * FROM smuggle_runs WHERE id=$1 AND status='in_progress' AND notified=FALSE",
+            run_id
+        )
+        if not run:
+            return
+        user_id = run['user_id']
+        chat_id = run['chat_id']
+
+        # Получаем навыки пользователя
+        skills = await get_user_skills(user_id)
+        luck = skills['skill_luck']
+        share = skills['skill_share']
+
+        # Базовые шансы из настроек
+        success_chance = settings_snapshot.smuggle_success_chance
+        caught_chance = settings_snapshot.smuggle_caught_chance
+        lost_chance = settings_snapshot.smuggle_lost_chance
+
+        # Модифицируем удачей
+        luck_bonus = luck * settings_snapshot.skill_luck_bonus_per_level
+        success_chance = min(success_chance + luck_bonus, 90)
+        remaining = 100 - success_chance
+        total_other = caught_chance + lost_chance
+
+        # Защита от деления на ноль
+        if total_other > 0:
+            adjusted_caught = int(remaining * caught_chance / total_other)
+            adjusted_lost = remaining - adjusted_caught
+        else:
+            adjusted_caught = 0
+            adjusted_lost = 0
 
-                    rand = random.randint(1, 100)
-                    amount = 0.0
-                    result_text = ""
-                    status = ""
-                    penalty = 0
-                    media_key = None
+        rand = random.randint(1, 100)
+        amount = 0.0
+        result_text = ""
+        status = ""
+        penalty = 0
+        media_key = None
 
-                    user_info = await conn.fetchrow("SELECT first_name, username FROM users WHERE user_id=$1", user_id)
-                    name = user_info['first_name'] if user_info else f"ID{user_id}"
-                    username = user_info['username'] if user_info and user_info['username'] else "нет юзернейма"
+        user_info = await conn.fetchrow("SELECT first_name, username FROM users WHERE user_id=$1", user_id)
+        name = user_info['first_name'] if user_info else f"ID{user_id}"
+        username = user_info['username'] if user_info and user_info['username'] else "нет юзернейма"
 
-                    # Все изменения выполняем в транзакции
-                    async with conn.transaction():
-                        if rand <= success_chance:
-                            base_amount = await get_setting_float("smuggle_base_amount")
-                            share_bonus = share * await get_setting_int("skill_share_bonus_per_level") / 100.0
-                            amount = base_amount * (1 + share_bonus)
-                            amount = round(amount, 4)
-                            success, new_balance = await update_user_bitcoin(user_id, amount, conn=conn)
-                            if not success:
-                                logging.error(f"Smuggle success: failed to add BTC to user {user_id}")
-                            await conn.execute(
-                                "UPDATE users SET smuggle_success = smuggle_success + 1 WHERE user_id = $1",
-                                user_id
-                            )
-                            # Начисляем репутацию за успешную контрабанду (опционально)
-                            rep_reward = random.randint(1, 3)
-                            await update_user_reputation(user_id, rep_reward, conn=conn)
-                            result_text = get_random_phrase(SMUGGLE_SUCCESS_PHRASES, name=name, username=username, amount=amount)
-                            status = 'completed'
-                            media_key = 'smuggle_success'
-                        elif rand <= success_chance + adjusted_caught:
-                            penalty = await get_setting_int("smuggle_fail_penalty_minutes")
-                            await conn.execute(
-                                "UPDATE users SET smuggle_fail = smuggle_fail + 1 WHERE user_id = $1",
-                                user_id
-                            )
-                            result_text = get_random_phrase(SMUGGLE_FAIL_PHRASES, name=name, username=username)
-                            status = 'failed'
-                            media_key = 'smuggle_fail'
-                        else:
-                            await conn.execute(
-                                "UPDATE users SET smuggle_fail = smuggle_fail + 1 WHERE user_id = $1",
-                                user_id
-                            )
-                            result_text = get_random_phrase(SMUGGLE_FAIL_PHRASES, name=name, username=username)
-                            status = 'failed'
-                            media_key = 'smuggle_fail'
-                            penalty = 0
+        # Все изменения выполняем в транзакции; повторно заблокированная строка уже обработана другим воркером
+        async with conn.transaction():
+            locked = await conn.fetchval(
+                "SELECT 1 FROM smuggle_runs WHERE id=$1 AND status='in_progress' AND notified=FALSE FOR UPDATE SKIP LOCKED",
+                run_id
+            )
+            if not locked:
+                return
+            if rand <= success_chance:
+                base_amount = settings_snapshot.smuggle_base_amount
+                share_bonus = share * settings_snapshot.skill_share_bonus_per_level / 100.0
+                amount = base_amount * (1 + share_bonus)
+                amount = round(amount, 4)
+                success, new_balance = await update_user_bitcoin(user_id, amount, conn=conn)
+                if not success:
+                    logging.error(f"Smuggle success: failed to add BTC to user {user_id}")
+                await conn.execute(
+                    "UPDATE users SET smuggle_success = smuggle_success + 1 WHERE user_id = $1",
+                    user_id
+                )
+                # Начисляем репутацию за успешную контрабанду (опционально)
+                rep_reward = random.randint(1, 3)
+                await update_user_reputation(user_id, rep_reward, conn=conn)
+                result_text = get_random_phrase(SMUGGLE_SUCCESS_PHRASES, name=name, username=username, amount=amount)
+                status = 'completed'
+                media_key = 'smuggle_success'
+            elif rand <= success_chance + adjusted_caught:
+                penalty = settings_snapshot.smuggle_fail_penalty_minutes
+                await conn.execute(
+                    "UPDATE users SET smuggle_fail = smuggle_fail + 1 WHERE user_id = $1",
+                    user_id
+                )
+                result_text = get_random_phrase(SMUGGLE_FAIL_PHRASES, name=name, username=username)
+                status = 'failed'
+                media_key = 'smuggle_fail'
+            else:
+                await conn.execute(
+                    "UPDATE users SET smuggle_fail = smuggle_fail + 1 WHERE user_id = $1",
+                    user_id
+                )
+                result_text = get_random_phrase(SMUGGLE_FAIL_PHRASES, name=name, username=username)
+                status = 'failed'
+                media_key = 'smuggle_fail'
+                penalty = 0
 
-                        await conn.execute(
-                            "UPDATE smuggle_runs SET status = $1, notified = TRUE, result = $2, smuggle_amount = $3 WHERE id = $4",
-                            status, result_text, amount, run_id
-                        )
+            await conn.execute(
+                "UPDATE smuggle_runs SET status = $1, notified = TRUE, result = $2, smuggle_amount = $3 WHERE id = $4",
+                status, result_text, amount, run_id
+            )
 
-                        exp = await get_setting_int("exp_per_smuggle")
-                        level_up_msg = await add_exp(user_id, exp, conn=conn)
+            exp = settings_snapshot.exp_per_smuggle
+            level_up_msg = await add_exp(user_id, exp, conn=conn)
 
-                    # Отправляем уведомления после транзакции
-                    if chat_id:
-                        try:
-                            await send_with_media(chat_id, result_text, media_key=media_key)
-                        except Exception as e:
-                            logging.error(f"Не удалось отправить результат контрабанды в чат {chat_id}: {e}")
-                            await safe_send_message(user_id, result_text)
-                    else:
-                        await safe_send_message(user_id, result_text)
+        # Отправляем уведомления после транзакции
+        if chat_id:
+            try:
+                await send_with_media(chat_id, result_text, media_key=media_key, priority=PRIORITY_GAME)
+            except Exception as e:
+                logging.error(f"Не удалось отправить результат контрабанды в чат {chat_id}: {e}")
+                await safe_send_message(user_id, result_text)
+        else:
+            await safe_send_message(user_id, result_text)
 
-                    await set_smuggle_cooldown(user_id, penalty)
+        await set_smuggle_cooldown(user_id, penalty)
 
-                    if level_up_msg:
-                        await safe_send_message(user_id, level_up_msg)
+        if level_up_msg:
+            await safe_send_message(user_id, level_up_msg)
 
-        except Exception as e:
-            logging.error(f"Ошибка в process_smuggle_runs: {e}")
-            await asyncio.sleep(60)
+# ==================== ОБРАБОТКА ТЮРЕМНЫХ СРОКОВ ====================
+async def process_jail_sentence(sentence_id: int):
+    """Выносит результат отсидки (вызывается планировщиком в end_time)."""
+    async with db_pool.acquire() as conn:
+        row = await conn.fetchrow(
+            "SELECT * FROM jail_sentences WHERE id=$1 AND status='serving' AND notified=FALSE",
+            sentence_id
+        )
+        if not row:
+            return
+        sentence_id = row['id']
+        user_id = row['user_id']
+        chat_id = row['chat_id']
+        success_chance = settings_snapshot.jail_success_chance
+        auth_min = settings_snapshot.jail_auth_min
+        auth_max = settings_snapshot.jail_auth_max
+        cell = row['cell_number']
+        article = row['article_number']
+
+        success = random.randint(1, 100) <= success_chance
+        auth_gain = 0
+        media_key = None
+
+        user_info = await conn.fetchrow("SELECT first_name, username FROM users WHERE user_id=$1", user_id)
+        name = user_info['first_name'] if user_info else f"ID{user_id}"
+        username = user_info['username'] if user_info and user_info['username'] else "нет юзернейма"
 
-# ==================== ФОНОВАЯ ЗАДАЧА: ОБРАБОТКА ТЮРЕМНЫХ СРОКОВ ====================
-async def process_jail_sentences():
-    """Проверяет завершённые тюремные сроки и выносит результат."""
-    while True:
-        try:
-            await asyncio.sleep(30)
-            now = datetime.now(timezone.utc)
-            async with db_pool.acquire() as conn:
-                rows = await conn.fetch("""
-                    SELECT * FROM jail_sentences
-                    WHERE status = 'serving' AND end_time <= $1 AND notified = FALSE
-                """, now)
-
-                for row in rows:
-                    sentence_id = row['id']
-                    user_id = row['user_id']
-                    chat_id = row['chat_id']
-                    success_chance = await get_setting_int("jail_success_chance")
-                    auth_min = await get_setting_int("jail_auth_min")
-                    auth_max = await get_setting_int("jail_auth_max")
-                    cell = row['cell_number']
-                    article = row['article_number']
-
-                    success = random.randint(1, 100) <= success_chance
-                    auth_gain = 0
-                    media_key = None
-
-                    user_info = await conn.fetchrow("SELECT first_name, username FROM users WHERE user_id=$1", user_id)
-                    name = user_info['first_name'] if user_info else f"ID{user_id}"
-                    username = user_info['username'] if user_info and user_info['username'] else "нет юзернейма"
+        async with conn.transaction():
+            locked = await conn.fetchval(
+                "SELECT 1 FROM jail_sentences WHERE id=$1 AND status='serving' AND notified=FALSE FOR UPDATE SKIP LOCKED",
+                sentence_id
+            )
+            if not locked:
+                return
+            if success:
+                auth_gain = random.randint(auth_min, auth_max)
+                await update_user_authority(user_id, auth_gain, conn=conn)
+                phrase = get_random_phrase(JAIL_SUCCESS_PHRASES, name=name, username=username, auth=auth_gain, cell=cell, article=article)
+                media_key = 'jail_success'
+            else:
+                phrase = get_random_phrase(JAIL_FAIL_PHRASES, name=name, username=username, cell=cell, article=article)
+                media_key = 'jail_fail'
 
-                    async with conn.transaction():
-                        if success:
-                            auth_gain = random.randint(auth_min, auth_max)
-                            await update_user_authority(user_id, auth_gain, conn=conn)
-                            phrase = get_random_phrase(JAIL_SUCCESS_PHRASES, name=name, username=username, auth=auth_gain, cell=cell, article=article)
-                            media_key = 'jail_success'
-                        else:
-                            phrase = get_random_phrase(JAIL_FAIL_PHRASES, name=name, username=username, cell=cell, article=article)
-                            media_key = 'jail_fail'
-
-                        await conn.execute(
-                            "UPDATE jail_sentences SET status='completed', notified=TRUE, result=$1, auth_gained=$2 WHERE id=$3",
-                            phrase, auth_gain, sentence_id
-                        )
-
-                        exp = await get_setting_int("exp_per_jail")
-                        level_up_msg = await add_exp(user_id, exp, conn=conn)
-
-                    # Отправляем уведомления после транзакции
-                    if chat_id:
-                        try:
-                            await send_with_media(chat_id, phrase, media_key=media_key)
-                        except Exception as e:
-                            logging.error(f"Не удалось отправить результат тюрьмы в чат {chat_id}: {e}")
-                            await safe_send_message(user_id, phrase)
-                    else:
-                        await safe_send_message(user_id, phrase)
+            await conn.execute(
+                "UPDATE jail_sentences SET status='completed', notified=TRUE, result=$1, auth_gained=$2 WHERE id=$3",
+                phrase, auth_gain, sentence_id
+            )
 
-                    if level_up_msg:
-                        await safe_send_message(user_id, level_up_msg)
+            exp = settings_snapshot.exp_per_jail
+            level_up_msg = await add_exp(user_id, exp, conn=conn)
 
-        except Exception as e:
-            logging.error(f"Ошибка в process_jail_sentences: {e}")
-            await asyncio.sleep(60)
+        # Отправляем уведомления после транзакции
+        if chat_id:
+            try:
+                await send_with_media(chat_id, phrase, media_key=media_key, priority=PRIORITY_GAME)
+            except Exception as e:
+                logging.error(f"Не удалось отправить результат тюрьмы в чат {chat_id}: {e}")
+                await safe_send_message(user_id, phrase)
+        else:
+            await safe_send_message(user_id, phrase)
 
-# ==================== ФОНОВАЯ ЗАДАЧА: ЗАВЕРШЕНИЕ РОЗЫГРЫШЕЙ ====================
-async def process_giveaways():
-    """Проверяет активные розыгрыши и завершает их по условию."""
-    while True:
-        try:
-            await asyncio.sleep(60)  # проверка раз в минуту
-            now = datetime.now(timezone.utc)
-            async with db_pool.acquire() as conn:
-                # Розыгрыши, завершающиеся по времени
-                time_giveaways = await conn.fetch("""
-                    SELECT * FROM giveaways
-                    WHERE status='active' AND condition_type='time' AND end_date <= $1
-                """, now)
-
-                for gw in time_giveaways:
-                    await complete_giveaway_by_id(conn, gw['id'])
-
-                # Розыгрыши, завершающиеся по количеству участников
-                participants_giveaways = await conn.fetch("""
-                    SELECT g.*, COUNT(p.user_id) as participants_count
-                    FROM giveaways g
-                    LEFT JOIN participants p ON g.id = p.giveaway_id
-                    WHERE g.status='active' AND g.condition_type='participants'
-                    GROUP BY g.id
-                    HAVING COUNT(p.user_id) >= g.min_participants
-                """)
+        if level_up_msg:
+            await safe_send_message(user_id, level_up_msg)
 
-                for gw in participants_giveaways:
-                    await complete_giveaway_by_id(conn, gw['id'])
+# ==================== ЗАВЕРШЕНИЕ РОЗЫГРЫШЕЙ ====================
+async def finish_giveaway_on_time(giveaway_id: int):
+    """Завершает розыгрыш по времени (вызывается планировщиком в end_date)."""
+    async with db_pool.acquire() as conn:
+        due = await conn.fetchval(
+            "SELECT 1 FROM giveaways WHERE id=$1 AND status='active' AND condition_type='time' AND end_date <= $2",
+            giveaway_id, datetime.now(timezone.utc)
+        )
+        if due:
+            await complete_giveaway_by_id(conn, giveaway_id)
 
-        except Exception as e:
-            logging.error(f"Ошибка в process_giveaways: {e}")
-            await asyncio.sleep(60)
+async def complete_reached_giveaways():
+    """Подводит итоги розыгрышей по участникам, порог которых набран, пока бот был выключен."""
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT id FROM giveaways
+            WHERE status='active' AND condition_type='participants' AND participants_count >= min_participants
+        """)
+    for r in rows:
+        await complete_giveaway(r['id'])
+
+async def draw_giveaway_winners(conn, giveaway_id: int, winners_count: int = None) -> Optional[Tuple[dict, List[int]]]:
+    """
+    Внутри транзакции: блокирует активный розыгрыш, выбирает победителей случайной выборкой
+    в SQL и помечает розыгрыш завершённым. Возвращает (розыгрыш, победители) или None.
+    """
+    giveaway = await conn.fetchrow("SELECT * FROM giveaways WHERE id=$1 AND status='active' FOR UPDATE", giveaway_id)
+    if not giveaway:
+        return None
+    rows = await conn.fetch(
+        "SELECT user_id FROM participants WHERE giveaway_id=$1 ORDER BY random() LIMIT $2",
+        giveaway_id, winners_count or giveaway['winners_count']
+    )
+    winners = [r['user_id'] for r in rows]
+    await conn.execute(
+        "UPDATE giveaways SET status='completed', winners_list=$1 WHERE id=$2",
+        json.dumps(winners), giveaway_id
+    )
+    return dict(giveaway), winners
+
+async def notify_giveaway_result(giveaway: dict, winners: List[int]):
+    """
+    Рассылает итоги через очередь отправки: победителям с приоритетом игр, остальным участникам
+    как уведомления, читая их пачками по id, чтобы не держать всех в памяти.
+    """
+    giveaway_id = giveaway['id']
+    for uid in winners:
+        await safe_send_message(uid, f"🎉 Поздравляем! Вы выиграли в розыгрыше #{giveaway_id}! Приз: {giveaway['prize']}", priority=PRIORITY_GAME)
+    winner_set = set(winners)
+    text = f"😢 К сожалению, вы не выиграли в розыгрыше #{giveaway_id}."
+    cursor = 0
+    try:
+        while True:
+            async with db_pool.acquire() as conn:
+                rows = await conn.fetch(
+                    "SELECT user_id FROM participants WHERE giveaway_id=$1 AND user_id > $2 ORDER BY user_id LIMIT $3",
+                    giveaway_id, cursor, BROADCAST_BATCH
+                )
+            if not rows:
+                break
+            cursor = rows[-1]['user_id']
+            # Ждём доставки пачки, прежде чем ставить следующую: очередь не разрастается
+            await asyncio.gather(*(
+                queue_send(r['user_id'], lambda uid=r['user_id']: bot.send_message(uid, text), PRIORITY_NOTIFY, wait=True)
+                for r in rows if r['user_id'] not in winner_set
+            ), return_exceptions=True)
+    except Exception as e:
+        logging.error(f"Ошибка рассылки итогов розыгрыша {giveaway_id}: {e}")
+
+async def complete_giveaway(giveaway_id: int):
+    async with db_pool.acquire() as conn:
+        await complete_giveaway_by_id(conn, giveaway_id)
 
 async def complete_giveaway_by_id(conn, giveaway_id: int):
     """Вспомогательная функция для завершения конкретного розыгрыша (внутри транзакции)."""
     try:
         async with conn.transaction():
-            giveaway = await conn.fetchrow("SELECT * FROM giveaways WHERE id=$1 AND status='active'", giveaway_id)
-            if not giveaway:
-                return
-            participants = await conn.fetch("SELECT user_id FROM participants WHERE giveaway_id=$1", giveaway_id)
-            if not participants:
-                # Если нет участников, просто помечаем как завершённый без победителей
-                await conn.execute("UPDATE giveaways SET status='completed', winners_list='[]' WHERE id=$1", giveaway_id)
-                return
-            winners_count = giveaway['winners_count']
-            winners = random.sample([p['user_id'] for p in participants], min(winners_count, len(participants)))
-            winners_list = json.dumps(winners)
-            await conn.execute(
-                "UPDATE giveaways SET status='completed', winners_list=$1 WHERE id=$2",
-                winners_list, giveaway_id
-            )
-        # Уведомляем участников после транзакции
-        for uid in [p['user_id'] for p in participants]:
-            if uid in winners:
-                await safe_send_message(uid, f"🎉 Поздравляем! Вы выиграли в розыгрыше #{giveaway_id}! Приз: {giveaway['prize']}")
-            else:
-                await safe_send_message(uid, f"😢 К сожалению, вы не выиграли в розыгрыше #{giveaway_id}.")
+            drawn = await draw_giveaway_winners(conn, giveaway_id)
+        if drawn:
+            # Уведомляем участников после транзакции, не задерживая вызывающего
+            asyncio.create_task(notify_giveaway_result(*drawn))
     except Exception as e:
         logging.error(f"Ошибка в complete_giveaway_by_id для giveaway {giveaway_id}: {e}")
 
@@ -11554,43 +13613,459 @@ async def periodic_cleanup():
     while True:
         try:
             await asyncio.sleep(86400)  # 24 часа
+            if not is_leader:
+                continue
             await perform_cleanup(manual=False)
         except Exception as e:
             logging.error(f"Ошибка в periodic_cleanup: {e}")
             await asyncio.sleep(3600)
 
-# ==================== ФОНОВАЯ ЗАДАЧА: СПИСАНИЕ ПРОСРОЧЕННЫХ БИЗНЕСОВ ====================
-async def business_expiration_checker():
-    """Раз в час проверяет истекшие бизнесы и списывает их."""
+# ==================== СПИСАНИЕ ПРОСРОЧЕННЫХ БИЗНЕСОВ ====================
+async def expire_business(business_id: int):
+    """Списывает бизнес с истёкшим сроком (вызывается планировщиком в expires_at)."""
+    async with db_pool.acquire() as conn:
+        # DELETE ... RETURNING вернёт строку только одному воркеру
+        biz = await conn.fetchrow("""
+            WITH expired AS (
+                DELETE FROM user_businesses
+                WHERE id = $1 AND expires_at IS NOT NULL AND expires_at <= NOW()
+                RETURNING user_id, business_type_id
+            )
+            SELECT e.user_id, bt.name, bt.emoji
+            FROM expired e
+            JOIN business_types bt ON e.business_type_id = bt.id
+        """, business_id)
+    if biz:
+        await safe_send_message(
+            biz['user_id'],
+            f"⚠️ Ваш бизнес {biz['emoji']} {biz['name']} истёк и был списан."
+        )
+
+# ==================== ДВИЖОК РАССЫЛОК ====================
+running_broadcasts = set()  # id рассылок, которые выполняет этот воркер
+broadcast_stop_events: Dict[int, asyncio.Event] = {}  # id -> сигнал остановки для отправителей
+
+BROADCAST_RECIPIENTS_SQL = """
+    SELECT u.user_id FROM users u
+    WHERE u.user_id > $1 AND NOT COALESCE(u.bot_blocked, FALSE)
+      AND NOT EXISTS (SELECT 1 FROM banned_users b WHERE b.user_id = u.user_id)
+    ORDER BY u.user_id
+    LIMIT $2
+"""
+
+async def create_broadcast_job(admin_id: int, content: dict, status_chat_id: int, status_message_id: int) -> int:
+    async with db_pool.acquire() as conn:
+        async with conn.transaction():
+            total = await conn.fetchval("""
+                SELECT COUNT(*) FROM users u
+                WHERE NOT COALESCE(u.bot_blocked, FALSE)
+                  AND NOT EXISTS (SELECT 1 FROM banned_users b WHERE b.user_id = u.user_id)
+            """)
+            job_id = await conn.fetchval(
+                "INSERT INTO broadcast_jobs (created_by, content, total, status_chat_id, status_message_id) "
+                "VALUES ($1, $2, $3, $4, $5) RETURNING id",
+                admin_id, json.dumps(content), total, status_chat_id, status_message_id
+            )
+            await conn.execute("INSERT INTO broadcast_progress (job_id) VALUES ($1)", job_id)
+    return job_id
+
+def start_broadcast_job(job_id: int):
+    if job_id in running_broadcasts:
+        return
+    running_broadcasts.add(job_id)
+    asyncio.create_task(run_broadcast_job(job_id))
+
+async def send_broadcast_content(user_id: int, content: dict):
+    """Отправляет сообщение рассылки через общую очередь с низшим приоритетом и ждёт результата."""
+    if content['type'] == 'text':
+        send = lambda: bot.send_message(user_id, content['text'])
+    elif content['type'] == 'photo':
+        send = lambda: bot.send_photo(user_id, content['file_id'], caption=content['caption'])
+    elif content['type'] == 'video':
+        send = lambda: bot.send_video(user_id, content['file_id'], caption=content['caption'])
+    elif content['type'] == 'document':
+        send = lambda: bot.send_document(user_id, content['file_id'], caption=content['caption'])
+    else:
+        return
+    await queue_send(user_id, send, PRIORITY_BROADCAST, wait=True)
+
+async def _edit_broadcast_status(job, stats: dict, final: bool = False, cancelled: bool = False):
+    if not job['status_chat_id']:
+        return
+    done = stats['sent'] + stats['failed'] + stats['blocked']
+    if cancelled:
+        text = (f"⛔ Рассылка #{job['id']} остановлена.\n📊 Отправлено: {stats['sent']}\n"
+                f"🚫 Заблокировали бота: {stats['blocked']}\n❌ Ошибок: {stats['failed']}\n"
+                f"👥 Обработано: {done}/{job['total']}")
+        markup = None
+    elif final:
+        text = (f"✅ Рассылка #{job['id']} завершена!\n📊 Отправлено: {stats['sent']}\n"
+                f"🚫 Заблокировали бота: {stats['blocked']}\n❌ Ошибок: {stats['failed']}\n👥 Всего: {job['total']}")
+        markup = None
+    else:
+        text = (f"⏳ Рассылка #{job['id']}: {done}/{job['total']}\n✅ Отправлено: {stats['sent']}\n"
+                f"🚫 Заблокировали бота: {stats['blocked']}\n❌ Ошибок: {stats['failed']}")
+        markup = InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="⛔ Остановить", callback_data=f"broadcast_cancel_{job['id']}")
+        ]])
+    try:
+        await bot.edit_message_text(text, chat_id=job['status_chat_id'], message_id=job['status_message_id'], reply_markup=markup)
+    except TelegramBadRequest:
+        pass  # текст не изменился или сообщение удалено
+    except Exception as e:
+        logging.warning(f"Не удалось обновить статус рассылки #{job['id']}: {e}")
+
+async def run_broadcast_job(job_id: int):
+    """
+    Выполняет (или продолжает) рассылку: курсор по users с пропуском забаненных и заблокировавших,
+    BROADCAST_SENDERS отправителей за общим токен-бакетом. Курсор и счётчики сохраняются после
+    каждой подпачки из BROADCAST_CHECKPOINT адресатов, так что после перезапуска рассылка продолжается
+    с места остановки и повторно получают сообщение не больше BROADCAST_CHECKPOINT человек.
+    """
+    try:
+        async with db_pool.acquire() as conn:
+            job = await conn.fetchrow("SELECT * FROM broadcast_jobs WHERE id=$1 AND status='running'", job_id)
+            progress = await conn.fetchrow("SELECT * FROM broadcast_progress WHERE job_id=$1", job_id)
+        if not job or not progress:
+            return
+        content = json.loads(job['content'])
+        stats = {'sent': progress['sent'], 'failed': progress['failed'], 'blocked': progress['blocked']}
+        cursor = progress['cursor_user_id']
+        bucket = AsyncTokenBucket(BROADCAST_RATE, burst=BROADCAST_SENDERS)
+        last_edit = 0.0
+        stop = broadcast_stop_events.setdefault(job_id, asyncio.Event())
+
+        async def sender(queue: asyncio.Queue, blocked_ids: list):
+            while True:
+                uid = await queue.get()
+                try:
+                    # После остановки оставшиеся в пачке адресаты просто вычерпываются
+                    for _ in range(3):
+                        if stop.is_set():
+                            break
+                        await bucket.acquire()
+                        if stop.is_set():
+                            break
+                        try:
+                            await send_broadcast_content(uid, content)
+                            stats['sent'] += 1
+                        except TelegramRetryAfter as e:
+                            # Пауза для всех отправителей разом, затем повтор этому же пользователю
+                            logging.warning(f"Рассылка #{job_id}: flood limit, пауза {e.retry_after} сек")
+                            bucket.pause(e.retry_after)
+                            continue
+                        except TelegramForbiddenError:
+                            stats['blocked'] += 1
+                            blocked_ids.append(uid)
+                        except Exception as e:
+                            stats['failed'] += 1
+                            logging.warning(f"Рассылка #{job_id}: не удалось отправить {uid}: {e}")
+                        break
+                    else:
+                        stats['failed'] += 1
+                finally:
+                    queue.task_done()
+
+        async def heartbeat():
+            """Отметка «рассылка жива» и проверка отмены (в т.ч. с другого воркера)."""
+            async with db_pool.acquire() as conn:
+                status = await conn.fetchval(
+                    "UPDATE broadcast_progress SET updated_at=NOW() WHERE job_id=$1 "
+                    "RETURNING (SELECT status FROM broadcast_jobs WHERE id=$1)",
+                    job_id
+                )
+            if status != 'running':
+                stop.set()
+
+        async def save_progress(blocked_ids: list):
+            async with db_pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute(
+                        "UPDATE broadcast_progress SET cursor_user_id=$2, sent=$3, failed=$4, blocked=$5, updated_at=NOW() WHERE job_id=$1",
+                        job_id, cursor, stats['sent'], stats['failed'], stats['blocked']
+                    )
+                    if blocked_ids:
+                        await conn.execute("UPDATE users SET bot_blocked=TRUE WHERE user_id = ANY($1::bigint[])", blocked_ids)
+
+        while not stop.is_set():
+            async with db_pool.acquire() as conn:
+                status = await conn.fetchval("SELECT status FROM broadcast_jobs WHERE id=$1", job_id)
+                if status != 'running':
+                    break
+                rows = await conn.fetch(BROADCAST_RECIPIENTS_SQL, cursor, BROADCAST_BATCH)
+            if not rows:
+                async with db_pool.acquire() as conn:
+                    await conn.execute("UPDATE broadcast_jobs SET status='completed', finished_at=NOW() WHERE id=$1", job_id)
+                break
+
+            queue = asyncio.Queue()
+            blocked_ids = []
+            senders = [asyncio.create_task(sender(queue, blocked_ids)) for _ in range(BROADCAST_SENDERS)]
+            try:
+                for start in range(0, len(rows), BROADCAST_CHECKPOINT):
+                    chunk = rows[start:start + BROADCAST_CHECKPOINT]
+                    for r in chunk:
+                        queue.put_nowait(r['user_id'])
+                    join_task = asyncio.create_task(queue.join())
+                    try:
+                        while not join_task.done():
+                            await asyncio.wait({join_task}, timeout=BROADCAST_PROGRESS_INTERVAL)
+                            if time.monotonic() - last_edit >= BROADCAST_PROGRESS_INTERVAL:
+                                last_edit = time.monotonic()
+                                # Отметка «рассылка жива», чтобы лидер не запустил её повторно во время долгой паузы
+                                await heartbeat()
+                                if not stop.is_set():
+                                    await _edit_broadcast_status(job, stats)
+                    finally:
+                        join_task.cancel()
+                    # Курсор сдвигается только за полностью обработанную подпачку (при остановке адресаты
+                    # подпачки могли быть пропущены), так что перезапуск не повторит уже доставленное раньше неё
+                    if not stop.is_set():
+                        cursor = chunk[-1]['user_id']
+                    await save_progress(blocked_ids)
+                    blocked_ids.clear()
+                    if stop.is_set():
+                        break
+            finally:
+                for task in senders:
+                    task.cancel()
+
+        async with db_pool.acquire() as conn:
+            final_status = await conn.fetchval("SELECT status FROM broadcast_jobs WHERE id=$1", job_id)
+        await _edit_broadcast_status(job, stats, final=True, cancelled=final_status == 'cancelled')
+    except Exception as e:
+        logging.error(f"Ошибка рассылки #{job_id}: {e}")
+    finally:
+        running_broadcasts.discard(job_id)
+        broadcast_stop_events.pop(job_id, None)
+
+async def broadcast_resumer():
+    """Лидер подхватывает рассылки, которые перестали продвигаться (воркер упал или перезапущен)."""
+    while True:
+        await asyncio.sleep(30)
+        if not is_leader:
+            continue
+        try:
+            async with db_pool.acquire() as conn:
+                rows = await conn.fetch("""
+                    SELECT j.id FROM broadcast_jobs j
+                    JOIN broadcast_progress p ON p.job_id = j.id
+                    WHERE j.status = 'running' AND p.updated_at < NOW() - make_interval(secs => $1)
+                """, BROADCAST_STALE_AFTER)
+            for r in rows:
+                if r['id'] not in running_broadcasts:
+                    logging.info(f"Продолжаем рассылку #{r['id']}")
+                    async with db_pool.acquire() as conn:
+                        await conn.execute("UPDATE broadcast_progress SET updated_at=NOW() WHERE job_id=$1", r['id'])
+                    start_broadcast_job(r['id'])
+        except Exception as e:
+            logging.error(f"Ошибка в broadcast_resumer: {e}")
+
+# ==================== КООРДИНАЦИЯ ВОРКЕРОВ (ЛИДЕР И ШАРДЫ) ====================
+WORKER_ID = f"{os.getpid()}-{random.randrange(16 ** 8):08x}"
+is_leader = False
+leader_conn = None
+live_workers: List[str] = [WORKER_ID]
+
+async def leader_election_loop():
+    """
+    Лидер — воркер, удерживающий advisory lock на отдельном соединении.
+    Блокировка живёт, пока живо соединение: при падении процесса или обрыве связи
+    Postgres снимает её сам, и лидерство переходит к другому воркеру.
+    """
+    global is_leader, leader_conn
+    while True:
+        try:
+            if leader_conn is None or leader_conn.is_closed():
+                leader_conn = await asyncpg.connect(
+                    get_database_dsn(), timeout=30, statement_cache_size=0,
+                    server_settings={'application_name': 'malboro_bot_leader'}
+                )
+            if not is_leader:
+                is_leader = await leader_conn.fetchval("SELECT pg_try_advisory_lock($1)", LEADER_LOCK_ID)
+                if is_leader:
+                    logging.info(f"👑 Воркер {WORKER_ID} стал лидером фоновых задач")
+            else:
+                await leader_conn.execute("SELECT 1")
+        except Exception as e:
+            if is_leader:
+                logging.error(f"Воркер {WORKER_ID} потерял лидерство: {e}")
+            is_leader = False
+            if leader_conn is not None and not leader_conn.is_closed():
+                await leader_conn.close()
+            leader_conn = None
+        await asyncio.sleep(LEADER_CHECK_INTERVAL)
+
+async def worker_heartbeat_loop():
+    """Отмечает воркер в bot_workers и обновляет список живых воркеров для шардирования."""
+    global live_workers
     while True:
         try:
-            await asyncio.sleep(3600)  # каждый час
-            if not await acquire_lock("business_expiration", timeout=60):
-                continue  # уже выполняется
+            async with db_pool.acquire() as conn:
+                await conn.execute('''
+                    INSERT INTO bot_workers (worker_id, heartbeat_at) VALUES ($1, NOW())
+                    ON CONFLICT (worker_id) DO UPDATE SET heartbeat_at = NOW()
+                ''', WORKER_ID)
+                rows = await conn.fetch(
+                    "SELECT worker_id FROM bot_workers WHERE heartbeat_at > NOW() - make_interval(secs => $1) ORDER BY worker_id",
+                    WORKER_STALE_AFTER
+                )
+                if is_leader:
+                    await conn.execute("DELETE FROM bot_workers WHERE heartbeat_at < NOW() - INTERVAL '1 day'")
+            workers = [r['worker_id'] for r in rows] or [WORKER_ID]
+            if workers != live_workers:
+                logging.info(f"Состав воркеров изменился: {len(live_workers)} -> {len(workers)}")
+                live_workers = workers
+                # Сроки ушедших воркеров теперь принадлежат кому-то из оставшихся
+                await load_scheduled_deadlines()
+        except Exception as e:
+            logging.error(f"Ошибка heartbeat воркера: {e}")
+        await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+
+def shard_owner(key: int) -> str:
+    """Воркер, которому принадлежит ключ (chat_id / user_id) при текущем составе воркеров."""
+    workers = live_workers
+    if len(workers) <= 1:
+        return WORKER_ID
+    digest = hashlib.md5(str(key).encode()).digest()
+    return workers[int.from_bytes(digest[:4], 'big') % len(workers)]
+
+def owns_shard(key: int) -> bool:
+    """Принадлежит ли ключ этому воркеру при текущем составе воркеров."""
+    return shard_owner(key) == WORKER_ID
+
+async def release_leadership():
+    global is_leader, leader_conn
+    is_leader = False
+    if leader_conn is not None and not leader_conn.is_closed():
+        await leader_conn.close()
+    leader_conn = None
+
+# ==================== ПЛАНИРОВЩИК СРОКОВ ====================
+class DeadlineScheduler:
+    """
+    Одна куча (heapq) сроков вида (время, порядок, тип, id) вместо опросов по таймеру.
+    Сроки сами хранятся в таблицах (end_time, end_date, join_until, ...), поэтому при старте
+    куча восстанавливается из БД. Чужой срок выполняется только если его владелец ушёл;
+    обработчики идемпотентны и защищены блокировками строк, так что такая подстраховка ничего не ломает.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.due: Dict[Tuple[str, int], float] = {}  # актуальный срок для каждой задачи
+        self.shard: Dict[Tuple[str, int], int] = {}  # ключ шарда для сроков, загруженных из БД
+        self.deferred: Dict[Tuple[str, int], str] = {}  # отложенные чужие сроки -> их владелец на момент срока
+        self.handlers: Dict[str, Any] = {}
+        self.counter = 0
+        self.wakeup = asyncio.Event()
+
+    def register(self, kind: str, handler):
+        self.handlers[kind] = handler
+
+    def schedule(self, kind: str, obj_id: int, when: Optional[datetime], shard_key: Optional[int] = None):
+        """
+        shard_key задаётся для сроков, загруженных из БД всеми воркерами: такой срок выполняет
+        только владелец шарда. Сроки, созданные этим воркером, он выполняет сам.
+        """
+        if when is None:
+            return
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        ts = when.timestamp()
+        key = (kind, obj_id)
+        if self.due.get(key) == ts:
+            return
+        if shard_key is None:
+            self.shard.pop(key, None)
+        else:
+            self.shard[key] = shard_key
+        self.deferred.pop(key, None)
+        # Перенос срока: старая запись в куче останется, но будет пропущена при извлечении
+        self.due[key] = ts
+        self.counter += 1
+        heapq.heappush(self.heap, (ts, self.counter, kind, obj_id))
+        if self.heap[0][2:] == key:
+            self.wakeup.set()
+
+    async def run(self):
+        while True:
+            now = time.time()
+            while self.heap and self.heap[0][0] <= now:
+                ts, _, kind, obj_id = heapq.heappop(self.heap)
+                key = (kind, obj_id)
+                if self.due.get(key) != ts:
+                    continue
+                del self.due[key]
+                shard_key = self.shard.pop(key, None)
+                owner = self.deferred.pop(key, None)
+                if shard_key is not None and not owns_shard(shard_key):
+                    if owner is None:
+                        # Чужой шард: даём владельцу время, потом проверим, жив ли он
+                        self.shard[key] = shard_key
+                        self.deferred[key] = shard_owner(shard_key)
+                        self.due[key] = ts + SHARD_GRACE_SECONDS
+                        self.counter += 1
+                        heapq.heappush(self.heap, (ts + SHARD_GRACE_SECONDS, self.counter, kind, obj_id))
+                        continue
+                    if owner in live_workers:
+                        # Владелец жив и выполнил срок сам — не дублируем его транзакцию на каждом воркере
+                        continue
+                    # Владелец ушёл, а новый хозяин шарда не мы: подстрахуем (обработчики идемпотентны)
+                asyncio.create_task(self._fire(kind, obj_id))
+            timeout = self.heap[0][0] - now if self.heap else None
+            self.wakeup.clear()
             try:
-                async with db_pool.acquire() as conn:
-                    # Используем транзакцию для согласованности
-                    async with conn.transaction():
-                        expired = await conn.fetch("""
-                            SELECT ub.id, ub.user_id, bt.name, bt.emoji
-                            FROM user_businesses ub
-                            JOIN business_types bt ON ub.business_type_id = bt.id
-                            WHERE ub.expires_at IS NOT NULL AND ub.expires_at <= NOW()
-                        """)
-                        for biz in expired:
-                            await conn.execute("DELETE FROM user_businesses WHERE id = $1", biz['id'])
-                            # Отправляем уведомление после коммита (сохраняем список)
-                            asyncio.create_task(
-                                safe_send_message(
-                                    biz['user_id'],
-                                    f"⚠️ Ваш бизнес {biz['emoji']} {biz['name']} истёк и был списан."
-                                )
-                            )
-            finally:
-                await release_lock("business_expiration")
+                await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, kind: str, obj_id: int):
+        try:
+            await self.handlers[kind](obj_id)
         except Exception as e:
-            logging.error(f"Ошибка в business_expiration_checker: {e}")
-            await asyncio.sleep(60)
+            logging.error(f"Ошибка планировщика ({kind} #{obj_id}): {e}")
+            # Повторяем через минуту: обработчик сам проверит, что задача ещё не выполнена
+            self.schedule(kind, obj_id, datetime.now(timezone.utc) + timedelta(seconds=60))
+
+deadline_scheduler = DeadlineScheduler()
+
+def schedule_deadline(kind: str, obj_id: int, when: Optional[datetime], shard_key: Optional[int] = None):
+    deadline_scheduler.schedule(kind, obj_id, when, shard_key)
+
+@db_retry()
+async def load_scheduled_deadlines():
+    """Заполняет кучу сроками всех незавершённых объектов из БД (при старте)."""
+    async with db_pool.acquire() as conn:
+        smuggle = await conn.fetch("SELECT id, user_id, end_time FROM smuggle_runs WHERE status='in_progress' AND notified=FALSE")
+        jail = await conn.fetch("SELECT id, user_id, end_time FROM jail_sentences WHERE status='serving' AND notified=FALSE")
+        giveaways = await conn.fetch("SELECT id, end_date FROM giveaways WHERE status='active' AND condition_type='time'")
+        joining = await conn.fetch("SELECT id, chat_id, join_until FROM heists WHERE status='joining'")
+        splitting = await conn.fetch("SELECT id, chat_id, split_until FROM heists WHERE status='splitting'")
+        businesses = await conn.fetch("SELECT id, user_id, expires_at FROM user_businesses WHERE expires_at IS NOT NULL")
+    # Сроки загружают все воркеры, а выполняет владелец шарда
+    for r in smuggle:
+        schedule_deadline('smuggle', r['id'], r['end_time'], r['user_id'])
+    for r in jail:
+        schedule_deadline('jail', r['id'], r['end_time'], r['user_id'])
+    for r in giveaways:
+        schedule_deadline('giveaway', r['id'], r['end_date'], r['id'])
+    for r in joining:
+        schedule_deadline('heist_join', r['id'], r['join_until'], r['chat_id'])
+    for r in splitting:
+        schedule_deadline('heist_split', r['id'], r['split_until'], r['chat_id'])
+    for r in businesses:
+        schedule_deadline('business', r['id'], r['expires_at'], r['user_id'])
+    logging.info(
+        f"Запланировано: рейсов {len(smuggle)}, сроков {len(jail)}, розыгрышей {len(giveaways)}, "
+        f"налётов {len(joining) + len(splitting)}, бизнесов {len(businesses)}"
+    )
+
+deadline_scheduler.register('smuggle', process_smuggle_run)
+deadline_scheduler.register('jail', process_jail_sentence)
+deadline_scheduler.register('giveaway', finish_giveaway_on_time)
+deadline_scheduler.register('heist_join', finish_heist_joining)
+deadline_scheduler.register('heist_split', process_betray_results)
+deadline_scheduler.register('business', expire_business)
 
 # ==================== ЗАПУСК БОТА ====================
 async def on_startup():
@@ -11612,23 +14087,64 @@ async def on_startup():
     
     # Запускаем пинг БД
     asyncio.create_task(keep_db_alive())
+    asyncio.create_task(outbound_queue.run())
+    asyncio.create_task(settings_refresher())
+    asyncio.create_task(cache_invalidation_listener())
+    asyncio.create_task(leaderboard_updater())
+    asyncio.create_task(chat_members_flusher())
     
-    # Восстанавливаем незавершённые налёты
-    await recover_heists()
+    # Реестр налётов в фазе сбора
+    await load_active_heists()
+
+    # Награды за уровни для расчёта повышений без запросов
+    await load_level_rewards()
+
+    # Выборы лидера и отметки воркера для распределения фоновых задач
+    asyncio.create_task(leader_election_loop())
+    asyncio.create_task(worker_heartbeat_loop())
+
+    # Восстанавливаем сроки налётов, рейсов, отсидок, розыгрышей и бизнесов
+    await load_scheduled_deadlines()
+    asyncio.create_task(deadline_scheduler.run())
+
+    # Загружаем биржевой стакан в память
+    await load_order_book()
+
+    # Загружаем забаненных и права админов в память
+    await load_access_cache()
+
+    # Восстанавливаем кулдауны (только без Redis)
+    try:
+        await load_durable_cooldowns()
+    except Exception as e:
+        logging.error(f"Не удалось восстановить кулдауны: {e}")
+
+    # Строим индексы топов
+    try:
+        await rebuild_leaderboards()
+    except Exception as e:
+        logging.error(f"Не удалось построить индексы топов: {e}")
     
     # Запускаем фоновые задачи
     asyncio.create_task(heist_spawner())
-    asyncio.create_task(process_smuggle_runs())
-    asyncio.create_task(process_jail_sentences())
-    asyncio.create_task(process_giveaways())
+    try:
+        await complete_reached_giveaways()
+    except Exception as e:
+        logging.error(f"Не удалось завершить розыгрыши с набранным порогом: {e}")
     asyncio.create_task(periodic_cleanup())
-    asyncio.create_task(business_expiration_checker())
+    asyncio.create_task(broadcast_resumer())
 
     logging.info("✅ Бот запущен!")
 
 async def on_shutdown():
     """Действия при остановке бота."""
+    await release_leadership()
     if db_pool:
+        try:
+            async with db_pool.acquire() as conn:
+                await conn.execute("DELETE FROM bot_workers WHERE worker_id=$1", WORKER_ID)
+        except Exception as e:
+            logging.error(f"Не удалось снять отметку воркера: {e}")
         await db_pool.close()
     if redis_client:
         await redis_client.close()
@@ -11655,7 +14171,8 @@ async def main():
         
         # Запуск поллинга
         logging.info("Запуск бота...")
-        await dp.start_polling(bot, skip_updates=True)
+        # chat_member не приходит по умолчанию — запрашиваем все используемые типы апдейтов
+        await dp.start_polling(bot, skip_updates=True, allowed_updates=dp.resolve_used_update_types())
         
     except asyncpg.exceptions.InvalidCatalogNameError:
         # База данных не существует